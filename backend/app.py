@@ -1,53 +1,150 @@
-from flask import Flask, jsonify, request
+from flask import Flask, g, has_app_context, jsonify, request, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask import Response
 import io
+import os
+import sys
+import logging
 import csv
+import contextvars
+import copy
+import functools
 import json
-from flask_caching import Cache
+import threading
+import time
 import pandas as pd
 import numpy as np
-from statsmodels.tsa.arima.model import ARIMA
-from sklearn.linear_model import LinearRegression
 from datetime import datetime, timedelta
 import pytz
+from werkzeug.local import LocalProxy
+
+from snapshot import OUT_OF_CORE_TABLES, Snapshot, alphabetical, category_ranks, current_version, open_snapshot
+from ingest import IngestError, ingest_pending, pending_batches
+from cohort import AGE_BANDS, ATTRIBUTES, CohortError, CohortIndex, RowIndex
+from chunked import DEFAULT_CHUNK_ROWS, ChunkPool, ChunkedTable
+from cube import Cube
+from export import (DEFAULT_EXPORT_CHUNK_ROWS, FORMATS as EXPORT_FORMATS, ExportError, TableExport, check_format,
+                    decode_cursor, encode, encode_cursor, formats as export_formats)
+from forecasting import Forecaster
+from metrics import SIZE_BUCKETS, Metrics, SlowRequestProfiler, finish_request, stage, start_request
+from intervals import IntervalIndex
+from observation_index import DEFAULT_PERCENTILES, FREQUENCIES, ObservationIndex
+from response_cache import OUTCOME_KEY, ResponseCache
+from query_plan import QueryPlan, WidgetPool
+from report_jobs import ReportJobs, valid_id as valid_job_id
+from patient_aggregates import PatientTable, QueryError, build_patient_table, patient_frame, update_counts
+from vocabulary import ConditionFlags, load_rules, rules_stamp, rules_version, save_rules, validate_rules
+
+# Serializing jsonify() bodies counts as the request's 'serialize' stage (see metrics.py)
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        with stage('serialize'):
+            return super().dumps(obj, **kwargs)
 
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 CORS(app)
-cache = Cache(app, config={'CACHE_TYPE': 'simple'})  # Simple in-memory cache
-
-# Load CSV data
-patients = pd.read_csv('/Users/harshithathota/Desktop/synthea/output/csv/cleaned_patients.csv')
-conditions = pd.read_csv('/Users/harshithathota/Desktop/synthea/output/csv/cleaned_conditions.csv')
-encounters = pd.read_csv('/Users/harshithathota/Desktop/synthea/output/csv/cleaned_encounters.csv')
-medications = pd.read_csv('/Users/harshithathota/Desktop/synthea/output/csv/cleaned_medications.csv')
-observations = pd.read_csv('/Users/harshithathota/Desktop/synthea/output/csv/cleaned_observations.csv')
-claims = pd.read_csv('/Users/harshithathota/Desktop/synthea/output/csv/cleaned_claims.csv')
-imaging_studies = pd.read_csv('/Users/harshithathota/Desktop/synthea/output/csv/cleaned_imaging_studies.csv')
-immunizations = pd.read_csv('/Users/harshithathota/Desktop/synthea/output/csv/cleaned_immunizations.csv')
-
-
-# Preprocess data at startup to improve performance
-patients['AGE'] = pd.to_datetime(patients['BIRTHDATE']).apply(lambda x: (datetime.now() - x).days // 365)
-conditions['START'] = pd.to_datetime(conditions['START'], utc=True)
-conditions['STOP'] = pd.to_datetime(conditions['STOP'], utc=True, errors='coerce')
-observations['DATE'] = pd.to_datetime(observations['DATE'], utc=True)
-observations['VALUE'] = pd.to_numeric(observations['VALUE'], errors='coerce')
-
-# Define medical condition keywords (expand this based on your data)
-MEDICAL_KEYWORDS = {'disorder', 'disease', 'syndrome', 'infection', 'injury', 'condition'}
-CHRONIC_CONDITIONS = set(
-    conditions[conditions['STOP'].isna() & conditions['DESCRIPTION'].str.lower().apply(lambda x: any(kw in x.lower() for kw in MEDICAL_KEYWORDS))]
-    ['DESCRIPTION'].value_counts().head(5).index
+
+# Debug output of the handlers is only formatted when PHI_LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.environ.get('PHI_LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('phi')
+
+# Data locations are configurable; the CSVs are only parsed when the snapshot is missing or stale
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.environ.get('PHI_DATA_DIR', os.path.join(BASE_DIR, 'csv'))
+SNAPSHOT_DIR = os.environ.get('PHI_SNAPSHOT_DIR', os.path.join(BASE_DIR, 'snapshot'))
+
+INGEST_DIR = os.environ.get('PHI_INGEST_DIR', os.path.join(BASE_DIR, 'incoming'))
+SNAPSHOT_KEEP = int(os.environ.get('PHI_SNAPSHOT_KEEP', 3))
+# How often a process checks whether another one published a new snapshot version
+SNAPSHOT_POLL_SECONDS = float(os.environ.get('PHI_SNAPSHOT_POLL', 1.0))
+ADMIN_TOKEN = os.environ.get('PHI_ADMIN_TOKEN')
+
+# Memory-mapped columnar snapshot; tables are opened lazily on first access.
+# `snapshot` resolves to the version bound to the current request (see bind_snapshot), so a
+# request that started before an ingestion swap finishes on the version it started with.
+current_snapshot = open_snapshot(SNAPSHOT_DIR, csv_dir=DATA_DIR)
+_pinned = contextvars.ContextVar('phi_pinned_snapshot', default=None)
+
+def active_snapshot():
+    pinned = _pinned.get()
+    if pinned is not None:
+        return pinned
+    if has_app_context() and 'snapshot' in g:
+        return g.snapshot
+    return current_snapshot
+
+snapshot = LocalProxy(active_snapshot)
+
+# Medical-keyword and chronic/acute rules (see vocabulary.py); optional JSON override file.
+# POST /api/vocabulary replaces the file; every process reloads it when it notices the change
+# (polled with the snapshot version), and a request keeps the rules it started with
+VOCAB_RULES_PATH = os.environ.get('PHI_VOCAB_RULES', os.path.join(BASE_DIR, 'vocabulary.json'))
+vocab_stamp = rules_stamp(VOCAB_RULES_PATH)
+vocab_rules = load_rules(VOCAB_RULES_PATH)
+
+def active_rules():
+    if has_app_context() and 'vocab_rules' in g:
+        return g.vocab_rules
+    return vocab_rules
+
+# Response cache shared by all worker processes on the host (see response_cache.py)
+cache = ResponseCache(
+    os.environ.get('PHI_CACHE_DIR', os.path.join(BASE_DIR, 'cache')),
+    max_bytes=int(os.environ.get('PHI_CACHE_MAX_MB', 256)) * 2**20,
+    max_entries=int(os.environ.get('PHI_CACHE_MAX_ENTRIES', 10000)),
+    enabled=os.environ.get('PHI_CACHE', '1') != '0',
 )
 
-# Helper function to apply filters
-def apply_filters(df, filters):
-    if "gender" in filters and filters["gender"] != "All":
-        df = df[df["GENDER"] == filters["gender"]]
-    if "age" in filters:
-        df = df[df["AGE"] == int(filters["age"])]
-    return df
+# Requests warmed at startup: the dashboard's default views, then the most requested ones
+WARM_PATHS = [
+    '/api/dashboard_stats',
+    '/api/disease_trends?condition_type=All&year_range=10',
+    '/api/patients',
+    '/api/resource_utilization',
+    '/api/resource_utilization?year=All&encounterClass=All',
+    '/api/reports?report_type=summary&year=All&format=json',
+    '/api/batch?widgets=resource_filters',
+]
+WARM_POPULAR = int(os.environ.get('PHI_CACHE_WARM_POPULAR', 20))
+
+# Forecasts are fitted in a process pool, never on the request path (see forecasting.py);
+# the top-K conditions of the default view are refitted whenever a snapshot is loaded
+forecaster = Forecaster(int(os.environ.get('PHI_FORECAST_WORKERS', 0)) or None)
+FORECAST_TOP_K = int(os.environ.get('PHI_FORECAST_TOP_K', 10))
+DEFAULT_FORECAST_HORIZON = 5
+MAX_FORECAST_HORIZON = 20
+
+# Per-route / per-stage request metrics, exposed on /metrics (see metrics.py). Pre-fork
+# servers point PHI_METRICS_DIR at a directory shared by the workers (see gunicorn.conf.py)
+metrics = Metrics(os.environ.get('PHI_METRICS_DIR'))
+metrics.describe('phi_request_seconds', 'histogram', 'Request latency by route, method and status')
+metrics.describe('phi_stage_seconds', 'histogram', 'Time spent per request stage (load, filter, join, aggregate, serialize, cache)')
+metrics.describe('phi_response_bytes', 'histogram', 'Response body size by route')
+metrics.describe('phi_cache_requests_total', 'counter', 'Requests to cached routes by cache outcome')
+metrics.describe('phi_profiles_total', 'counter', 'Slow-request profiles written')
+metrics.describe('phi_cache_entries', 'gauge', 'Entries in the response cache')
+metrics.describe('phi_cache_bytes', 'gauge', 'Body bytes in the response cache')
+metrics.describe('phi_snapshot_info', 'gauge', 'Snapshot version served by this process')
+metrics.describe('phi_report_jobs_total', 'counter', 'Report jobs finished, by report type and state')
+metrics.describe('phi_report_job_seconds', 'histogram', 'Time to generate a report job, by report type')
+
+# Opt-in: profile a sample of requests and keep the profiles of the slow ones
+profiler = SlowRequestProfiler(os.environ.get('PHI_PROFILE_DIR'),
+                               threshold_ms=float(os.environ.get('PHI_PROFILE_SLOW_MS', 1000)),
+                               sample_rate=float(os.environ.get('PHI_PROFILE_SAMPLE', 0.1)))
+
+# Tables too large to map next to the others (OUT_OF_CORE_TABLES) are never opened whole:
+# their endpoints scan them in chunks of PHI_CHUNK_ROWS rows on PHI_SCAN_THREADS threads (see chunked.py)
+CHUNK_ROWS = int(os.environ.get('PHI_CHUNK_ROWS', DEFAULT_CHUNK_ROWS))
+chunk_pool = ChunkPool(int(os.environ.get('PHI_SCAN_THREADS', os.cpu_count() or 1)))
+# Rows per chunk of a streamed export (see export.py)
+EXPORT_CHUNK_ROWS = int(os.environ.get('PHI_EXPORT_CHUNK_ROWS', DEFAULT_EXPORT_CHUNK_ROWS))
+
+CENSUS_FREQUENCIES = {'day': 'D', 'week': 'W-MON', 'month': 'MS', 'year': 'YS'}
+MAX_CENSUS_POINTS = 20000
 
 # Custom JSON encoder to handle NaN
 class NaNEncoder(json.JSONEncoder):
@@ -55,137 +152,537 @@ class NaNEncoder(json.JSONEncoder):
         if pd.isna(obj):
             return None
         return super().default(obj)
-@app.route("/api/dashboard_stats", methods=["GET"])
-def get_dashboard_stats():
+
+# JSON body encoded with NaNEncoder (NaN -> null)
+def json_response(data, status=200):
+    with stage('serialize'):
+        body = json.dumps(data, cls=NaNEncoder)
+    return body, status, {'Content-Type': 'application/json'}
+
+# Records with ISO dates, as they appeared in the source CSVs
+def to_records(df):
+    df = df.copy()
+    for col in df.select_dtypes(include=['datetimetz', 'datetime']).columns:
+        df[col] = df[col].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+# Parse an optional date/time query parameter as a UTC timestamp
+def parse_timestamp(value, default=None):
+    if not value:
+        return default
     try:
-        # Total Patients: Count unique patients
-        total_patients = len(patients)
+        ts = pd.Timestamp(value)
+    except (ValueError, TypeError):
+        ts = pd.NaT
+    if ts is pd.NaT:
+        raise ValueError(f"Invalid date '{value}', expected an ISO date such as 2020-01-31")
+    return ts.tz_localize('UTC') if ts.tzinfo is None else ts.tz_convert('UTC')
 
-        # Active Encounters: Count encounters ongoing as of today
-        today = pd.Timestamp.now(tz="UTC")
-        encounters["START"] = pd.to_datetime(encounters["START"], utc=True)
-        encounters["STOP"] = pd.to_datetime(encounters["STOP"], utc=True, errors="coerce")
-        active_encounters_df = encounters[
-            (encounters["START"] <= today) &
-            ((encounters["STOP"].isna()) | (encounters["STOP"] >= today))
-        ]
-        active_encounters = active_encounters_df.shape[0]
+# Codes-based membership test for a categorical column
+@stage('filter')
+def category_mask(series, values):
+    wanted = series.cat.categories.get_indexer(list(values))
+    return np.isin(series.cat.codes.to_numpy(), wanted[wanted >= 0])
 
-        # Total Claims Cost: Sum of TOTAL_CLAIM_COST from encounters.csv
-        total_claims_cost = encounters["TOTAL_CLAIM_COST"].sum()
+# value_counts of a categorical without the zero rows of unused vocabulary entries
+# (ties in alphabetical order)
+def category_counts(series):
+    counts = alphabetical(series).value_counts()
+    return counts[counts > 0]
 
-        # Debug prints to verify calculations
-        print(f"Total Patients: {total_patients}")
-        print(f"Active Encounters: {active_encounters}")
-        print(f"Total Claims Cost: {total_claims_cost}")
+# Per-table column derived once per snapshot (e.g. START_YEAR)
+def table_column(table, name, build):
+    return snapshot.derived(f'{table}.{name}', build)
 
-        response_data = {
-            "totalPatients": int(total_patients),
-            "activeEncounters": int(active_encounters),
-            "totalClaimsCost": round(float(total_claims_cost), 2)
-        }
-        return jsonify(response_data)
+# Year and month of a datetime column per row (-1 where the date is missing)
+def split_dates(values):
+    missing = values.isna().to_numpy()
+    year = np.where(missing, -1, values.dt.year.fillna(-1).to_numpy()).astype(np.int16)
+    month = np.where(missing, -1, values.dt.month.fillna(-1).to_numpy()).astype(np.int8)
+    return year, month
+
+def date_parts(table, column):
+    return table_column(table, f'{column}_PARTS', lambda: split_dates(snapshot.table(table)[column]))
+
+# Dense patient id (row position in patients) of each row of a table, -1 when unknown
+def patient_ids(table):
+    return snapshot.patient_ids(table)
+
+# Gather a patients column at the given positions, keeping its dtype (-1 -> missing)
+@stage('join')
+def take_patient_column(column, rows):
+    values = snapshot.patients[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        return pd.Categorical.from_codes(np.where(rows >= 0, codes[np.maximum(rows, 0)], -1), dtype=values.dtype)
+    taken = values.to_numpy()[np.maximum(rows, 0)]
+    if (rows < 0).any():
+        taken = np.where(rows >= 0, taken, np.nan)
+    return taken
+
+# Medical / chronic flags per DESCRIPTION code; recomputed only when the rules change
+def condition_flags():
+    def open_counts():
+        conditions = snapshot.conditions
+        codes = conditions['DESCRIPTION'].cat.codes.to_numpy()
+        open_rows = conditions['STOP'].isna().to_numpy() & (codes >= 0)
+        return np.bincount(codes[open_rows], minlength=len(conditions['DESCRIPTION'].cat.categories))
+    rules = active_rules()
+    counts = snapshot.derived('conditions.OPEN_COUNTS', open_counts)
+    categories = snapshot.conditions['DESCRIPTION'].cat.categories
+    return snapshot.derived(f'condition_flags:{rules_version(rules)}', lambda: ConditionFlags(categories, rules, counts))
+
+# Columns of a table at the given row positions (rows=None: the whole mapped table)
+@stage('load')
+def table_rows(table, columns, rows=None):
+    df = snapshot.table(table)
+    columns = [c for c in columns if c in df]
+    return df if rows is None else df.iloc[rows, df.columns.get_indexer(columns)]
+
+# A per-row array restricted to the given row positions
+def take_rows(values, rows=None):
+    return values if rows is None else np.asarray(values)[rows]
+
+# Built once per snapshot for the whole table, or on the fly for a cohort's rows
+def derived_for(name, build, rows=None):
+    return snapshot.derived(name, build) if rows is None else build()
+
+# Interval indexes over conditions and encounters
+def condition_intervals(rows=None):
+    def build():
+        df = table_rows('conditions', ['START', 'STOP', 'DESCRIPTION'], rows)
+        return IntervalIndex(df['START'], df['STOP'], {
+            'DESCRIPTION': df['DESCRIPTION'],
+            'STATE': take_patient_column('STATE', take_rows(patient_ids('conditions'), rows)),
+        })
+    return derived_for('condition_intervals', build, rows)
+
+def encounter_intervals(rows=None):
+    def build():
+        df = table_rows('encounters', ['START', 'STOP', 'ENCOUNTERCLASS'], rows)
+        return IntervalIndex(df['START'], df['STOP'], {
+            'ENCOUNTERCLASS': df['ENCOUNTERCLASS'],
+            'STATE': take_patient_column('STATE', take_rows(patient_ids('encounters'), rows)),
+        })
+    return derived_for('encounter_intervals', build, rows)
+
+# Encounter and medication cubes (year x month x class x organization / description)
+def encounter_cube(rows=None):
+    def build():
+        measures = ['TOTAL_CLAIM_COST', 'BASE_ENCOUNTER_COST', 'PAYER_COVERAGE']
+        df = table_rows('encounters', ['ENCOUNTERCLASS', 'ORGANIZATION'] + measures, rows)
+        year, month = date_parts('encounters', 'START')
+        return Cube(
+            dims={'year': take_rows(year, rows), 'month': take_rows(month, rows),
+                  'ENCOUNTERCLASS': df['ENCOUNTERCLASS'], 'ORGANIZATION': df['ORGANIZATION']},
+            measures={col: df[col] for col in measures},
+            sketch_dims=['year', 'month', 'ENCOUNTERCLASS'],
+            sketch_keys=take_rows(patient_ids('encounters'), rows),
+            sketch_universe=len(snapshot.patients),
+        )
+    return derived_for('encounter_cube', build, rows)
+
+def medication_cube(rows=None):
+    def build():
+        measures = ['DISPENSES', 'TOTALCOST', 'BASE_COST', 'PAYER_COVERAGE']
+        df = table_rows('medications', ['DESCRIPTION'] + measures, rows)
+        year, month = date_parts('medications', 'START')
+        return Cube(
+            dims={'year': take_rows(year, rows), 'month': take_rows(month, rows), 'DESCRIPTION': df['DESCRIPTION']},
+            measures={col: df[col] for col in measures if col in df},
+            sketch_dims=['year', 'DESCRIPTION'],
+            sketch_keys=take_rows(patient_ids('medications'), rows),
+            sketch_universe=len(snapshot.patients),
+        )
+    return derived_for('medication_cube', build, rows)
+
+# Bitmap cohort index over patient attributes and conditions, built once per snapshot
+def cohort_index():
+    def build():
+        descriptions = snapshot.conditions['DESCRIPTION']
+        return CohortIndex(snapshot.patients, patient_ids('conditions'),
+                           descriptions.cat.codes.to_numpy(), descriptions.cat.categories)
+    return snapshot.derived('cohort_index', build)
+
+# Numeric observations grouped by code and sorted by date, with per-period aggregates
+def observation_index():
+    return snapshot.derived('observation_index', lambda: ObservationIndex(snapshot.observations, patient_ids('observations')))
+
+# Patient set of a cohort expression (None when absent: no filtering)
+@stage('filter')
+def parse_cohort(expression):
+    return cohort_index().parse(expression) if expression else None
+
+# Patient set of the ?cohort= expression
+def cohort_arg():
+    return parse_cohort(request.args.get('cohort'))
+
+# Rows of a table grouped by patient id, built once per snapshot
+def patient_row_index(table):
+    return snapshot.derived(f'{table}.PATIENT_ROWS', lambda: RowIndex(patient_ids(table), len(snapshot.patients)))
+
+# Sorted row positions of a table that belong to a cohort (None when there is no cohort)
+@stage('filter')
+def cohort_rows(table, cohort):
+    if cohort is None:
+        return None
+    return patient_row_index(table).rows(cohort.ids())
+
+# Cache entries are tied to the snapshot and to the vocabulary rules they were computed with
+def cache_version():
+    return f'{snapshot.version}:{rules_version(active_rules())}'
+
+def cached(ttl=None):
+    return cache.view(cache_version, ttl=ttl)
+
+# ETag / If-None-Match only, for responses that are streamed rather than stored
+def conditional():
+    return cache.conditional(cache_version)
+
+def warm_cache():
+    paths = list(dict.fromkeys(WARM_PATHS + cache.popular(WARM_POPULAR)))
+    return cache.warm(app, paths)
+
+# Integer query parameter; ValueError (-> 400) when it is not one
+def int_arg(name, value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        raise ValueError(f"{name} must be an integer, got '{value}'")
+
+# Year filter value for the cubes (None = all years)
+def year_arg(value):
+    return None if value in (None, '', 'All') else int_arg('year', value)
+
+# Dashboard sections are widgets (see query_plan.py): functions (plan, filters) -> data that
+# read shared base frames through the plan, so the sections of one endpoint, or of a whole
+# page requested through /api/batch, filter and slice the data once.
+# Filters every widget understands, with the endpoints' defaults
+WIDGET_FILTERS = {
+    'cohort': '',
+    'as_of': None,
+    'condition_type': 'All',
+    'year_range': 10,
+    'conditions': (),
+    'year': 'All',
+    'encounterClass': 'All',
+}
+
+# Widget filters from query parameters (a MultiDict) or a JSON object
+def widget_filters(source):
+    filters = dict(WIDGET_FILTERS)
+    for name in WIDGET_FILTERS:
+        if name not in source:
+            continue
+        if name == 'conditions':
+            values = source.getlist(name) if hasattr(source, 'getlist') else source[name]
+            values = [values] if isinstance(values, str) else values
+            filters[name] = tuple(v for v in values if v)
+        else:
+            filters[name] = source[name]
+    filters['year_range'] = int_arg('year_range', filters['year_range'])
+    return filters
+
+# Base frames shared by widgets: name -> (filters it depends on, build(plan, filters))
+def medical_conditions_base(plan, filters):
+    min_year = datetime.now(pytz.UTC).year - filters['year_range']
+    df = medical_conditions(filters['condition_type'], min_year, plan.base('cohort', filters))
+    logger.debug("Filtered rows: %d, min_year: %d", len(df), min_year)
+    return df
+
+def encounter_slice(plan, filters):
+    cube = encounter_cube(cohort_rows('encounters', plan.base('cohort', filters)))
+    return cube.where({'year': year_arg(filters['year']), 'ENCOUNTERCLASS': filters['encounterClass']})
+
+def medication_slice(plan, filters):
+    cube = medication_cube(cohort_rows('medications', plan.base('cohort', filters)))
+    return cube.where({'year': year_arg(filters['year'])})
+
+WIDGET_BASES = {
+    'cohort': (('cohort',), lambda plan, filters: parse_cohort(filters['cohort'])),
+    'medical_conditions': (('condition_type', 'year_range', 'cohort'), medical_conditions_base),
+    'encounter_slice': (('year', 'encounterClass', 'cohort'), encounter_slice),
+    'medication_slice': (('year', 'cohort'), medication_slice),
+}
+
+# Evaluate widgets in this thread over one plan -> {name: data}; errors propagate
+def evaluate(widgets, filters):
+    plan = QueryPlan(WIDGET_BASES)
+    return {name: widget(plan, filters) for name, widget in widgets.items()}
+
+def dashboard_stats_widget(plan, filters):
+    # Optional cohort restricts every figure to a patient set
+    cohort = plan.base('cohort', filters)
+    rows = cohort_rows('encounters', cohort)
+
+    # Total Patients: Count unique patients
+    total_patients = len(snapshot.patients) if cohort is None else len(cohort)
+
+    # Active Encounters: Count encounters ongoing as of today (or as_of)
+    as_of = parse_timestamp(filters['as_of'], pd.Timestamp.now(tz="UTC"))
+    active_encounters = encounter_intervals(rows).active_at(as_of).sum()
+
+    # Total Claims Cost: Sum of TOTAL_CLAIM_COST from encounters.csv
+    total_claims_cost = table_rows('encounters', ['TOTAL_CLAIM_COST'], rows)["TOTAL_CLAIM_COST"].sum()
+
+    logger.debug("Total patients: %s, active encounters: %s, total claims cost: %s",
+                 total_patients, active_encounters, total_claims_cost)
+
+    return {
+        "totalPatients": int(total_patients),
+        "activeEncounters": int(active_encounters),
+        "totalClaimsCost": round(float(total_claims_cost), 2)
+    }
+
+@app.route("/api/dashboard_stats", methods=["GET"])
+@cached(ttl=60)
+def get_dashboard_stats():
+    try:
+        return jsonify(dashboard_stats_widget(QueryPlan(WIDGET_BASES), widget_filters(request.args)))
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"Error in get_dashboard_stats: {str(e)}")
+        logger.exception("Error in get_dashboard_stats")
         return jsonify({"error": str(e)}), 500
 
+# Medical condition rows starting in or after min_year (optionally Chronic / Acute only, and
+# only the ?cohort= patients' rows) with their year, description and patient gender / age
+@stage('filter')
+def medical_conditions(condition_type, min_year, cohort=None):
+    conditions = snapshot.conditions
+    flags = condition_flags()
+
+    # Candidate rows: the whole table, or only the rows of the cohort's patients
+    rows = cohort_rows('conditions', cohort)
+    if rows is None:
+        rows = np.arange(len(conditions))
+
+    # Filter to medical conditions only, and by condition type, from per-description flags
+    codes = conditions['DESCRIPTION'].cat.codes.to_numpy()[rows]
+    is_medical, is_chronic = flags.row_flags(codes, conditions['STOP'].array.asi8[rows] == np.iinfo(np.int64).min)
+    keep = is_medical
+    if condition_type == 'Chronic':
+        keep = keep & is_chronic
+    elif condition_type == 'Acute':
+        keep = keep & ~is_chronic
+
+    start_year, _ = date_parts('conditions', 'START')
+    keep &= start_year[rows] >= min_year
+
+    rows, codes = rows[keep], codes[keep]
+    patient_pos = patient_ids('conditions')[rows]
+    return pd.DataFrame({
+        'year': start_year[rows],
+        'DESCRIPTION': pd.Categorical.from_codes(codes, dtype=conditions['DESCRIPTION'].dtype),
+        'GENDER': take_patient_column('GENDER', patient_pos),
+        'AGE': take_patient_column('AGE', patient_pos),
+    })
+
+HBA1C = 'Hemoglobin A1c/Hemoglobin.total in Blood'
+
+# Mean HbA1c per year (Series named avg_hba1c, indexed by year), from the observation index
+def hba1c_trend(min_year, cohort=None):
+    index = observation_index()
+    description = index.lookup(HBA1C)
+    if description is None:
+        return pd.Series([], dtype=np.float64, name='avg_hba1c').rename_axis('year')
+    trend, _ = index.trend(description, 'year', percentiles=(), cohort=cohort)
+    trend = trend[trend['period'] >= min_year]
+    return pd.Series(trend['mean'].to_numpy(), index=trend['period'].to_numpy(), name='avg_hba1c').rename_axis('year')
+
+# Disease trend sections, over the medical condition rows of the selected type and years
+def condition_trends_widget(plan, filters):
+    df = plan.base('medical_conditions', filters)
+    selected_conditions = list(filters['conditions'])
+
+    # Default to top 2 medical conditions if none selected
+    if not selected_conditions:
+        selected_conditions = category_counts(df['DESCRIPTION']).head(2).index.tolist()
+        logger.debug("Default selected conditions: %s", selected_conditions)
+
+    # Yearly counts of the selected conditions (sorted by year)
+    selected = category_mask(df['DESCRIPTION'], selected_conditions)
+    trends_df = df[selected].groupby(['year', alphabetical(df['DESCRIPTION'][selected])], observed=True).size().reset_index(name='count')
+    if trends_df.empty and selected_conditions:  # Fallback if no data for selected conditions
+        logger.debug("No data for %s, falling back to all conditions", selected_conditions)
+        trends_df = df.groupby(['year', alphabetical(df['DESCRIPTION'])], observed=True).size().reset_index(name='count')
+    trends_df.columns = ['year', 'condition', 'count']
+    trends_df = trends_df.sort_values('year')
+    trends_data = trends_df.to_dict(orient='records')
+    logger.debug("Trends data: %d rows", len(trends_data))
+    return trends_data
+
+def condition_heatmap_widget(plan, filters):
+    # Counts per age group x gender x condition; the shared frame is not modified
+    df = plan.base('medical_conditions', filters)
+    age_bins = [0, 18, 35, 50, 65, max(df['AGE'].max(), 120)]
+    age_labels = ['0-18', '19-35', '36-50', '51-65', '65+']
+    age_group = pd.cut(df['AGE'], bins=age_bins, labels=age_labels, right=False).rename('age_group')
+    counts = df.groupby([age_group, df['GENDER'], df['DESCRIPTION']], observed=True).size()
+    # Full grid, zero cells included: every age group x the genders and conditions present,
+    # in alphabetical order (not vocabulary code order, which ingestion appends to)
+    grid = pd.MultiIndex.from_product([age_labels, sorted(df['GENDER'].dropna().unique()),
+                                       sorted(df['DESCRIPTION'].dropna().unique())], names=counts.index.names)
+    heatmap_df = counts.reindex(grid, fill_value=0).reset_index(name='count')
+    return heatmap_df.to_dict(orient='records')
+
+def top_conditions_widget(plan, filters):
+    df = plan.base('medical_conditions', filters)
+    total_cases = len(df)
+    top_conditions_df = category_counts(df['DESCRIPTION']).head(5).reset_index()
+    top_conditions_df.columns = ['condition', 'count']
+    top_conditions_df['percentage'] = (top_conditions_df['count'] / total_cases * 100).round(2)
+    return top_conditions_df.to_dict(orient='records')
+
+def hba1c_trend_widget(plan, filters):
+    min_year = datetime.now(pytz.UTC).year - filters['year_range']
+    return hba1c_trend(min_year, plan.base('cohort', filters)).reset_index().to_dict(orient='records')
+
+DISEASE_TREND_WIDGETS = {
+    'trends': condition_trends_widget,
+    'heatmap': condition_heatmap_widget,
+    'top_conditions': top_conditions_widget,
+    'hba1c_trend': hba1c_trend_widget,
+}
+
 @app.route('/api/disease_trends', methods=['GET'])
-@cache.cached(timeout=300, query_string=True)
+@cached(ttl=300)
 def get_disease_trends():
+    try:
+        return json_response(evaluate(DISEASE_TREND_WIDGETS, widget_filters(request.args)))
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Yearly series to forecast: condition counts and mean HbA1c over the complete years of the
+# range -> {series key: (label, years, values)}; keys carry the filters the series depends on
+def forecast_series(condition_type, year_range, cohort_expression='', conditions=None, top=FORECAST_TOP_K):
+    cohort = cohort_index().parse(cohort_expression) if cohort_expression else None
+    current_year = datetime.now(pytz.UTC).year
+    min_year = current_year - year_range
+    # The current year, or the data's last year if it ends earlier, is incomplete: not fitted
+    end_year = min(current_year, int(date_parts('conditions', 'START')[0].max()))
+    years = np.arange(min_year, end_year)
+    filters = (condition_type, year_range, cohort_expression)
+
+    df = medical_conditions(condition_type, min_year, cohort)
+    df = df[df['year'] < end_year]
+    if not conditions:
+        conditions = category_counts(df['DESCRIPTION']).head(top).index.tolist()
+    df = df[category_mask(df['DESCRIPTION'], conditions)]
+    counts = (df.assign(DESCRIPTION=df['DESCRIPTION'].astype(str))
+              .groupby(['DESCRIPTION', 'year']).size().unstack(fill_value=0)
+              .reindex(index=conditions, columns=years, fill_value=0))
+    series = {('condition', name) + filters: (name, years, counts.loc[name].to_numpy()) for name in conditions}
+
+    hba1c = hba1c_trend(min_year, cohort)
+    hba1c = hba1c[hba1c.index < end_year]
+    series[('hba1c',) + filters] = (HBA1C, hba1c.index.to_numpy(), hba1c.to_numpy())
+    return series
+
+# Fit the default view's series for the current snapshot in parallel (warm-started from the
+# previous version's fits) and wait for them
+def refresh_forecasts(timeout=None):
+    if FORECAST_TOP_K <= 0:
+        return 0
+    jobs = [(key, snapshot.version, years, values, MAX_FORECAST_HORIZON)
+            for key, (_, years, values) in forecast_series('All', 10).items()]
+    return forecaster.refresh(jobs, timeout)
+
+@app.route('/api/disease_forecast', methods=['GET'])
+@cached(ttl=300)
+def get_disease_forecast():
     try:
         condition_type = request.args.get('condition_type', 'All')
-        selected_conditions = request.args.getlist('conditions')
-        year_range = int(request.args.get('year_range', 10))
-
-        df = conditions.merge(patients[['Id', 'GENDER', 'AGE']], left_on='PATIENT', right_on='Id', how='left')
-        
-        # Filter to medical conditions only
-        df = df[df['DESCRIPTION'].str.lower().apply(lambda x: any(kw in x.lower() for kw in MEDICAL_KEYWORDS))]
-
-        # Filter by condition type
-        df['IS_CHRONIC'] = df['DESCRIPTION'].isin(CHRONIC_CONDITIONS) | df['STOP'].isna()
-        if condition_type == 'Chronic':
-            df = df[df['IS_CHRONIC']]
-        elif condition_type == 'Acute':
-            df = df[~df['IS_CHRONIC']]
-
-        # Apply year range
-        current_year = datetime.now(pytz.UTC).year
-        min_year = current_year - year_range
-        df = df[df['START'].dt.year >= min_year]
-
-        print(f"Filtered DF rows: {len(df)}, min_year: {min_year}")  # Debug: Check filtered data size
-
-        # Default to top 2 medical conditions if none selected
-        if not selected_conditions or selected_conditions == ['']:
-            top_conditions = df['DESCRIPTION'].value_counts().head(2).index.tolist()
-            selected_conditions = top_conditions
-            print(f"Default selected_conditions: {selected_conditions}")  # Debug
-
-        # 1. Trends Data (sorted by year)
-        trends_df = df[df['DESCRIPTION'].isin(selected_conditions)].groupby([df['START'].dt.year, 'DESCRIPTION']).size().reset_index(name='count')
-        if trends_df.empty and selected_conditions:  # Fallback if no data for selected conditions
-            print(f"No data for {selected_conditions}, falling back to all conditions")
-            trends_df = df.groupby([df['START'].dt.year, 'DESCRIPTION']).size().reset_index(name='count')
-        trends_df.columns = ['year', 'condition', 'count']
-        trends_df = trends_df.sort_values('year')
-        trends_data = trends_df.to_dict(orient='records')
-        print(f"Trends Data: {trends_data}")  # Debug
-
-        # 2. Heatmap Data
-        age_bins = [0, 18, 35, 50, 65, max(df['AGE'].max(), 120)]
-        age_labels = ['0-18', '19-35', '36-50', '51-65', '65+']
-        df['age_group'] = pd.cut(df['AGE'], bins=age_bins, labels=age_labels, right=False)
-        heatmap_df = df.groupby(['age_group', 'GENDER', 'DESCRIPTION']).size().reset_index(name='count')
-        heatmap_data = heatmap_df.to_dict(orient='records')
-
-        # 3. Top Conditions
-        total_cases = len(df)
-        top_conditions_df = df['DESCRIPTION'].value_counts().head(5).reset_index()
-        top_conditions_df.columns = ['condition', 'count']
-        top_conditions_df['percentage'] = (top_conditions_df['count'] / total_cases * 100).round(2)
-        top_conditions = top_conditions_df.to_dict(orient='records')
-
-        # 4. HbA1c Trend
-        obs_df = observations[observations['DESCRIPTION'] == 'Hemoglobin A1c/Hemoglobin.total in Blood'].copy()
-        obs_df = obs_df[obs_df['DATE'].dt.year >= min_year]
-        obs_trend_df = obs_df.groupby(obs_df['DATE'].dt.year)['VALUE'].mean().reset_index()
-        obs_trend_df = obs_trend_df.sort_values('DATE')
-        obs_trend_data = obs_trend_df.rename(columns={'DATE': 'year', 'VALUE': 'avg_hba1c'}).to_dict(orient='records')
-
-        return json.dumps({
-            'trends': trends_data,
-            'heatmap': heatmap_data,
-            'top_conditions': top_conditions,
-            'hba1c_trend': obs_trend_data
-        }, cls=NaNEncoder), 200, {'Content-Type': 'application/json'}
+        selected_conditions = [c for c in request.args.getlist('conditions') if c]
+        year_range = int_arg('year_range', request.args.get('year_range', 10))
+        horizon = min(max(int_arg('horizon', request.args.get('horizon', DEFAULT_FORECAST_HORIZON)), 1), MAX_FORECAST_HORIZON)
+        top = min(max(int_arg('top', request.args.get('top', 5)), 1), 50)
+        cohort_expression = request.args.get('cohort', '').strip()
+
+        # Only cached models are used here; missing ones are queued and reported as pending.
+        # Models always project MAX_FORECAST_HORIZON years, so every horizon shares them.
+        forecasts, pending = [], []
+        for key, (label, years, values) in forecast_series(condition_type, year_range, cohort_expression,
+                                                           selected_conditions, top).items():
+            model, stale = forecaster.get(key, snapshot.version, years, values, MAX_FORECAST_HORIZON)
+            if model is None:
+                pending.append(label)
+            forecasts.append({
+                'series': key[0],
+                'condition': label,
+                'history': [{'year': int(y), 'value': round(float(v), 3)} for y, v in zip(years, values)],
+                'forecast': model['forecast'][:horizon] if model else None,
+                'model': model['model'] if model else None,
+                'fitted_version': model['version'] if model else None,
+                'stale': stale,
+            })
+
+        # 202 (not cached) until every series has a model for this snapshot
+        complete = not pending and not any(f['stale'] for f in forecasts)
+        return json_response({
+            'horizon': horizon,
+            'version': snapshot.version,
+            'forecasts': [f for f in forecasts if f['series'] == 'condition'],
+            'hba1c': next(f for f in forecasts if f['series'] == 'hba1c'),
+            'pending': pending,
+        }, 200 if complete else 202)
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# Placeholder for other endpoints (e.g., /api/patients)
+# Per-patient aggregates, materialized once per snapshot
+def patient_table():
+    def build():
+        df, counts = build_patient_table(snapshot.patients, snapshot.conditions, patient_ids('conditions'),
+                                         snapshot.medications, patient_ids('medications'))
+        return PatientTable(df, snapshot.version, counts)
+    return snapshot.derived('patient_table', build)
+
+# Optional float query parameter
+def float_arg(name):
+    value = request.args.get(name)
+    return float(value) if value not in (None, '') else None
+
+PAGING_PARAMS = ('limit', 'offset', 'cursor')
+
 @app.route('/api/patients', methods=['GET'])
+@cached()
 def get_patients():
     try:
-        df = patients.copy()
-        df_conditions_count = conditions.groupby('PATIENT')['DESCRIPTION'].count().reset_index(name='condition_count')
-        df_conditions_top = conditions.groupby('PATIENT')['DESCRIPTION'].agg(lambda x: x.value_counts().index[0]).reset_index(name='top_condition')
-        df_medications = pd.read_csv('/Users/harshithathota/Desktop/synthea/output/csv/cleaned_medications.csv').groupby('PATIENT')['DISPENSES'].sum().reset_index(name='medication_count')
-        
-        df = df.merge(df_conditions_count, left_on='Id', right_on='PATIENT', how='left').fillna({'condition_count': 0})
-        df = df.merge(df_conditions_top, left_on='Id', right_on='PATIENT', how='left').fillna({'top_condition': 'None'})
-        df = df.merge(df_medications, left_on='Id', right_on='PATIENT', how='left').fillna({'medication_count': 0})
-        
-        df['HRI'] = (df['condition_count'] * 0.4 + df['HEALTHCARE_EXPENSES'] / 10000 * 0.4 + df['medication_count'] * 0.2)
-        max_hri = df['HRI'].max()
-        df['HRI'] = (df['HRI'] / max_hri * 100).clip(upper=100)
-
-        result = df[['Id', 'GENDER', 'RACE', 'AGE', 'CITY', 'HEALTHCARE_EXPENSES', 'condition_count', 'medication_count', 'HRI', 'top_condition']].to_dict(orient='records')
-        
-        return json.dumps(result, cls=NaNEncoder), 200, {'Content-Type': 'application/json'}
+        table = patient_table()
+        fields = [f for f in request.args.get('fields', '').split(',') if f] or None
+        cohort = cohort_arg()
+
+        # Without paging parameters, return the whole population (or cohort) as before
+        if not any(p in request.args for p in PAGING_PARAMS):
+            df = table.df[table.project(fields)]
+            if cohort is not None:
+                df = df.iloc[cohort.ids()]
+            return json_response(df.to_dict(orient='records'))
+
+        filters = {param: request.args.getlist(param) for param in ('gender', 'race', 'city')}
+        for param in ('hri_min', 'hri_max', 'age_min', 'age_max'):
+            filters[param] = float_arg(param)
+        result = table.query(
+            filters=filters,
+            sort=request.args.get('sort', '-HRI'),
+            limit=request.args.get('limit', 100),
+            offset=request.args.get('offset', 0),
+            cursor=request.args.get('cursor'),
+            fields=fields,
+            members=cohort.mask() if cohort is not None else None,
+        )
+        return json_response(result)
+    except (QueryError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/top_diseases', methods=['GET'])
+@cached()
 def get_top_diseases():
     try:
         disease_filter = request.args.get('disease', 'All')
@@ -193,7 +690,7 @@ def get_top_diseases():
         time_range = request.args.get('timeRange', 'month')
 
         # Determine time ranges
-        today = pd.Timestamp('2025-03-17', tz='UTC')  # Fixed date as per your setup
+        today = parse_timestamp(request.args.get('as_of'), pd.Timestamp('2025-03-17', tz='UTC'))  # Fixed date as per your setup
         if time_range == 'week':
             this_year_start = today - timedelta(days=7)
             last_year_start = today - timedelta(days=14)
@@ -204,45 +701,113 @@ def get_top_diseases():
             this_year_start = today - timedelta(days=30)
             last_year_start = today - timedelta(days=60)
 
-        # Join conditions with patients to get STATE
-        df = conditions.merge(patients[['Id', 'STATE']], left_on='PATIENT', right_on='Id', how='left')
-        df['START'] = pd.to_datetime(df['START'], utc=True)
-        df['STOP'] = df['STOP'].replace('Ongoing', pd.Timestamp('2025-03-17', tz='UTC'))
-        df['STOP'] = pd.to_datetime(df['STOP'], utc=True)
-
-        # Apply filters
-        if disease_filter != 'All':
-            df = df[df['DESCRIPTION'] == disease_filter]
-        if location_filter != 'All':
-            df = df[df['STATE'] == location_filter]
+        # Apply filters on the condition interval index (DESCRIPTION x patient STATE)
+        index = condition_intervals(cohort_rows('conditions', cohort_arg()))
+        mask = index.select(DESCRIPTION=disease_filter, STATE=location_filter)
 
         # This period: active conditions within the last X days
-        this_year_df = df[
-            (df['START'] <= today) & 
-            ((df['STOP'].isna()) | (df['STOP'] >= this_year_start))
-        ]
-        this_year_counts = this_year_df['DESCRIPTION'].value_counts().head(5).to_dict()
+        this_year = index.totals(index.overlapping(this_year_start, today, include_end=True), 'DESCRIPTION', mask)
+        this_year = this_year[this_year > 0].sort_values(ascending=False, kind='stable')
+        this_year_counts = this_year.head(5).to_dict()
 
         # Last period: active conditions in the prior period, excluding current period overlap
-        last_year_df = df[
-            (df['START'] < this_year_start) & 
-            ((df['STOP'].isna()) | (df['STOP'] >= last_year_start)) & 
-            ((df['STOP'].isna()) | (df['STOP'] < this_year_start))
-        ]
-        last_year_counts = last_year_df['DESCRIPTION'].value_counts().to_dict()
+        last_year = index.totals(index.open_started_before(this_year_start) +
+                                 index.stopped_between(last_year_start, this_year_start), 'DESCRIPTION', mask)
+        last_year_counts = last_year[last_year > 0].to_dict()
 
         # Combine data
         top_diseases = [
             {
                 'name': disease,
-                'currentYear': this_year_counts.get(disease, 0),
-                'lastYear': last_year_counts.get(disease, 0),
+                'currentYear': int(this_year_counts.get(disease, 0)),
+                'lastYear': int(last_year_counts.get(disease, 0)),
             }
             for disease in set(this_year_counts.keys()).union(last_year_counts.keys())
         ]
         top_diseases = sorted(top_diseases, key=lambda x: x['currentYear'], reverse=True)[:5]
 
         return create_response(data=top_diseases)
+    except (CohortError, ValueError) as e:
+        return create_response(error=str(e), status=400)
+    except Exception as e:
+        return create_response(error=str(e), status=500)
+
+@app.route('/api/observation_codes', methods=['GET'])
+@cached(ttl=3600)
+def get_observation_codes():
+    try:
+        return jsonify({"codes": observation_index().codes_summary()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Trend of any numeric observation (LOINC code or description): count, mean and approximate
+# percentiles per year or month, optionally within [start, end) and for a cohort
+@app.route('/api/observation_trend', methods=['GET'])
+@cached(ttl=300)
+def get_observation_trend():
+    try:
+        index = observation_index()
+        code = request.args.get('code', '').strip()
+        description = index.lookup(code)
+        if description is None:
+            return jsonify({"error": f"Unknown observation code '{code}'"}), 404
+        freq = request.args.get('freq', 'year')
+        if freq not in FREQUENCIES:
+            return jsonify({"error": f"freq must be one of {list(FREQUENCIES)}"}), 400
+        percentiles = request.args.get('percentiles')
+        try:
+            percentiles = [float(p) for p in percentiles.split(',')] if percentiles else list(DEFAULT_PERCENTILES)
+        except ValueError:
+            return jsonify({"error": "percentiles must be a comma-separated list of numbers"}), 400
+        if not all(0 <= p <= 100 for p in percentiles):
+            return jsonify({"error": "percentiles must be between 0 and 100"}), 400
+
+        trend, rows_read = index.trend(description, freq, percentiles,
+                                       start=parse_timestamp(request.args.get('start')),
+                                       end=parse_timestamp(request.args.get('end')),
+                                       cohort=cohort_arg())
+        return json_response({
+            "code": index.labels['CODE'].get(description),
+            "description": index.categories[description],
+            "units": index.labels['UNITS'].get(description),
+            "freq": freq,
+            "rows_read": int(rows_read),
+            "trend": trend.round(3).to_dict(orient='records'),
+        })
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/census', methods=['GET'])
+@cached()
+def get_census():
+    try:
+        table = request.args.get('table', 'encounters')
+        freq = request.args.get('freq', 'month')
+        cohort = cohort_arg()
+        if table == 'conditions':
+            index = condition_intervals(cohort_rows('conditions', cohort))
+            mask = index.select(DESCRIPTION=request.args.get('disease'), STATE=request.args.get('location'))
+        elif table == 'encounters':
+            index = encounter_intervals(cohort_rows('encounters', cohort))
+            mask = index.select(ENCOUNTERCLASS=request.args.get('encounterClass'), STATE=request.args.get('location'))
+        else:
+            return create_response(error="Invalid table", status=400)
+        if freq not in CENSUS_FREQUENCIES or index.min_time is None:
+            return create_response(error="Invalid freq" if index.min_time is not None else "No data", status=400)
+
+        # Active count at the start of each day / month in [start, end]
+        start = parse_timestamp(request.args.get('start'), index.min_time)
+        end = parse_timestamp(request.args.get('end'), index.max_time)
+        times = pd.date_range(start.normalize(), end, freq=CENSUS_FREQUENCIES[freq])
+        if len(times) > MAX_CENSUS_POINTS:
+            return create_response(error=f"Too many points ({len(times)}), narrow the range", status=400)
+        counts = index.census(times, mask)
+        data = [{'date': t.strftime('%Y-%m-%d'), 'active': int(c)} for t, c in zip(times, counts)]
+        return create_response(data=data)
+    except (CohortError, ValueError) as e:
+        return create_response(error=str(e), status=400)
     except Exception as e:
         return create_response(error=str(e), status=500)
 
@@ -251,211 +816,923 @@ def create_response(data=None, error=None, status=200):
     return jsonify({"data": data, "error": error}), status
 
 @app.route('/api/medications', methods=['GET'])
+@cached()
 def get_medications():
     try:
-        return jsonify(medications.head(50).to_dict(orient="records"))
+        rows = cohort_rows('medications', cohort_arg())
+        df = snapshot.medications
+        return jsonify(to_records(df.head(50) if rows is None else df.iloc[rows[:50]]))
+    except CohortError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/immunizations', methods=['GET'])
+@cached()
 def get_immunizations():
     try:
-        return jsonify(immunizations.head(50).to_dict(orient="records"))
+        rows = cohort_rows('immunizations', cohort_arg())
+        df = snapshot.immunizations
+        return jsonify(to_records(df.head(50) if rows is None else df.iloc[rows[:50]]))
+    except CohortError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 
 @app.route('/api/patient_demographics', methods=['GET'])
+@cached(ttl=3600)
 def get_patient_demographics():
     try:
+        cohort = cohort_arg()
+        patients = table_rows('patients', ['GENDER', 'AGE', 'RACE'], cohort.ids() if cohort is not None else None)
         demographics = {
-            "gender_distribution": patients["GENDER"].value_counts().to_dict(),
+            "gender_distribution": category_counts(patients["GENDER"]).to_dict(),
             "age_distribution": patients["AGE"].value_counts().to_dict(),
-            "race_distribution": patients["RACE"].value_counts().to_dict()
+            "race_distribution": category_counts(patients["RACE"]).to_dict()
         }
         return jsonify(demographics)
+    except CohortError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/medication_trends', methods=['GET'])
+@cached()
 def get_medication_trends():
     try:
-        medication_counts = medications["DESCRIPTION"].value_counts().to_dict()
+        rows = cohort_rows('medications', cohort_arg())
+        medication_counts = category_counts(table_rows('medications', ['DESCRIPTION'], rows)["DESCRIPTION"]).to_dict()
         return jsonify(medication_counts)
+    except CohortError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Resource utilization sections, rolled up from the encounter / medication cubes sliced to
+# the selected year and class (for a cohort, cubes over just the cohort's rows)
+def top_organizations_widget(plan, filters):
+    # Top Organizations by Encounter Count and Cost
+    top_orgs = (plan.base('encounter_slice', filters).rollup(by=['ORGANIZATION'])[['count', 'TOTAL_CLAIM_COST']]
+               .sort_values('count', ascending=False)
+               .head(5))
+    top_orgs['ORG_SHORT'] = top_orgs.index.astype(str).str[:8] + '...'  # Shortened name for display
+    return top_orgs.reset_index().to_dict(orient='records')
+
+def encounter_types_widget(plan, filters):
+    # Encounter Types Distribution
+    encounter_types = (plan.base('encounter_slice', filters).rollup(by=['ENCOUNTERCLASS'])[['count', 'TOTAL_CLAIM_COST', 'BASE_ENCOUNTER_COST']]
+                     .rename(columns={'TOTAL_CLAIM_COST': 'total_cost', 'BASE_ENCOUNTER_COST': 'base_cost'}))
+    encounter_types['avg_cost_per_encounter'] = (encounter_types['total_cost'] / encounter_types['count']).round(2)
+    return encounter_types.reset_index().rename(columns={'ENCOUNTERCLASS': 'class'}).to_dict(orient='records')
+
+def top_medications_widget(plan, filters):
+    # Top Medications by Usage and Cost
+    med_cube = plan.base('medication_slice', filters)
+    top_meds = (med_cube.rollup(by=['DESCRIPTION'])[['DISPENSES', 'TOTALCOST']]
+               .rename(columns={'DISPENSES': 'dispenses', 'TOTALCOST': 'total_cost'})
+               .sort_values('dispenses', ascending=False)
+               .head(5))
+    top_meds['patients_count'] = med_cube.distinct(by=['DESCRIPTION']).reindex(top_meds.index, fill_value=0)
+    top_meds['avg_cost_per_dispense'] = (top_meds['total_cost'] / top_meds['dispenses']).round(2)
+    return top_meds.reset_index().rename(columns={'DESCRIPTION': 'medication'}).to_dict(orient='records')
+
+def monthly_trends_widget(plan, filters):
+    monthly_trends = (plan.base('encounter_slice', filters).rollup(by=['year', 'month'])[['count', 'TOTAL_CLAIM_COST']]
+                    .rename(columns={'count': 'encounters', 'TOTAL_CLAIM_COST': 'total_cost'})
+                    .sort_index())
+    monthly_trends = monthly_trends[monthly_trends.index.get_level_values('year') >= 0]
+    monthly_trends.index = [f"{y:04d}-{m:02d}" for y, m in monthly_trends.index]
+    monthly_trends.index.name = 'month'
+    monthly_trends['cost_per_encounter'] = (monthly_trends['total_cost'] / monthly_trends['encounters']).round(2)
+    return monthly_trends.reset_index().to_dict(orient='records')
+
+def resource_metrics_widget(plan, filters):
+    totals = plan.base('encounter_slice', filters).rollup()
+    return {
+        'total_encounters': int(totals['count']),
+        'total_claims_cost': float(totals['TOTAL_CLAIM_COST']),
+        'avg_cost_per_encounter': round(float(totals['TOTAL_CLAIM_COST'] / totals['count']), 2) if totals['count'] else 0,
+        'payer_coverage_percentage': round(float(totals['PAYER_COVERAGE'] / totals['TOTAL_CLAIM_COST'] * 100), 2) if totals['TOTAL_CLAIM_COST'] > 0 else 0
+    }
+
+def resource_filters_widget(plan, filters):
+    # Years and encounter classes with data under the current filters
+    enc_slice = plan.base('encounter_slice', filters)
+    by_year = enc_slice.rollup(by=['year'])
+    available_years = [y for y in by_year.index[by_year['count'] > 0] if y >= 0]
+    by_class = enc_slice.rollup(by=['ENCOUNTERCLASS'])
+    encounter_classes = sorted(by_class.index[by_class['count'] > 0].astype(str).tolist())
+    return {
+        'available_years': [str(year) for year in available_years],
+        'encounter_classes': encounter_classes
+    }
+
+RESOURCE_WIDGETS = {
+    'top_organizations': top_organizations_widget,
+    'encounter_types': encounter_types_widget,
+    'top_medications': top_medications_widget,
+    'monthly_trends': monthly_trends_widget,
+    'resource_metrics': resource_metrics_widget,
+    'filters': resource_filters_widget,
+}
+
 @app.route('/api/resource_utilization', methods=['GET'])
+@cached()
 def get_resource_utilization():
     try:
-        year_filter = request.args.get('year', 'All')
-        encounter_class = request.args.get('encounterClass', 'All')
-
-        # Prepare encounters DataFrame
-        enc_df = encounters.copy()
-        enc_df['START'] = pd.to_datetime(enc_df['START'], errors='coerce', utc=True)
-
-        # Apply filters
-        if year_filter != 'All':
-            enc_df = enc_df[enc_df['START'].dt.year == int(year_filter)]
-        if encounter_class != 'All':
-            enc_df = enc_df[enc_df['ENCOUNTERCLASS'] == encounter_class]
-
-        # 1. Top Organizations by Encounter Count and Cost
-        top_orgs = (enc_df.groupby('ORGANIZATION')
-                   .agg({'Id': 'count', 'TOTAL_CLAIM_COST': 'sum'})
-                   .rename(columns={'Id': 'count'})
-                   .sort_values('count', ascending=False)
-                   .head(5))
-        top_orgs['ORG_SHORT'] = top_orgs.index.str[:8] + '...'  # Shortened name for display
-        top_orgs_data = top_orgs.reset_index().to_dict(orient='records')
-
-        # 2. Encounter Types Distribution
-        encounter_types = (enc_df.groupby('ENCOUNTERCLASS')
-                         .agg({'Id': 'count', 'TOTAL_CLAIM_COST': 'sum', 'BASE_ENCOUNTER_COST': 'sum'})
-                         .rename(columns={'Id': 'count', 'TOTAL_CLAIM_COST': 'total_cost', 'BASE_ENCOUNTER_COST': 'base_cost'}))
-        encounter_types['avg_cost_per_encounter'] = (encounter_types['total_cost'] / encounter_types['count']).round(2)
-        encounter_types_data = encounter_types.reset_index().rename(columns={'ENCOUNTERCLASS': 'class'}).to_dict(orient='records')
-
-        # 3. Top Medications by Usage and Cost
-        meds_df = medications.copy()
-        if year_filter != 'All':
-            meds_df['START'] = pd.to_datetime(meds_df['START'], errors='coerce', utc=True)
-            meds_df = meds_df[meds_df['START'].dt.year == int(year_filter)]
-        top_meds = (meds_df.groupby('DESCRIPTION')
-                   .agg({'DISPENSES': 'sum', 'TOTALCOST': 'sum', 'PATIENT': 'nunique'})
-                   .rename(columns={'DISPENSES': 'dispenses', 'TOTALCOST': 'total_cost', 'PATIENT': 'patients_count'})
-                   .sort_values('dispenses', ascending=False)
-                   .head(5))
-        top_meds['avg_cost_per_dispense'] = (top_meds['total_cost'] / top_meds['dispenses']).round(2)
-        top_meds_data = top_meds.reset_index().rename(columns={'DESCRIPTION': 'medication'}).to_dict(orient='records')
-
-        # 4. Monthly Trends
-        enc_df['month'] = enc_df['START'].dt.to_period('M').astype(str)
-        monthly_trends = (enc_df.groupby('month')
-                        .agg({'Id': 'count', 'TOTAL_CLAIM_COST': 'sum'})
-                        .rename(columns={'Id': 'encounters', 'TOTAL_CLAIM_COST': 'total_cost'})
-                        .sort_index())
-        monthly_trends['cost_per_encounter'] = (monthly_trends['total_cost'] / monthly_trends['encounters']).round(2)
-        monthly_trends_data = monthly_trends.reset_index().to_dict(orient='records')
-
-        # 5. Resource Metrics
-        resource_metrics = {
-            'total_encounters': int(enc_df['Id'].count()),
-            'total_claims_cost': float(enc_df['TOTAL_CLAIM_COST'].sum()),
-            'avg_cost_per_encounter': float(enc_df['TOTAL_CLAIM_COST'].mean().round(2)) if not enc_df.empty else 0,
-            'payer_coverage_percentage': float((enc_df['PAYER_COVERAGE'].sum() / enc_df['TOTAL_CLAIM_COST'].sum() * 100).round(2)) if enc_df['TOTAL_CLAIM_COST'].sum() > 0 else 0
-        }
+        return json_response(evaluate(RESOURCE_WIDGETS, widget_filters(request.args)))
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        # 6. Available Filters
-        available_years = sorted(enc_df['START'].dt.year.unique().tolist())
-        encounter_classes = sorted(enc_df['ENCOUNTERCLASS'].unique().tolist())
-
-        response_data = {
-            'top_organizations': top_orgs_data,
-            'encounter_types': encounter_types_data,
-            'top_medications': top_meds_data,
-            'monthly_trends': monthly_trends_data,
-            'resource_metrics': resource_metrics,
-            'filters': {
-                'available_years': [str(year) for year in available_years],
-                'encounter_classes': encounter_classes
-            }
-        }
-        return json.dumps(response_data, cls=NaNEncoder), 200, {'Content-Type': 'application/json'}
+# Every widget by name, for /api/batch
+WIDGETS = {
+    'dashboard_stats': dashboard_stats_widget,
+    **DISEASE_TREND_WIDGETS,
+    **{('resource_filters' if name == 'filters' else name): widget for name, widget in RESOURCE_WIDGETS.items()},
+}
+MAX_BATCH_WIDGETS = 50
+
+# Widgets of a batch run concurrently on a per-process thread pool (see query_plan.py)
+widget_pool = WidgetPool(int(os.environ.get('PHI_WIDGET_THREADS', min(4, os.cpu_count() or 1))))
+
+# (id, widget name, filters) per requested widget; a spec is a widget name or
+# {"widget": name, "id": ..., "filters": {...}} with filters overriding the shared ones
+def batch_specs(widgets, shared):
+    if not isinstance(widgets, list) or not widgets:
+        raise ValueError("widgets must be a non-empty list")
+    if len(widgets) > MAX_BATCH_WIDGETS:
+        raise ValueError(f"At most {MAX_BATCH_WIDGETS} widgets per batch")
+    specs = []
+    for spec in widgets:
+        if isinstance(spec, str):
+            spec = {'widget': spec}
+        if not isinstance(spec, dict) or spec.get('widget') not in WIDGETS:
+            raise ValueError(f"Unknown widget {spec!r}; available: {sorted(WIDGETS)}")
+        overrides = spec.get('filters') or {}
+        if not isinstance(overrides, dict):
+            raise ValueError("Widget filters must be an object")
+        specs.append((str(spec.get('id', spec['widget'])), spec['widget'], widget_filters({**shared, **overrides})))
+    if len({widget_id for widget_id, _, _ in specs}) < len(specs):
+        raise ValueError("Widget ids must be unique")
+    return specs
 
+# Run a batch over one query plan -> {"results": {id: data}, "errors": {id: {error, status}}}
+def run_batch(specs):
+    # The widgets run on the pool in copies of this context, so on this request's snapshot
+    plan = QueryPlan(WIDGET_BASES)
+    results, errors = {}, {}
+    outcomes = widget_pool.run([functools.partial(WIDGETS[name], plan, filters) for _, name, filters in specs])
+    for (widget_id, name, _), (data, error) in zip(specs, outcomes):
+        if error is None:
+            results[widget_id] = data
+        elif isinstance(error, (CohortError, ValueError)):
+            errors[widget_id] = {'error': str(error), 'status': 400}
+        else:
+            logger.error("Widget %s failed", name, exc_info=error)
+            errors[widget_id] = {'error': str(error), 'status': 500}
+    return {'version': snapshot.version, 'bases_built': plan.built(), 'results': results, 'errors': errors}
+
+# GET /api/batch?widgets=trends,heatmap&year_range=5: widgets sharing the query filters (cached)
+@app.route('/api/batch', methods=['GET'])
+@cached(ttl=60)
+def get_batch():
+    try:
+        names = [n for value in request.args.getlist('widgets') for n in value.split(',') if n]
+        return json_response(run_batch(batch_specs(names, widget_filters(request.args))))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# POST /api/batch {"filters": {...}, "widgets": ["trends", {"id": ..., "widget": ..., "filters": {...}}]}
+@app.route('/api/batch', methods=['POST'])
+def post_batch():
+    try:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return jsonify({"error": "Expected a JSON object"}), 400
+        shared = body.get('filters') or {}
+        if not isinstance(shared, dict):
+            return jsonify({"error": "filters must be an object"}), 400
+        return json_response(run_batch(batch_specs(body.get('widgets'), widget_filters(shared))))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Encounter row of each encounter Id code, the join key of claims (APPOINTMENTID)
+def encounter_row_of_id():
+    def build():
+        codes = snapshot.encounters['Id'].cat.codes.to_numpy()
+        rows = np.full(len(snapshot.encounters['Id'].cat.categories), -1, dtype=np.int32)
+        rows[codes[codes >= 0]] = np.flatnonzero(codes >= 0)
+        return rows
+    return snapshot.derived('encounters.ROW_OF_ID', build)
+
+CLAIM_MEASURES = ['TOTAL_CLAIM_COST', 'PAYER_COVERAGE', 'OUTSTANDING']
+
+# Claims by (service year, primary payer, department): claim count, cost and payer coverage of
+# the claim's encounter, outstanding balance (primary + secondary + patient), and a patient
+# sketch per (year, payer). Built by an out-of-core scan of the claims files, never mapping
+# the table: once per snapshot, or for a cohort's claims on the fly; first_row scans only
+# the rows from there on (an ingested batch).
+def claims_cube(cohort=None, first_row=0):
+    def build():
+        claims = ChunkedTable(snapshot, 'claims')
+        cost = snapshot.encounters['TOTAL_CLAIM_COST'].to_numpy(dtype=np.float64)
+        coverage = snapshot.encounters['PAYER_COVERAGE'].to_numpy(dtype=np.float64)
+        # Encounter row of each APPOINTMENTID code (-1: no such encounter), joined once on the
+        # vocabulary so the chunks only gather by integer code
+        encounter = snapshot.encounters['Id'].cat.categories.get_indexer(claims.categories('APPOINTMENTID'))
+        row_of_appointment = np.where(encounter >= 0, encounter_row_of_id()[np.maximum(encounter, 0)], -1)
+        payers = pd.CategoricalDtype(pd.Index(claims.categories('PRIMARYPATIENTINSURANCEID'), dtype=object))
+        members = cohort.mask() if cohort is not None else None
+        n_patients = len(snapshot.patients)
+
+        def partial(start, stop):
+            patient = claims.read('PATIENT_ID', start, stop)
+            keep = slice(None) if members is None else (patient >= 0) & members[np.maximum(patient, 0)]
+            patient = patient[keep]
+            appointment = claims.read('APPOINTMENTID', start, stop)[keep]
+            encounter = np.where(appointment >= 0, row_of_appointment[np.maximum(appointment, 0)], -1)
+            matched = encounter >= 0
+            outstanding = sum(np.nan_to_num(claims.read(column, start, stop, np.float64)[keep])
+                              for column in ('OUTSTANDING1', 'OUTSTANDING2', 'OUTSTANDINGP'))
+            department = np.nan_to_num(claims.read('DEPARTMENTID', start, stop, np.float64)[keep], nan=-1)
+            return Cube(
+                dims={'year': claims.read('SERVICEDATE', start, stop, 'year')[keep],
+                      'PAYER': pd.Categorical.from_codes(claims.read('PRIMARYPATIENTINSURANCEID', start, stop)[keep], dtype=payers),
+                      'DEPARTMENT': department.astype(np.int32)},
+                measures={'TOTAL_CLAIM_COST': np.where(matched, cost[np.maximum(encounter, 0)], 0.0),
+                          'PAYER_COVERAGE': np.where(matched, coverage[np.maximum(encounter, 0)], 0.0),
+                          'OUTSTANDING': outstanding},
+                sketch_dims=['year', 'PAYER'],
+                sketch_keys=patient,
+                sketch_universe=n_patients,
+            )
+        return chunk_pool.fold(claims.ranges(CHUNK_ROWS, first_row), partial, Cube.merged)
+    return snapshot.derived('claims_cube', build) if cohort is None and first_row == 0 else build()
+
+# Claim measures of rolled-up cells as records (cost per claim and coverage share added)
+def claim_records(cells, patients=None):
+    cells = cells[['count'] + CLAIM_MEASURES].rename(columns={
+        'count': 'claims', 'TOTAL_CLAIM_COST': 'total_cost', 'PAYER_COVERAGE': 'payer_coverage', 'OUTSTANDING': 'outstanding'})
+    cells['claims'] = cells['claims'].astype(np.int64)
+    cells[['total_cost', 'payer_coverage', 'outstanding']] = cells[['total_cost', 'payer_coverage', 'outstanding']].round(2)
+    cells['avg_cost_per_claim'] = (cells['total_cost'] / cells['claims'].where(cells['claims'] > 0)).round(2).fillna(0)
+    cells['coverage_percentage'] = (cells['payer_coverage'] / cells['total_cost'].where(cells['total_cost'] > 0) * 100).round(2).fillna(0)
+    if patients is not None:
+        cells['patients'] = patients.reindex(cells.index, fill_value=0)
+    return cells
+
+@app.route('/api/claims', methods=['GET'])
+@cached(ttl=300)
+def get_claims():
+    try:
+        if 'claims' not in snapshot.table_names:
+            return jsonify({"error": "No claims table in this snapshot"}), 404
+        filters = {
+            'year': year_arg(request.args.get('year')),
+            'PAYER': request.args.getlist('payer') or None,
+            'DEPARTMENT': [int_arg('department', d) for d in request.args.getlist('department')] or None,
+        }
+        cube = claims_cube(cohort_arg()).where(filters)
+        # Distinct patients come from the (year, payer) sketches: unavailable under a department filter
+        sketched = bool(cube.sketch_dims)
+
+        # to_dict(orient='records') keeps each column's type (a row Series would make claims a float)
+        totals = claim_records(cube.rollup().to_frame().T).to_dict(orient='records')[0]
+        totals['patients'] = cube.distinct() if sketched else None
+
+        by_year = claim_records(cube.rollup(by=['year']), cube.distinct(by=['year']) if sketched else None)
+        by_year = by_year[by_year.index >= 0]
+        by_payer = claim_records(cube.rollup(by=['PAYER']), cube.distinct(by=['PAYER']) if sketched else None)
+        by_payer = by_payer.sort_values('total_cost', ascending=False, kind='stable')
+        by_department = claim_records(cube.rollup(by=['DEPARTMENT'])).sort_index()
+
+        return json_response({
+            'totals': totals,
+            'by_year': by_year.rename_axis('year').reset_index().to_dict(orient='records'),
+            'by_payer': by_payer.rename_axis('payer').reset_index().to_dict(orient='records'),
+            'by_department': by_department.rename_axis('department').reset_index().to_dict(orient='records'),
+        })
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 @app.route('/api/hospitals', methods=['GET'])
+@cached()
 def get_hospitals():
     try:
-        hospitals = ["All"] + sorted(encounters["ORGANIZATION"].unique().tolist())
+        hospitals = ["All"] + sorted(snapshot.encounters["ORGANIZATION"].unique().tolist())
         return jsonify(hospitals)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+REPORT_TYPES = ('summary', 'conditions', 'resources')
+
+# -> (data, CSV header, CSV rows) of a report over the encounters / conditions of `year`
+def report_data(report_type, year, cohort=None):
+    enc_selection = cohort_rows('encounters', cohort)
+    enc_cube = encounter_cube(enc_selection)
+
+    if report_type == 'summary':
+        totals = enc_cube.rollup({'year': year})
+        data = {
+            'total_patients': int(snapshot.patients['Id'].nunique()) if cohort is None else len(cohort),
+            'total_encounters': int(totals['count']),
+            'total_claims_cost': float(totals['TOTAL_CLAIM_COST']),
+            'avg_cost_per_encounter': round(float(totals['TOTAL_CLAIM_COST'] / totals['count']), 2) if totals['count'] else 0,
+            'payer_coverage_percentage': round(float(totals['PAYER_COVERAGE'] / totals['TOTAL_CLAIM_COST'] * 100), 2) if totals['TOTAL_CLAIM_COST'] > 0 else 0,
+            'active_patients': enc_cube.distinct({'year': year}),
+        }
+        headers = ['Metric', 'Value']
+        csv_rows = [
+            ['Total Patients', data['total_patients']],
+            ['Total Encounters', data['total_encounters']],
+            ['Total Claims Cost', f"${data['total_claims_cost']:,.2f}"],
+            ['Avg Cost per Encounter', f"${data['avg_cost_per_encounter']:,.2f}"],
+            ['Payer Coverage Percentage', f"{data['payer_coverage_percentage']}%"],
+            ['Active Patients', data['active_patients']],
+        ]
+
+    elif report_type == 'conditions':
+        # Encounter cost per patient in the selected year, gathered onto each condition row
+        enc_rows = take_rows(patient_ids('encounters'), enc_selection)
+        enc_year = take_rows(date_parts('encounters', 'START')[0], enc_selection)
+        enc_mask = enc_rows >= 0
+        if year is not None:
+            enc_mask &= enc_year == year
+        cost = take_rows(np.nan_to_num(snapshot.encounters['TOTAL_CLAIM_COST'].to_numpy(dtype=np.float64)), enc_selection)
+        patient_cost = np.bincount(enc_rows[enc_mask], weights=cost[enc_mask], minlength=len(snapshot.patients))
+        expenses = snapshot.patients['HEALTHCARE_EXPENSES'].to_numpy(dtype=np.float64)
+        patient_hri = expenses / np.where(patient_cost == 0, 1, patient_cost) * 100  # Simplified HRI
+
+        cond_selection = cohort_rows('conditions', cohort)
+        cond_rows = take_rows(patient_ids('conditions'), cond_selection)
+        cond_year = take_rows(date_parts('conditions', 'START')[0], cond_selection)
+        keep = cond_rows >= 0
+        if year is not None:
+            keep &= cond_year == year
+        rows = cond_rows[keep]
+        descriptions = snapshot.conditions['DESCRIPTION']
+        description_codes = take_rows(descriptions.cat.codes.to_numpy(), cond_selection)
+        cond_df = pd.DataFrame({
+            'DESCRIPTION': pd.Categorical.from_codes(description_codes[keep], dtype=descriptions.dtype),
+            'PATIENT': rows,
+            'TOTAL_CLAIM_COST': patient_cost[rows],
+            'HRI': patient_hri[rows],
+        })
+
+        top_conditions = (cond_df.groupby(alphabetical(cond_df['DESCRIPTION']), observed=True)
+                          .agg({'PATIENT': 'nunique', 'TOTAL_CLAIM_COST': 'sum', 'HRI': 'mean'})
+                          .rename(columns={'PATIENT': 'patientCount', 'TOTAL_CLAIM_COST': 'totalCost', 'HRI': 'avgHRI'})
+                          .sort_values('patientCount', ascending=False)
+                          .head(10))
+        data = top_conditions.reset_index().rename(columns={'DESCRIPTION': 'condition'}).to_dict(orient='records')
+        headers = ['Condition', 'Patient Count', 'Total Cost', 'Average HRI']
+        csv_rows = [headers] + [[row['condition'], row['patientCount'], f"${row['totalCost']:,.2f}", f"{row['avgHRI']:.1f}"] for row in data]
+
+    elif report_type == 'resources':
+        yearly_data = (enc_cube.rollup({'year': year}, by=['year'])[['count', 'TOTAL_CLAIM_COST']]
+                       .rename(columns={'count': 'encounters', 'TOTAL_CLAIM_COST': 'totalCost'}))
+        yearly_data = yearly_data[yearly_data.index >= 0]
+        yearly_data['avgCostPerEncounter'] = (yearly_data['totalCost'] / yearly_data['encounters']).round(2)
+        data = yearly_data.reset_index().to_dict(orient='records')
+        headers = ['Year', 'Encounters', 'Total Cost', 'Average Cost Per Encounter']
+        csv_rows = [headers] + [[row['year'], row['encounters'], f"${row['totalCost']:,.2f}", f"${row['avgCostPerEncounter']:,.2f}"] for row in data]
+
+    return data, headers, csv_rows
+
+# CSV text of a report's header and rows
+def report_csv(headers, csv_rows):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(headers)
+    writer.writerows(csv_rows[1:])
+    return output.getvalue()
+
 @app.route('/api/reports', methods=['GET'])
+@cached()
 def get_reports():
     try:
         report_type = request.args.get('report_type', 'summary')
         format_type = request.args.get('format', 'json')
         year_filter = request.args.get('year', 'All')
 
-        enc_df = encounters.copy()
-        enc_df['START'] = pd.to_datetime(enc_df['START'], errors='coerce', utc=True)
-        if year_filter != 'All':
-            enc_df = enc_df[enc_df['START'].dt.year == int(year_filter)]
-
-        if report_type == 'summary':
-            data = {
-                'total_patients': int(patients['Id'].nunique()),
-                'total_encounters': int(enc_df['Id'].count()),
-                'total_claims_cost': float(enc_df['TOTAL_CLAIM_COST'].sum()),
-                'avg_cost_per_encounter': float(enc_df['TOTAL_CLAIM_COST'].mean().round(2)) if not enc_df.empty else 0,
-                'payer_coverage_percentage': float((enc_df['PAYER_COVERAGE'].sum() / enc_df['TOTAL_CLAIM_COST'].sum() * 100).round(2)) if enc_df['TOTAL_CLAIM_COST'].sum() > 0 else 0,
-                'active_patients': int(enc_df['PATIENT'].nunique()),
-            }
-            headers = ['Metric', 'Value']
-            csv_rows = [
-                ['Total Patients', data['total_patients']],
-                ['Total Encounters', data['total_encounters']],
-                ['Total Claims Cost', f"${data['total_claims_cost']:,.2f}"],
-                ['Avg Cost per Encounter', f"${data['avg_cost_per_encounter']:,.2f}"],
-                ['Payer Coverage Percentage', f"{data['payer_coverage_percentage']}%"],
-                ['Active Patients', data['active_patients']],
-            ]
-
-        elif report_type == 'conditions':
-            cond_df = conditions.merge(patients[['Id']], left_on='PATIENT', right_on='Id', how='left')
-            enc_cost_df = enc_df.groupby('PATIENT')['TOTAL_CLAIM_COST'].sum().reset_index()
-            patient_df = patients.merge(enc_cost_df, left_on='Id', right_on='PATIENT', how='left').fillna({'TOTAL_CLAIM_COST': 0})
-            patient_df['HRI'] = patient_df['HEALTHCARE_EXPENSES'] / patient_df['TOTAL_CLAIM_COST'].replace(0, 1) * 100  # Simplified HRI
-            cond_df = cond_df.merge(patient_df[['Id', 'TOTAL_CLAIM_COST', 'HRI']], left_on='PATIENT', right_on='Id', how='left')
-            if year_filter != 'All':
-                cond_df = cond_df[cond_df['START'].dt.year == int(year_filter)]
-            
-            top_conditions = (cond_df.groupby('DESCRIPTION')
-                              .agg({'PATIENT': 'nunique', 'TOTAL_CLAIM_COST': 'sum', 'HRI': 'mean'})
-                              .rename(columns={'PATIENT': 'patientCount', 'TOTAL_CLAIM_COST': 'totalCost', 'HRI': 'avgHRI'})
-                              .sort_values('patientCount', ascending=False)
-                              .head(10))
-            data = top_conditions.reset_index().rename(columns={'DESCRIPTION': 'condition'}).to_dict(orient='records')
-            headers = ['Condition', 'Patient Count', 'Total Cost', 'Average HRI']
-            csv_rows = [headers] + [[row['condition'], row['patientCount'], f"${row['totalCost']:,.2f}", f"{row['avgHRI']:.1f}"] for row in data]
-
-        elif report_type == 'resources':
-            enc_df['year'] = enc_df['START'].dt.year
-            yearly_data = (enc_df.groupby('year')
-                           .agg({'Id': 'count', 'TOTAL_CLAIM_COST': 'sum'})
-                           .rename(columns={'Id': 'encounters', 'TOTAL_CLAIM_COST': 'totalCost'}))
-            yearly_data['avgCostPerEncounter'] = (yearly_data['totalCost'] / yearly_data['encounters']).round(2)
-            data = yearly_data.reset_index().to_dict(orient='records')
-            headers = ['Year', 'Encounters', 'Total Cost', 'Average Cost Per Encounter']
-            csv_rows = [headers] + [[row['year'], row['encounters'], f"${row['totalCost']:,.2f}", f"${row['avgCostPerEncounter']:,.2f}"] for row in data]
-
-        else:
+        if report_type not in REPORT_TYPES:
             return jsonify({"error": "Invalid report type"}), 400
+        data, headers, csv_rows = report_data(report_type, year_arg(year_filter), cohort_arg())
 
         if format_type == 'csv':
-            output = io.StringIO()
-            writer = csv.writer(output)
-            writer.writerow(headers)
-            writer.writerows(csv_rows[1:] if report_type == 'summary' else csv_rows[1:])
-            csv_data = output.getvalue()
-            output.close()
             return Response(
-                csv_data,
+                report_csv(headers, csv_rows),
                 mimetype='text/csv',
                 headers={"Content-Disposition": f"attachment;filename={report_type}_report_{year_filter}.csv"}
             )
         else:
-            return json.dumps({"data": data}, cls=NaNEncoder), 200, {'Content-Type': 'application/json'}
+            return json_response({"data": data})
+
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Failed to generate report: {str(e)}"}), 500
+
+# Reports generated off the request path (see report_jobs.py): a job runs on a per-process
+# thread pool and its JSON / CSV results are kept on disk per snapshot version
+report_jobs = ReportJobs(os.environ.get('PHI_REPORT_DIR', os.path.join(BASE_DIR, 'report_jobs')),
+                         lambda job: run_report_job(job),
+                         workers=int(os.environ.get('PHI_REPORT_WORKERS', 2)))
+
+# -> (JSON body, CSV body) of a job's report, computed on the job's snapshot version
+def run_report_job(job):
+    source = snapshot_of_version(job['version'])
+    if source is None:
+        raise ValueError(f"Snapshot {job['version']} is no longer kept")
+    started = time.perf_counter()
+    try:
+        with pinned(source):
+            data, headers, csv_rows = report_data(job['report_type'], year_arg(job['year']), parse_cohort(job['cohort']))
+    except Exception:
+        metrics.inc('phi_report_jobs_total', report_type=job['report_type'], state='failed')
+        raise
+    metrics.inc('phi_report_jobs_total', report_type=job['report_type'], state='done')
+    metrics.observe('phi_report_job_seconds', time.perf_counter() - started, report_type=job['report_type'])
+    return json.dumps({"data": data}, cls=NaNEncoder).encode(), report_csv(headers, csv_rows).encode()
+
+def report_job_view(job):
+    urls = {'status_url': f"/api/reports/jobs/{job['id']}"}
+    if job['state'] == 'done':
+        urls['result_url'] = f"/api/reports/jobs/{job['id']}/result"
+    return {**{k: v for k, v in job.items() if k != 'updated'}, **urls}
+
+@app.route('/api/reports/jobs', methods=['GET', 'POST'])
+def report_jobs_view():
+    try:
+        if request.method == 'GET':
+            version = request.args.get('version', snapshot.version)
+            if version != snapshot.version and version not in report_jobs.versions():
+                return jsonify({"error": f"Unknown snapshot version '{version}'"}), 404
+            return jsonify({'version': version, 'jobs': [report_job_view(job) for job in report_jobs.list(version)]})
+
+        # Parameters as for /api/reports, from the JSON body or the query string
+        body = request.get_json(silent=True)
+        if (body is None and request.get_data()) or (body is not None and not isinstance(body, dict)):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+        params = {**request.args.to_dict(), **(body or {})}
+        report_type = params.get('report_type', 'summary')
+        if report_type not in REPORT_TYPES:
+            return jsonify({"error": "Invalid report type"}), 400
+        year = year_arg(params.get('year', 'All'))
+        cohort = str(params.get('cohort') or '').strip()
+        parse_cohort(cohort)
+        job = report_jobs.submit(snapshot.version, report_type, 'All' if year is None else str(year), cohort)
+        # 200 with the result's URL when it is already there, else 202 to poll the status
+        if job['state'] == 'done':
+            return jsonify(report_job_view(job))
+        return jsonify(report_job_view(job)), 202, {'Location': f"/api/reports/jobs/{job['id']}"}
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/reports/jobs/<job_id>', methods=['GET'])
+def report_job_status(job_id):
+    job = report_jobs.get(job_id) if valid_job_id(job_id) else None
+    if job is None:
+        return jsonify({"error": "Unknown report job"}), 404
+    return jsonify(report_job_view(job))
+
+@app.route('/api/reports/jobs/<job_id>/result', methods=['GET'])
+def report_job_result(job_id):
+    try:
+        job = report_jobs.get(job_id) if valid_job_id(job_id) else None
+        if job is None:
+            return jsonify({"error": "Unknown report job"}), 404
+        if job['state'] == 'failed':
+            return jsonify({"error": f"Failed to generate report: {job['error']}"}), 500
+        if job['state'] != 'done':
+            return jsonify({"error": f"Report job is {job['state']}", **report_job_view(job)}), 409
+        format_type = request.args.get('format', 'json')
+        if format_type not in ('json', 'csv'):
+            return jsonify({"error": "format must be json or csv"}), 400
+        # Results never change once written, so the file's ETag / Last-Modified answer revalidations
+        if format_type == 'csv':
+            return send_file(report_jobs.path(job, 'csv'), mimetype='text/csv', as_attachment=True,
+                             download_name=f"{job['report_type']}_report_{job['year']}.csv")
+        return send_file(report_jobs.path(job, 'json'), mimetype='application/json')
+    except FileNotFoundError:
+        return jsonify({"error": "Report job result is gone; submit the job again"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Streaming exports (see export.py): a table, a page of it, or a report's result rows as
+# CSV, NDJSON or Arrow IPC. Any other parameter names a text column to filter on.
+EXPORT_PARAMS = ('format', 'fields', 'limit', 'cursor', 'cohort', 'start', 'end')
+
+# The snapshot of a cursor's version: the request's own, or an older one still kept on disk
+def snapshot_of_version(version):
+    current = active_snapshot()
+    if version == current.version:
+        return current
+    if version not in os.listdir(SNAPSHOT_DIR) or not os.path.exists(os.path.join(SNAPSHOT_DIR, version, 'meta.json')):
+        return None
+    return Snapshot(os.path.join(SNAPSHOT_DIR, version))
+
+def export_response(chunks, fmt, name, headers):
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    headers = {**headers, "Content-Disposition": f"attachment;filename={name}.{extension}"}
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+@app.route('/api/export', methods=['GET'])
+@conditional()
+def get_exports():
+    tables = {name: {'rows': info['rows'], 'columns': {c['name']: c['kind'] for c in info['columns']}}
+              for name, info in snapshot.meta['tables'].items()}
+    return jsonify({'version': snapshot.version, 'formats': export_formats(), 'tables': tables, 'reports': list(REPORT_TYPES)})
+
+@app.route('/api/export/<table>', methods=['GET'])
+@conditional()
+def export_table(table):
+    try:
+        fmt = check_format(request.args.get('format', 'csv'))
+        limit = request.args.get('limit')
+        limit = int(limit) if limit not in (None, '') else None
+        if limit is not None and limit < 1:
+            raise ExportError("limit must be at least 1")
+        # The rows come from the snapshot the request started on, or the one paging started on
+        source, start = active_snapshot(), 0
+        if request.args.get('cursor'):
+            version, start = decode_cursor(request.args['cursor'], table)
+            source = snapshot_of_version(version)
+            if source is None:
+                return jsonify({"error": f"Snapshot {version} is no longer kept; restart paging"}), 410
+        if table not in source.table_names:
+            return jsonify({"error": f"No {table} table in this snapshot"}), 404
 
+        cohort = cohort_arg()
+        export = TableExport(
+            source, table,
+            fields=[f for f in request.args.get('fields', '').split(',') if f] or None,
+            where={name: request.args.getlist(name) for name in request.args if name not in EXPORT_PARAMS},
+            start=parse_timestamp(request.args.get('start')),
+            end=parse_timestamp(request.args.get('end')),
+            members=cohort.mask() if cohort is not None else None,
+            chunk_rows=EXPORT_CHUNK_ROWS,
+        )
+        stop = export.page_end(start, limit)
+        headers = {'X-Snapshot-Version': source.version}
+        if stop < export.rows:
+            headers['X-Next-Cursor'] = encode_cursor(source.version, table, stop)
+        return export_response(export.stream(fmt, start, stop), fmt, table, headers)
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/export/reports/<report_type>', methods=['GET'])
+@conditional()
+def export_report(report_type):
+    try:
+        fmt = check_format(request.args.get('format', 'csv'))
+        if report_type not in REPORT_TYPES:
+            return jsonify({"error": "Invalid report type"}), 404
+        year_filter = request.args.get('year', 'All')
+        data, _, _ = report_data(report_type, year_arg(year_filter), cohort_arg())
+        frame = pd.DataFrame(data if isinstance(data, list) else [data])
+        return export_response(encode([frame], fmt, list(frame.columns)), fmt, f"{report_type}_report_{year_filter}",
+                               {'X-Snapshot-Version': snapshot.version})
+    except (CohortError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Failed to generate report: {str(e)}"}), 500
 
+# Operations that change state shared by every worker need PHI_ADMIN_TOKEN configured and
+# sent as X-Admin-Token; -> the 403 response, or None when the request may proceed
+def admin_forbidden(action):
+    if not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        return jsonify({"error": f"Forbidden: {action} requires PHI_ADMIN_TOKEN"}), 403
+    return None
+
+@app.route('/api/vocabulary', methods=['GET', 'POST'])
+def vocabulary_rules():
+    try:
+        if request.method == 'POST':
+            # Rules change for every process, so changing them is always an admin operation
+            forbidden = admin_forbidden("changing the rules")
+            if forbidden:
+                return forbidden
+            body = request.get_json(silent=True)
+            if not isinstance(body, dict):
+                return jsonify({"error": "Request body must be a JSON object of rules"}), 400
+            # Partial update of the rules on disk; only the per-description flags are recomputed
+            with _vocab_lock:
+                save_rules(VOCAB_RULES_PATH, validate_rules({**load_rules(VOCAB_RULES_PATH), **body}))
+                reload_rules()
+            g.vocab_rules = vocab_rules
+        return jsonify(condition_flags().summary())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/cohort', methods=['GET'])
+def get_cohort():
+    try:
+        # Size of a ?cohort= expression, without running any endpoint on it
+        cohort = cohort_arg()
+        if cohort is None:
+            cohort = cohort_index().everyone()
+        return jsonify({
+            "cohort": request.args.get('cohort', ''),
+            "patients": len(cohort),
+            "population": cohort.n,
+            "attributes": ATTRIBUTES,
+            "age_bands": list(AGE_BANDS),
+        })
+    except CohortError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/cache', methods=['GET', 'DELETE'])
+def cache_info():
+    try:
+        if request.method == 'DELETE':
+            # The cache is shared by every worker; stats stay open, emptying it does not
+            forbidden = admin_forbidden("emptying the cache")
+            if forbidden:
+                return forbidden
+            cache.clear()
+        return jsonify(cache.stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/cache/warm', methods=['POST'])
+def cache_warm():
+    try:
+        # A synchronous run of every warm-up query
+        forbidden = admin_forbidden("warming the cache")
+        if forbidden:
+            return forbidden
+        return jsonify(warm_cache())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/snapshot', methods=['GET'])
+def get_snapshot_info():
+    try:
+        return jsonify({
+            "version": snapshot.version,
+            "parent": snapshot.meta.get('parent'),
+            "batch": snapshot.meta.get('batch'),
+            "tables": {name: info['rows'] for name, info in snapshot.meta['tables'].items()},
+            "loaded": snapshot.stats
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Map every table and build the per-snapshot indexes up front; pre-fork servers call
+# this once in the master process so every worker shares the result (see wsgi.py)
+def preload():
+    snapshot.load_all(exclude=OUT_OF_CORE_TABLES)
+    for build in (condition_flags, condition_intervals, encounter_intervals, encounter_cube,
+                  medication_cube, patient_table, cohort_index, observation_index):
+        build()
+    if 'claims' in snapshot.table_names:
+        claims_cube()
+    for table in ('conditions', 'encounters', 'medications', 'observations'):
+        patient_row_index(table)
+    refresh_forecasts()
+    return snapshot.stats
+
+# Resolve `snapshot` to a given version in this context (outside of a request's binding);
+# pool tasks submitted meanwhile run in a copy of the context, so they resolve it too
+class pinned:
+    def __init__(self, version):
+        self.version = version
+
+    def __enter__(self):
+        self.token = _pinned.set(self.version)
+
+    def __exit__(self, *exc):
+        _pinned.reset(self.token)
+
+# Extend the previous version's derived structures with the rows an ingested batch
+# appended instead of rebuilding them; anything not carried over is rebuilt on first use
+def carry_over(old, new):
+    if new.meta.get('parent') != old.version:
+        return []
+    appended = new.meta.get('appended', {})
+    # Tables whose earlier rows were linked to patients of this batch: structures keyed by
+    # patient id are rebuilt for them rather than extended
+    relinked = new.meta.get('relinked', {})
+    carried = []
+    with pinned(new):
+        # Per-row date parts: unchanged tables keep theirs, appended rows are split and added
+        for name in old.derived_names():
+            if name.endswith('_PARTS'):
+                table, column = name[:-len('_PARTS')].split('.', 1)
+                parts = old.cached_derived(name)
+                if table in appended:
+                    extra = split_dates(new.table(table)[column].iloc[appended[table]:])
+                    parts = tuple(np.concatenate([p, e]) for p, e in zip(parts, extra))
+                new.set_derived(name, parts)
+                carried.append(name)
+
+        # Open-row counts per description, which decide CHRONIC_CONDITIONS
+        counts = old.cached_derived('conditions.OPEN_COUNTS')
+        if counts is not None:
+            descriptions = new.conditions['DESCRIPTION']
+            n_codes = len(descriptions.cat.categories)
+            counts = np.concatenate([counts, np.zeros(n_codes - len(counts), dtype=counts.dtype)])
+            if 'conditions' in appended:
+                first = appended['conditions']
+                codes = descriptions.cat.codes.to_numpy()[first:]
+                open_rows = new.conditions['STOP'].iloc[first:].isna().to_numpy() & (codes >= 0)
+                counts = counts + np.bincount(codes[open_rows], minlength=n_codes)
+            new.set_derived('conditions.OPEN_COUNTS', counts)
+            carried.append('conditions.OPEN_COUNTS')
+
+        # Cubes: merge in a cube over just the appended rows
+        for name, table, build in (('encounter_cube', 'encounters', encounter_cube),
+                                   ('medication_cube', 'medications', medication_cube)):
+            cube = old.cached_derived(name)
+            if cube is None or table in relinked:
+                continue
+            if table in appended:
+                cube = cube.merged(build(np.arange(appended[table], len(new.table(table)))))
+            else:
+                cube = copy.copy(cube)
+                cube.sketch_universe = len(new.patients)
+            new.set_derived(name, cube)
+            carried.append(name)
+
+        # Claims cube: scan just the appended claims
+        cube = old.cached_derived('claims_cube')
+        if cube is not None and 'claims' not in relinked:
+            if 'claims' in appended:
+                cube = cube.merged(claims_cube(first_row=appended['claims']))
+            else:
+                cube = copy.copy(cube)
+                cube.sketch_universe = len(new.patients)
+            new.set_derived('claims_cube', cube)
+            carried.append('claims_cube')
+
+        # Per-patient aggregates: count the appended rows, recompute top conditions of their patients
+        table = old.cached_derived('patient_table')
+        if table is not None and table.counts is not None and not {'conditions', 'medications'} & set(relinked):
+            conditions, medications = new.conditions, new.medications
+            counts = update_counts(
+                table.counts, len(new.patients),
+                np.asarray(patient_ids('conditions')), conditions['DESCRIPTION'].cat.codes.to_numpy(),
+                np.asarray(patient_ids('medications')), medications['DISPENSES'].fillna(0).to_numpy(),
+                appended.get('conditions', len(conditions)), appended.get('medications', len(medications)),
+                category_ranks(conditions['DESCRIPTION'].cat.categories))
+            df = patient_frame(new.patients, counts, conditions['DESCRIPTION'].cat.categories)
+            new.set_derived('patient_table', PatientTable(df, new.version, counts))
+            carried.append('patient_table')
+    return carried
+
+_swap_lock = threading.Lock()
+_last_poll = 0.0
+
+# Open a published version, carry over / build its derived structures, then make it current.
+# Requests keep using the version they are bound to until they finish.
+def switch_snapshot(version):
+    global current_snapshot
+    started = time.perf_counter()
+    old, new = current_snapshot, Snapshot(os.path.join(SNAPSHOT_DIR, version))
+    carried = carry_over(old, new)
+    with pinned(new):
+        preload()
+    current_snapshot = new
+    logger.info("Switched to snapshot %s in %.2fs (carried over %d structures)",
+                version, time.perf_counter() - started, len(carried))
+    # Report job results of versions no longer kept can never be asked for again
+    report_jobs.prune(os.listdir(SNAPSHOT_DIR))
+    if cache.enabled:
+        threading.Thread(target=warm_cache, daemon=True).start()
+    return carried
+
+def _switch_in_background(version):
+    try:
+        switch_snapshot(version)
+    except Exception:
+        logger.exception("Error switching to snapshot %s", version)
+    finally:
+        _swap_lock.release()
+
+# Current version, noticing (at most every SNAPSHOT_POLL_SECONDS) versions published by an
+# ingestion in this or another process, and rules files replaced since the last check; the
+# switch itself runs in the background
+def latest_snapshot():
+    global _last_poll
+    now = time.monotonic()
+    if now - _last_poll >= SNAPSHOT_POLL_SECONDS:
+        _last_poll = now
+        version = current_version(SNAPSHOT_DIR)
+        if version and version != current_snapshot.version and _swap_lock.acquire(blocking=False):
+            threading.Thread(target=_switch_in_background, args=(version,), daemon=True).start()
+        reload_rules()
+    return current_snapshot
+
+# Reload the vocabulary rules when their file was replaced (by a POST in any process or by hand)
+_vocab_lock = threading.Lock()
+
+def reload_rules():
+    global vocab_rules, vocab_stamp
+    stamp = rules_stamp(VOCAB_RULES_PATH)
+    if stamp == vocab_stamp:
+        return
+    try:
+        rules = load_rules(VOCAB_RULES_PATH)
+    except (OSError, ValueError) as e:
+        logger.error("Keeping vocabulary rules %s; %s is invalid: %s", rules_version(vocab_rules), VOCAB_RULES_PATH, e)
+    else:
+        if rules != vocab_rules:
+            logger.info("Vocabulary rules %s -> %s", rules_version(vocab_rules), rules_version(rules))
+        vocab_rules = rules
+    vocab_stamp = stamp
+
+@app.before_request
+def bind_snapshot():
+    g.snapshot = latest_snapshot()
+    g.vocab_rules = vocab_rules
+
+# Per-request stage timers; recorded per route (the URL rule, so paths with ids share one series)
+@app.before_request
+def start_timing():
+    start_request()
+    profiler.start()
+
+@app.after_request
+def record_timing(response):
+    timer = finish_request()
+    if timer is None:
+        return response
+    seconds = timer.elapsed()
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe('phi_request_seconds', seconds, route=route, method=request.method, status=str(response.status_code))
+    for name, spent in timer.stages.items():
+        metrics.observe('phi_stage_seconds', spent, route=route, stage=name)
+    if response.content_length is not None:
+        metrics.observe('phi_response_bytes', response.content_length, buckets=SIZE_BUCKETS, route=route)
+    outcome = request.environ.get(OUTCOME_KEY)
+    if outcome is not None:
+        metrics.inc('phi_cache_requests_total', route=route, outcome=outcome)
+    path = profiler.finish(route, seconds)
+    if path is not None:
+        metrics.inc('phi_profiles_total', route=route)
+        logger.info("Slow request %s (%.0f ms) profiled to %s", request.full_path, seconds * 1000, path)
+    return response
+
+# after_request handlers are skipped when a request fails; teardown always runs
+@app.teardown_request
+def release_profiler(exc):
+    profiler.discard()
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    gauges = [('phi_snapshot_info', {'version': current_snapshot.version}, 1)]
+    stats = cache.stats()
+    if stats['enabled']:
+        gauges += [('phi_cache_entries', {}, stats['entries']), ('phi_cache_bytes', {}, stats['bytes'])]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/ingest', methods=['GET', 'POST'])
+def ingest_batches():
+    try:
+        if ADMIN_TOKEN and request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+            return jsonify({"error": "Forbidden"}), 403
+        if request.method == 'GET':
+            return jsonify({"drop_dir": INGEST_DIR, "pending": [os.path.basename(b) for b in pending_batches(INGEST_DIR)],
+                            "version": current_snapshot.version})
+        # Apply every pending batch of the drop directory, then switch this process right away
+        started = time.perf_counter()
+        results = ingest_pending(SNAPSHOT_DIR, INGEST_DIR, SNAPSHOT_KEEP)
+        version = current_version(SNAPSHOT_DIR)
+        carried = []
+        if version != current_snapshot.version:
+            with _swap_lock:
+                carried = switch_snapshot(version)
+        return jsonify({
+            "batches": results,
+            "version": version,
+            "carried_over": carried,
+            "seconds": round(time.perf_counter() - started, 3),
+        })
+    except IngestError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    # Run the development server from serve.py, so forecasting's spawned workers (which
+    # re-import __main__) do not load this module
+    os.execv(sys.executable, [sys.executable, os.path.join(BASE_DIR, 'serve.py'), *sys.argv[1:]])
\ No newline at end of file
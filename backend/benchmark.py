@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+# Per-endpoint benchmark over synthetic data (see synth.py).
+#
+# For every scale (number of patients) the CSVs are generated once under --data-root and
+# the snapshot is built in its own process (timed). A fresh interpreter then imports
+# app.py, preloads the snapshot (timed: startup) and requests every case of every GET
+# route through the Flask test client with the response cache disabled:
+#
+#   first_ms       the first request (lazily built structures included)
+#   p50_ms/p95_ms  over --repeat further requests
+#   bytes          response size
+#   peak_alloc_mb  peak memory allocated during one request (tracemalloc, separate pass)
+#
+# plus the process's peak RSS per scale. Results can be stored as a baseline; a later run
+# fails (exit 1) when a case is slower than the baseline by more than --tolerance (and
+# --min-ms), allocates more than --memory-tolerance above it, or changes status.
+#
+#   python benchmark.py --scales 1000,10000 --save-baseline
+#   python benchmark.py --scales 1000,10000
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, 'benchmarks', 'baseline.json')
+DEFAULT_DATA_ROOT = os.path.join(HERE, 'benchmarks', 'data')
+
+# Representative filter combinations per route; GET routes not listed run without parameters
+CASES = {
+    '/api/dashboard_stats': ['', '?as_of=2020-01-01', '?cohort=gender:F AND age:65%2B'],
+    '/api/disease_trends': ['', '?condition_type=Chronic', '?condition_type=Acute&year_range=30',
+                            '?conditions=Hypertension (disorder)&conditions=Asthma (disorder)',
+                            '?cohort=state:Texas'],
+    '/api/disease_forecast': ['', '?horizon=10&top=3', '?condition_type=Chronic'],
+    '/api/patients': ['', '?limit=20&sort=-HRI&gender=F', '?limit=50&sort=AGE&age_min=65',
+                      '?limit=100&offset=500&race=white&city=Texville 1', '?cohort=condition:"Diabetes mellitus type 2 (disorder)"&limit=50'],
+    '/api/top_diseases': ['', '?timeRange=year&location=Texas', '?timeRange=week&disease=Asthma (disorder)'],
+    '/api/observation_codes': [''],
+    '/api/observation_trend': ['?code=4548-4', '?code=8480-6&freq=month', '?code=4548-4&start=2020-01-01&end=2022-01-01',
+                               '?code=39156-5&cohort=gender:M&percentiles=10,50,90'],
+    '/api/census': ['', '?table=conditions&freq=year', '?table=encounters&freq=day&start=2024-01-01&end=2024-03-01',
+                    '?encounterClass=inpatient&location=Texas'],
+    '/api/resource_utilization': ['', '?year=2020', '?encounterClass=inpatient', '?year=2018&encounterClass=wellness',
+                                  '?cohort=age:65%2B'],
+    '/api/reports': ['', '?year=2019', '?report_type=conditions', '?report_type=conditions&year=2020',
+                     '?report_type=resources', '?report_type=resources&year=2021&format=csv',
+                     '?report_type=summary&format=csv&year=2015'],
+    '/api/batch': ['?widgets=resource_filters',
+                   '?widgets=dashboard_stats,trends,heatmap,top_conditions,hba1c_trend,top_organizations,encounter_types,'
+                   'top_medications,monthly_trends,resource_metrics,resource_filters&cohort=gender:F'],
+    '/api/claims': ['', '?year=2020', '?department=3', '?cohort=age:65%2B'],
+    '/api/cohort': ['?cohort=gender:F AND (age:65%2B OR condition:"Hypertension (disorder)") AND NOT state:Texas'],
+}
+
+# Routes with path parameters run only with these URLs
+PATH_CASES = {
+    '/api/export/<table>': ['/api/export/encounters', '/api/export/observations?format=ndjson',
+                            '/api/export/claims?format=ndjson&limit=10000',
+                            '/api/export/encounters?ENCOUNTERCLASS=inpatient&cohort=age:65%2B'],
+    '/api/export/reports/<report_type>': ['/api/export/reports/conditions?year=2020', '/api/export/reports/resources?format=ndjson'],
+}
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 3)
+
+
+def cases(app):
+    # (route, url) for every GET route of the app; POST / DELETE forms have side effects and are skipped
+    routes = sorted({rule.rule for rule in app.url_map.iter_rules()
+                     if 'GET' in rule.methods and rule.rule.startswith('/api/') and '<' not in rule.rule})
+    return ([(route, route + query.replace(' ', '%20')) for route in routes for query in CASES.get(route, [''])]
+            + [(route, url) for route, urls in PATH_CASES.items() for url in urls])
+
+
+def run_scale(repeat):
+    # Runs in the worker process: PHI_* variables point at the scale's data
+    started = time.perf_counter()
+    import app as backend
+    imported = time.perf_counter()
+    backend.preload()
+    preloaded = time.perf_counter()
+
+    client = backend.app.test_client()
+    results = {}
+    for route, url in cases(backend.app):
+        t = time.perf_counter()
+        response = client.get(url)
+        first = (time.perf_counter() - t) * 1000
+        # 202: the work was queued in the background (e.g. forecast fits); time the finished response
+        deadline = time.time() + 120
+        while response.status_code == 202 and time.time() < deadline:
+            time.sleep(0.1)
+            response = client.get(url)
+        size = len(response.get_data())
+        timings = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            client.get(url).get_data()
+            timings.append((time.perf_counter() - t) * 1000)
+        results[url] = {'route': route, 'status': response.status_code, 'bytes': size, 'first_ms': round(first, 3),
+                        'p50_ms': percentile(timings, 50), 'p95_ms': percentile(timings, 95)}
+
+    # Allocation peaks in a separate pass: tracemalloc slows every allocation down
+    tracemalloc.start()
+    for url, result in results.items():
+        tracemalloc.reset_peak()
+        client.get(url).get_data()
+        result['peak_alloc_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 3)
+    tracemalloc.stop()
+    backend.forecaster.close()
+
+    return {
+        'import_seconds': round(imported - started, 3),
+        'startup_seconds': round(preloaded - started, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'cases': results,
+    }
+
+
+def build_snapshot():
+    # Runs in the worker process: converts the scale's CSVs into a snapshot
+    from snapshot import open_snapshot
+    started = time.perf_counter()
+    open_snapshot(os.environ['PHI_SNAPSHOT_DIR'], csv_dir=os.environ['PHI_DATA_DIR'])
+    return {'build_seconds': round(time.perf_counter() - started, 3)}
+
+
+def worker(mode, scale_dir, repeat, verbose):
+    # Run one phase in a fresh interpreter; -> its JSON result
+    env = dict(os.environ, PHI_DATA_DIR=os.path.join(scale_dir, 'csv'),
+               PHI_SNAPSHOT_DIR=os.path.join(scale_dir, 'snapshot'), PHI_CACHE='0',
+               PHI_INGEST_DIR=os.path.join(scale_dir, 'incoming'))
+    with tempfile.NamedTemporaryFile(suffix='.json') as out:
+        subprocess.run([sys.executable, __file__, '--worker', mode, '--repeat', str(repeat), '--out', out.name],
+                       cwd=HERE, env=env, check=True, stdout=None if verbose else subprocess.DEVNULL)
+        return json.load(open(out.name))
+
+
+def prepare(scale, data_root, seed, rebuild):
+    scale_dir = os.path.join(data_root, str(scale))
+    csv_dir = os.path.join(scale_dir, 'csv')
+    if not os.path.exists(os.path.join(csv_dir, 'cleaned_patients.csv')):
+        from synth import generate
+        print(f"Generating {scale} patients -> {csv_dir}")
+        generate(scale, csv_dir, seed=seed)
+    if rebuild:
+        import shutil
+        shutil.rmtree(os.path.join(scale_dir, 'snapshot'), ignore_errors=True)
+    return scale_dir
+
+
+def compare(results, baseline, args):
+    # -> list of regression messages
+    regressions = []
+    for scale, current in results.items():
+        base = baseline.get('scales', {}).get(scale)
+        if base is None:
+            print(f"  {scale}: no baseline")
+            continue
+        if current['startup_seconds'] > base['startup_seconds'] * (1 + args.tolerance) + 0.5:
+            regressions.append(f"{scale} startup {base['startup_seconds']}s -> {current['startup_seconds']}s")
+        for url, case in current['cases'].items():
+            old = base['cases'].get(url)
+            if old is None:
+                continue
+            if case['status'] != old['status']:
+                regressions.append(f"{scale} {url}: status {old['status']} -> {case['status']}")
+            if case['p50_ms'] > old['p50_ms'] * (1 + args.tolerance) and case['p50_ms'] - old['p50_ms'] > args.min_ms:
+                regressions.append(f"{scale} {url}: p50 {old['p50_ms']}ms -> {case['p50_ms']}ms")
+            if case['peak_alloc_mb'] > old['peak_alloc_mb'] * (1 + args.memory_tolerance) + 1:
+                regressions.append(f"{scale} {url}: peak alloc {old['peak_alloc_mb']}MB -> {case['peak_alloc_mb']}MB")
+    return regressions
+
+
+def report(scale, result):
+    print(f"\n{scale} patients: snapshot build {result.get('build_seconds', '-')}s, "
+          f"startup {result['startup_seconds']}s, peak RSS {result['peak_rss_mb']} MiB")
+    print(f"{'status':>6}{'first ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'bytes':>11}{'alloc MB':>10}  url")
+    for url, case in result['cases'].items():
+        print(f"{case['status']:>6}{case['first_ms']:>10.1f}{case['p50_ms']:>10.1f}{case['p95_ms']:>10.1f}"
+              f"{case['bytes']:>11}{case['peak_alloc_mb']:>10.1f}  {url}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every GET endpoint on synthetic data')
+    parser.add_argument('--scales', default='1000,10000', help='comma-separated patient counts')
+    parser.add_argument('--repeat', type=int, default=20, help='timed requests per case')
+    parser.add_argument('--data-root', default=DEFAULT_DATA_ROOT, help='generated data, one directory per scale')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the snapshots from the CSVs')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative p50 / startup increase')
+    parser.add_argument('--min-ms', type=float, default=2.0, help='ignore p50 increases below this')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='allowed relative allocation increase')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help="show the app's output")
+    parser.add_argument('--worker', choices=['build', 'run'], help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = build_snapshot() if args.worker == 'build' else run_scale(args.repeat)
+        with open(args.out, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    results = {}
+    for scale in [int(s) for s in args.scales.split(',') if s]:
+        scale_dir = prepare(scale, args.data_root, args.seed, args.rebuild)
+        built = os.path.exists(os.path.join(scale_dir, 'snapshot', 'CURRENT'))
+        result = {} if built else worker('build', scale_dir, args.repeat, args.verbose)
+        result.update(worker('run', scale_dir, args.repeat, args.verbose))
+        results[str(scale)] = result
+        report(scale, result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = json.load(open(args.baseline)) if os.path.exists(args.baseline) else {'scales': {}}
+        baseline['scales'].update(results)
+        baseline['recorded'] = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                                'machine': platform.machine(), 'cpus': os.cpu_count()}
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to record one")
+        return 0
+    print(f"\nComparing with {args.baseline}")
+    regressions = compare(results, json.load(open(args.baseline)), args)
+    for message in regressions:
+        print(f"  REGRESSION {message}")
+    if regressions:
+        print(f"FAIL: {len(regressions)} regression(s)", file=sys.stderr)
+        return 1
+    print("OK: no regressions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
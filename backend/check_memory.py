@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Memory budget check for the pre-fork serving mode (Linux only, needs gunicorn).
+#
+# Starts gunicorn with wsgi.py and the given number of workers, sends every worker a
+# round of dashboard requests, then reads /proc/<pid>/smaps_rollup of each worker:
+#
+#   rss      resident pages, including the shared snapshot mappings and the heap
+#            inherited from the master (counted again in every worker)
+#   private  pages only this worker holds (its own heap + copy-on-write copies)
+#   pss      proportional share; summed over all processes it is the real footprint
+#
+# The check fails when a worker's private memory exceeds --budget-mb (or its RSS
+# exceeds --rss-budget-mb when given), i.e. when adding a worker would cost more than
+# the budget.
+#
+#   python check_memory.py --workers 4 --budget-mb 128
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+URLS = [
+    '/api/dashboard_stats', '/api/disease_trends', '/api/patients', '/api/top_diseases',
+    '/api/patients?limit=100&sort=-HRI', '/api/census?table=encounters&freq=month',
+    '/api/resource_utilization', '/api/reports?report_type=conditions', '/api/patient_demographics',
+    '/api/medication_trends', '/api/resource_utilization?cohort=gender:F AND age:65%2B',
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def cmdline(pid):
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def workers_of(pid):
+    # Forked workers run the master's command line; other children (e.g. multiprocessing's
+    # resource tracker) do not
+    return [child for child in children(pid) if cmdline(child) == cmdline(pid)]
+
+
+def memory(pid):
+    # -> {'rss', 'pss', 'private'} in bytes from smaps_rollup (status as a fallback)
+    values = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(':') and parts[1].isdigit():
+                    values[parts[0][:-1]] = int(parts[1]) * 1024
+    except OSError:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    values['Rss'] = int(line.split()[1]) * 1024
+    return {
+        'rss': values.get('Rss', 0),
+        'pss': values.get('Pss', 0),
+        'private': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0),
+    }
+
+
+def wait_ready(base, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            urllib.request.urlopen(f'{base}/api/snapshot', timeout=2).read()
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"gunicorn did not answer within {timeout}s")
+
+
+def fetch(url):
+    try:
+        with urllib.request.urlopen(url, timeout=300) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def measure(workers=4, threads=4, rounds=3, startup_timeout=600, env=None):
+    # Start gunicorn (wsgi.py, preload), send every worker `rounds` rounds of URLS, read the
+    # memory of each process; -> (master, {worker pid: memory}, failed request count)
+    port = free_port()
+    env = dict(os.environ if env is None else env, PHI_BIND=f'127.0.0.1:{port}', PHI_WORKERS=str(workers),
+               PHI_THREADS=str(threads), PHI_ACCESS_LOG='/dev/null')
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application'],
+                               cwd=HERE, env=env, start_new_session=True)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        wait_ready(base, process, startup_timeout)
+        # Enough concurrent requests that every worker serves each URL a few times
+        urls = [base + url.replace(' ', '%20') for url in URLS] * workers * rounds
+        with ThreadPoolExecutor(workers * threads) as pool:
+            statuses = list(pool.map(fetch, urls))
+        failed = len([s for s in statuses if s != 200])
+        return memory(process.pid), {pid: memory(pid) for pid in workers_of(process.pid)}, failed
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check per-worker memory of the gunicorn serving mode')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=3, help='request rounds per worker')
+    parser.add_argument('--budget-mb', type=float, default=128, help='max private MiB per worker')
+    parser.add_argument('--rss-budget-mb', type=float, default=None, help='optional max RSS MiB per worker')
+    parser.add_argument('--startup-timeout', type=float, default=600)
+    parser.add_argument('--json', action='store_true', help='print the measurements as JSON')
+    args = parser.parse_args()
+
+    master, workers, failed = measure(args.workers, args.threads, args.rounds, args.startup_timeout)
+    requests = len(URLS) * args.workers * args.rounds
+
+    mib = lambda b: b / 2**20
+    over = [pid for pid, m in workers.items()
+            if mib(m['private']) > args.budget_mb or (args.rss_budget_mb and mib(m['rss']) > args.rss_budget_mb)]
+    if args.json:
+        print(json.dumps({'master': master, 'workers': workers, 'failed_requests': failed, 'over_budget': over}, indent=2))
+    else:
+        print(f"{'process':<16}{'rss MiB':>10}{'pss MiB':>10}{'private MiB':>13}")
+        print(f"{'master':<16}{mib(master['rss']):>10.1f}{mib(master['pss']):>10.1f}{mib(master['private']):>13.1f}")
+        for pid, m in workers.items():
+            print(f"{'worker ' + str(pid):<16}{mib(m['rss']):>10.1f}{mib(m['pss']):>10.1f}{mib(m['private']):>13.1f}")
+        total = master['pss'] + sum(m['pss'] for m in workers.values())
+        print(f"total footprint (sum of pss): {mib(total):.1f} MiB; {requests} requests, {failed} failed")
+    if not workers:
+        print("No workers found", file=sys.stderr)
+        return 1
+    if over or failed:
+        print(f"FAIL: {len(over)} worker(s) over budget, {failed} failed request(s)", file=sys.stderr)
+        return 1
+    print(f"OK: every worker under {args.budget_mb} MiB private" +
+          (f" and {args.rss_budget_mb} MiB RSS" if args.rss_budget_mb else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
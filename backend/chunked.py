@@ -0,0 +1,115 @@
+import collections
+import os
+
+import numpy as np
+
+from snapshot import PATIENT_ID_FILE, npy_layout
+from thread_pool import ThreadPool
+
+# Out-of-core scans over snapshot tables.
+#
+# ChunkedTable reads a row range of just the requested columns straight from the table's
+# .npy files (a seek plus one read per column, no memory mapping), so a scan over a table
+# that does not fit in memory holds one chunk of the pruned columns at a time. Columns come
+# back compact: category codes keep their narrow integer width, datetimes can be reduced
+# to int16 years while reading, numerics can be downcast.
+#
+# fold() runs a function over every chunk and merges the partial aggregates it returns
+# (counts, sums, distinct-count sketches: anything with an associative merge) in row
+# order. Chunks run on a per-process thread pool (see thread_pool.py): the per-chunk work
+# is numpy kernels and file reads, which release the GIL, and the threads share the
+# process's join lookups instead of copying them per worker. At most 2 chunks per thread
+# are in flight, which bounds peak memory by the chunk size rather than the table size.
+
+DEFAULT_CHUNK_ROWS = 1_000_000
+NAT = np.iinfo(np.int64).min
+
+
+def years(ns):
+    # int64 nanoseconds (NaT = min int64) -> int16 calendar year, -1 where missing
+    year = ns.astype('datetime64[ns]').astype('datetime64[Y]').astype(np.int64) + 1970
+    return np.where(ns == NAT, -1, year).astype(np.int16)
+
+
+class ChunkedTable:
+    def __init__(self, snapshot, table):
+        info = snapshot.meta['tables'][table]
+        self.snapshot = snapshot
+        self.table = table
+        self.path = os.path.join(snapshot.path, table)
+        self.rows = info['rows']
+        self.columns = {c['name']: c for c in info['columns']}
+        self._layouts = {}
+
+    def __len__(self):
+        return self.rows
+
+    def _file(self, column):
+        if column == 'PATIENT_ID':
+            return os.path.join(self.path, PATIENT_ID_FILE)
+        kind = self.columns[column]['kind']
+        return os.path.join(self.path, f"{column}.{'codes' if kind == 'category' else 'values'}.npy")
+
+    def _layout(self, path):
+        layout = self._layouts.get(path)
+        if layout is None:
+            layout = self._layouts[path] = npy_layout(path)
+        return layout
+
+    def dtype(self, column):
+        # dtype of the stored values (category codes for a category column)
+        return self._layout(self._file(column))[0]
+
+    def read(self, column, start, stop, as_type=None):
+        # Rows [start, stop) of one column: category codes, int64 ns for datetimes (as_type='year':
+        # int16 years), values for numerics (optionally converted to as_type); PATIENT_ID: dense ids
+        path = self._file(column)
+        # The table's rows come from meta.json: the file may hold rows of later versions
+        dtype, _, offset = self._layout(path)
+        stop = min(stop, self.rows)
+        with open(path, 'rb') as f:
+            f.seek(offset + start * dtype.itemsize)
+            values = np.fromfile(f, dtype=dtype, count=max(stop - start, 0))
+        if as_type == 'year':
+            return years(values)
+        return values if as_type is None else values.astype(as_type, copy=False)
+
+    def categories(self, column):
+        # Categories of a category column (memory-mapped unless it uses a shared vocabulary)
+        meta = self.columns[column]
+        if 'vocabulary' in meta:
+            return self.snapshot.vocabulary(meta['vocabulary']).categories
+        return np.load(os.path.join(self.path, f'{column}.categories.npy'), mmap_mode='r')
+
+    def ranges(self, chunk_rows, first=0):
+        # Row ranges of at most chunk_rows covering [first, rows); one empty range for no rows
+        chunk_rows = max(1, int(chunk_rows))
+        return [(start, min(start + chunk_rows, self.rows)) for start in range(first, self.rows, chunk_rows)] or [(first, first)]
+
+
+class ChunkPool(ThreadPool):
+    def __init__(self, workers):
+        super().__init__(workers, 'phi-chunk')
+
+    def fold(self, ranges, partial, merge):
+        # partial(start, stop) -> aggregate of a chunk; merge(a, b) -> aggregate; None when no chunks
+        if self.workers == 1 or len(ranges) < 2:
+            result = None
+            for start, stop in ranges:
+                part = partial(start, stop)
+                result = part if result is None else merge(result, part)
+            return result
+        result = None
+        in_flight = collections.deque()
+        todo = iter(ranges)
+        for start, stop in todo:
+            in_flight.append(self.submit(partial, start, stop))
+            if len(in_flight) >= 2 * self.workers:
+                break
+        while in_flight:
+            part = in_flight.popleft().result()
+            result = part if result is None else merge(result, part)
+            for start, stop in todo:
+                in_flight.append(self.submit(partial, start, stop))
+                break
+        return result
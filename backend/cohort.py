@@ -0,0 +1,208 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# Cohort engine over dense patient ids (the row position of a patient in the snapshot).
+#
+# Every attribute value (gender, race, state, city, age band, "has condition X") is a
+# bitmap with one bit per patient, packed into uint64 words and built lazily on first
+# use. Cohort expressions combine them with AND / OR / NOT word by word, so a query
+# costs n_patients / 64 operations whatever the size of the clinical tables.
+#
+# `RowIndex` maps a patient set back to the rows of a table (rows grouped by patient,
+# CSR style), so filtered queries touch only the cohort's rows.
+
+CATEGORY_ATTRIBUTES = {'gender': 'GENDER', 'race': 'RACE', 'state': 'STATE', 'city': 'CITY'}
+AGE_BANDS = {'0-18': (0, 18), '19-35': (18, 35), '36-50': (35, 50), '51-65': (50, 65), '65+': (65, None)}
+ATTRIBUTES = list(CATEGORY_ATTRIBUTES) + ['age', 'condition']
+
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+class CohortError(ValueError):
+    pass
+
+
+def _pack(mask):
+    # Bool array -> uint64 words (bit i of the set = patient i)
+    padded = np.zeros(-(-len(mask) // 64) * 64, dtype=bool)
+    padded[:len(mask)] = mask
+    return np.packbits(padded, bitorder='little').view(np.uint64)
+
+
+class Cohort:
+    def __init__(self, words, n):
+        self.words = words
+        self.n = n
+
+    @classmethod
+    def from_ids(cls, ids, n):
+        mask = np.zeros(n, dtype=bool)
+        mask[ids] = True
+        return cls(_pack(mask), n)
+
+    @classmethod
+    def everyone(cls, n):
+        return cls.from_ids(slice(None), n)
+
+    def __and__(self, other):
+        return Cohort(self.words & other.words, self.n)
+
+    def __or__(self, other):
+        return Cohort(self.words | other.words, self.n)
+
+    def __invert__(self):
+        # Complement within the population; padding bits past n stay clear
+        return Cohort(~self.words, self.n) & Cohort.everyone(self.n)
+
+    def __len__(self):
+        return int(np.bitwise_count(self.words).sum())
+
+    def mask(self):
+        return np.unpackbits(self.words.view(np.uint8), bitorder='little', count=self.n).astype(bool)
+
+    def ids(self):
+        return np.flatnonzero(self.mask())
+
+
+class CohortIndex:
+    def __init__(self, patients, condition_ids, condition_codes, condition_categories):
+        # patients: the patients table (row i = patient id i)
+        # condition_ids / condition_codes: patient id and DESCRIPTION code of each conditions row
+        self.patients = patients
+        self.n = len(patients)
+        self.condition_categories = pd.Index(condition_categories)
+        self._conditions = RowIndex(np.asarray(condition_codes), len(self.condition_categories))
+        self._condition_ids = np.asarray(condition_ids)
+        self._bitmaps = {}
+
+    def bitmap(self, attribute, value):
+        # Bitmaps are cached per vocabulary entry (code), never per typed value, so the
+        # cache is bounded by the vocabulary; values nobody has are an uncached empty set
+        key = self._resolve(attribute, value)
+        if key is None:
+            return Cohort(_pack(np.zeros(self.n, dtype=bool)), self.n)
+        cohort = self._bitmaps.get(key)
+        if cohort is None:
+            cohort = self._bitmaps[key] = Cohort(_pack(self._members(*key)), self.n)
+        return cohort
+
+    def _resolve(self, attribute, value):
+        # -> (attribute, category code or age band), or None when no patient can match
+        if attribute in CATEGORY_ATTRIBUTES:
+            code = self.patients[CATEGORY_ATTRIBUTES[attribute]].cat.categories.get_indexer([value])[0]
+            return (attribute, int(code)) if code >= 0 else None
+        if attribute == 'age':
+            if value not in AGE_BANDS:
+                raise CohortError(f"Unknown age band '{value}', expected one of {list(AGE_BANDS)}")
+            return attribute, value
+        if attribute == 'condition':
+            code = self.condition_categories.get_indexer([value])[0]
+            return (attribute, int(code)) if code >= 0 else None
+        raise CohortError(f"Unknown cohort attribute '{attribute}', expected one of {ATTRIBUTES}")
+
+    def _members(self, attribute, key):
+        # Bool mask over patients for one attribute value (code or age band)
+        if attribute in CATEGORY_ATTRIBUTES:
+            return self.patients[CATEGORY_ATTRIBUTES[attribute]].cat.codes.to_numpy() == key
+        if attribute == 'age':
+            low, high = AGE_BANDS[key]
+            age = self.patients['AGE'].to_numpy(dtype=np.float64)
+            return (age >= low) & (age < high if high is not None else True)
+        mask = np.zeros(self.n, dtype=bool)
+        ids = self._condition_ids[self._conditions.rows([key])]
+        mask[ids[ids >= 0]] = True
+        return mask
+
+    def everyone(self):
+        return Cohort.everyone(self.n)
+
+    def parse(self, expression):
+        # gender:F AND (age:65+ OR condition:"Diabetes mellitus type 2 (disorder)") AND NOT state:Texas
+        tokens = _tokenize(expression)
+        cohort, position = self._or(tokens, 0)
+        if position != len(tokens):
+            raise CohortError(f"Unexpected '{tokens[position][1]}' in cohort expression")
+        return cohort
+
+    def _or(self, tokens, position):
+        cohort, position = self._and(tokens, position)
+        while position < len(tokens) and tokens[position] == ('word', 'OR'):
+            other, position = self._and(tokens, position + 1)
+            cohort = cohort | other
+        return cohort, position
+
+    def _and(self, tokens, position):
+        cohort, position = self._not(tokens, position)
+        while position < len(tokens) and tokens[position] == ('word', 'AND'):
+            other, position = self._not(tokens, position + 1)
+            cohort = cohort & other
+        return cohort, position
+
+    def _not(self, tokens, position):
+        if position >= len(tokens):
+            raise CohortError("Incomplete cohort expression")
+        kind, text = tokens[position]
+        if (kind, text) == ('word', 'NOT'):
+            cohort, position = self._not(tokens, position + 1)
+            return ~cohort, position
+        if kind == '(':
+            cohort, position = self._or(tokens, position + 1)
+            if position >= len(tokens) or tokens[position][0] != ')':
+                raise CohortError("Unbalanced parentheses in cohort expression")
+            return cohort, position + 1
+        if kind == 'term':
+            attribute, value = text
+            return self.bitmap(attribute, value), position + 1
+        raise CohortError(f"Unexpected '{text}' in cohort expression")
+
+
+def _tokenize(expression):
+    # -> [(kind, text)] with kinds '(', ')', 'word' (AND / OR / NOT) and 'term' ((attribute, value))
+    tokens, position = [], 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if not match or match.end() == position:
+            raise CohortError(f"Cannot parse cohort expression at '{expression[position:]}'")
+        position = match.end()
+        opening, closing, quoted, word = match.groups()
+        if opening or closing:
+            tokens.append((opening or closing, opening or closing))
+        elif word and word.upper() in ('AND', 'OR', 'NOT'):
+            tokens.append(('word', word.upper()))
+        elif word and word.endswith(':') and quoted is None:
+            # attribute:"quoted value" arrives as two matches
+            value = _TOKEN.match(expression, position)
+            if not value or value.group(3) is None:
+                raise CohortError(f"Missing value for '{word}'")
+            position = value.end()
+            tokens.append(('term', (word[:-1].lower(), value.group(3).replace('\\"', '"'))))
+        elif word and ':' in word:
+            attribute, value = word.split(':', 1)
+            tokens.append(('term', (attribute.lower(), value)))
+        else:
+            raise CohortError(f"Expected attribute:value, got '{word if word else quoted}'")
+    return tokens
+
+
+class RowIndex:
+    # Rows of a table grouped by an integer key (patient id, description code, ...)
+    def __init__(self, keys, n_keys):
+        keys = np.asarray(keys)
+        valid = keys >= 0
+        self.order = np.flatnonzero(valid)[np.argsort(keys[valid], kind='stable')]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(keys[valid], minlength=n_keys))])
+
+    def rows(self, keys):
+        # Sorted row positions of every row whose key is in `keys`
+        keys = np.asarray(keys, dtype=np.int64)
+        starts, stops = self.offsets[keys], self.offsets[keys + 1]
+        lengths = stops - starts
+        total = int(lengths.sum())
+        if not total:
+            return np.zeros(0, dtype=np.int64)
+        # Concatenate the [start, stop) ranges without a Python loop
+        shifts = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return np.sort(self.order[np.arange(total) + shifts])
@@ -0,0 +1,165 @@
+import copy
+
+import numpy as np
+import pandas as pd
+
+from sketches import hll_estimate, hll_merge, hll_registers
+from snapshot import alphabetical
+
+# Pre-aggregated cube: one row per observed combination of the dimension values with
+# the row count and the sum of each measure, plus HyperLogLog registers for distinct
+# counts on a (usually coarser) set of sketch dimensions.
+#
+# Queries filter and group the cell table, whose size is bounded by the number of
+# distinct dimension combinations rather than by the number of source rows. Adding a
+# slice dimension is one more entry in `dims`.
+
+
+def _factorize(values):
+    # -> (non-negative codes, cardinality, decoder from codes back to values)
+    if isinstance(values, (pd.Categorical, pd.Series)) and isinstance(values.dtype, pd.CategoricalDtype):
+        dtype = values.dtype
+        codes = np.asarray(values.codes if isinstance(values, pd.Categorical) else values.cat.codes, dtype=np.int64) + 1
+        return codes, len(dtype.categories) + 1, lambda c: pd.Categorical.from_codes(c - 1, dtype=dtype)
+    uniques, codes = np.unique(np.asarray(values), return_inverse=True)
+    return codes.astype(np.int64), len(uniques), lambda c: uniques[c]
+
+
+def _cells(dims, n_rows):
+    # Collapse the dimension values of every row into a dense cell id
+    factors = [_factorize(values) for values in dims.values()]
+    combined = np.zeros(n_rows, dtype=np.int64)
+    for codes, cardinality, _ in factors:
+        combined = combined * cardinality + codes
+    unique, cell_of_row = np.unique(combined, return_inverse=True)
+    columns = {}
+    rest = unique
+    for name, (_, cardinality, decode) in reversed(list(zip(dims, factors))):
+        columns[name] = decode(rest % cardinality)
+        rest = rest // cardinality
+    cells = pd.DataFrame({name: columns[name] for name in dims})
+    return cells, cell_of_row
+
+
+def _filter(cells, filters):
+    mask = np.ones(len(cells), dtype=bool)
+    for name, value in (filters or {}).items():
+        if value is None or value == 'All':
+            continue
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        mask &= cells[name].isin(list(values)).to_numpy()
+    return mask
+
+
+def _keys(cells, by):
+    # Group keys, categorical dimensions in alphabetical (not vocabulary code) order
+    return [alphabetical(cells[name]) if isinstance(cells[name].dtype, pd.CategoricalDtype) else cells[name] for name in by]
+
+
+def _concat_cells(first, second):
+    # Stack two cell tables, recoding categorical columns of `first` to `second`'s dtype
+    first = first.copy()
+    for name in first.columns:
+        dtype = second[name].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            codes = dtype.categories.get_indexer(first[name].cat.categories)[first[name].cat.codes.to_numpy()]
+            first[name] = pd.Categorical.from_codes(np.where(first[name].cat.codes.to_numpy() >= 0, codes, -1), dtype=dtype)
+    return pd.concat([first, second], ignore_index=True)
+
+
+class Cube:
+    def __init__(self, dims, measures, sketch_dims=(), sketch_keys=None, sketch_universe=None):
+        # dims: {name: array/Categorical per row}; measures: {name: float array per row}
+        # sketch_keys: integer key per row (negative = unknown) counted by distinct();
+        # estimates never exceed sketch_universe (e.g. the number of patients)
+        n_rows = len(next(iter(dims.values())))
+        self.dims = list(dims)
+        self.measures = list(measures)
+        self.cells, cell_of_row = _cells(dims, n_rows)
+        n_cells = len(self.cells)
+        self.cells['count'] = np.bincount(cell_of_row, minlength=n_cells)
+        for name, values in measures.items():
+            weights = np.nan_to_num(np.asarray(values, dtype=np.float64))
+            self.cells[name] = np.bincount(cell_of_row, weights=weights, minlength=n_cells)
+
+        self.sketch_dims = list(sketch_dims)
+        self.sketch_cells = None
+        if self.sketch_dims:
+            self.sketch_cells, sketch_of_row = _cells({name: dims[name] for name in self.sketch_dims}, n_rows)
+            keys = np.asarray(sketch_keys)
+            known = keys >= 0
+            self.registers = hll_registers(sketch_of_row[known], keys[known], len(self.sketch_cells))
+            self.sketch_rows = np.bincount(sketch_of_row[known], minlength=len(self.sketch_cells))
+            self.sketch_universe = sketch_universe
+
+    def __len__(self):
+        return len(self.cells)
+
+    def merged(self, other):
+        # Cube over the rows of both cubes (e.g. a snapshot and an ingested batch). Counts and
+        # sums add up and sketches merge, so no source row is read again. Categorical cells
+        # take `other`'s dtype, whose categories extend this cube's.
+        merged = Cube.__new__(Cube)
+        merged.dims, merged.measures = self.dims, self.measures
+        merged.sketch_universe = getattr(other, 'sketch_universe', None)
+        cells = _concat_cells(self.cells, other.cells)
+        merged.cells = cells.groupby(self.dims, observed=True, dropna=False, sort=True).sum().reset_index()
+        merged.sketch_dims = self.sketch_dims
+        merged.sketch_cells = None
+        if self.sketch_dims:
+            sketch_cells = _concat_cells(self.sketch_cells, other.sketch_cells)
+            grouped = sketch_cells.groupby(self.sketch_dims, observed=True, dropna=False, sort=True)
+            groups = grouped.ngroup().to_numpy()
+            merged.sketch_cells = grouped.size().reset_index()[self.sketch_dims]
+            merged.registers = hll_merge(np.concatenate([self.registers, other.registers]), groups, len(merged.sketch_cells))
+            merged.sketch_rows = np.bincount(groups, weights=np.concatenate([self.sketch_rows, other.sketch_rows]),
+                                             minlength=len(merged.sketch_cells)).astype(np.int64)
+        return merged
+
+    def where(self, filters):
+        # Cube over just the cells matching `filters`, so several queries on the same slice
+        # filter once. distinct() stays available when every filter is a sketch dimension.
+        sliced = copy.copy(self)
+        sliced.cells = self.cells[_filter(self.cells, filters)].reset_index(drop=True)
+        if self.sketch_dims:
+            active = {name for name, value in filters.items() if value is not None and value != 'All'}
+            if active <= set(self.sketch_dims):
+                mask = _filter(self.sketch_cells, filters)
+                sliced.sketch_cells = self.sketch_cells[mask].reset_index(drop=True)
+                sliced.registers, sliced.sketch_rows = self.registers[mask], self.sketch_rows[mask]
+            else:
+                sliced.sketch_dims, sliced.sketch_cells = [], None
+        return sliced
+
+    def rollup(self, filters=None, by=()):
+        # Count and measure sums of the cells matching `filters`, grouped by `by`
+        cells = self.cells[_filter(self.cells, filters)]
+        columns = ['count'] + self.measures
+        if not by:
+            return cells[columns].sum()
+        return cells.groupby(_keys(cells, by), observed=True)[columns].sum()
+
+    def distinct(self, filters=None, by=()):
+        # Approximate distinct sketch keys of the matching sketch cells, grouped by `by`
+        if not set(filters or {}) <= set(self.sketch_dims) or not set(by) <= set(self.sketch_dims):
+            raise ValueError(f"distinct() can only filter and group on {self.sketch_dims}")
+        mask = _filter(self.sketch_cells, filters)
+        cells = self.sketch_cells[mask]
+        registers = self.registers[mask]
+        rows = self.sketch_rows[mask]
+        if not by:
+            estimate = hll_estimate(registers.max(axis=0, initial=0))
+            return int(self._clamp(estimate, rows.sum())[0])
+        grouped = cells.groupby(_keys(cells, by), observed=True, sort=True)
+        groups = grouped.ngroup().to_numpy()
+        index = grouped.size().index
+        merged = hll_merge(registers, groups, len(index))
+        estimate = self._clamp(hll_estimate(merged), np.bincount(groups, weights=rows, minlength=len(index)))
+        return pd.Series(estimate, index=index)
+
+    def _clamp(self, estimate, rows):
+        # A distinct count is bounded by the rows counted and by the key universe
+        bound = np.asarray(rows, dtype=np.int64)
+        if self.sketch_universe is not None:
+            bound = np.minimum(bound, self.sketch_universe)
+        return np.minimum(estimate, bound)
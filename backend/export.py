@@ -0,0 +1,297 @@
+import base64
+import csv
+import io
+import json
+from json.encoder import encode_basestring_ascii as escape
+
+import numpy as np
+import pandas as pd
+
+from chunked import NAT, ChunkedTable
+from snapshot import TABLES, UTC
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow IPC exports are then unavailable
+    pa = None
+
+# Streaming exports of snapshot tables and report results.
+#
+# An export is a generator of encoded byte chunks. Rows are read a chunk at a time with
+# ChunkedTable (just the projected and filtered columns, straight from the .npy files, so
+# nothing is mapped or cached), filtered with vectorized masks over category codes, date
+# nanoseconds and patient ids, and each chunk is encoded column by column: dates formatted
+# with one numpy call, text escaped once per category the chunk uses, numbers in their
+# shortest round-trip form, missing values -> empty CSV field / JSON null by mask; or the
+# chunk becomes one Arrow record batch. Memory stays at one chunk whatever the export size,
+# and the first bytes go out after the first chunk.
+#
+# A page is a range of table rows. Its cursor holds the snapshot version and the row to
+# continue from, so paging through a table reads one consistent version even when a batch
+# is ingested meanwhile (as long as that version is kept, see PHI_SNAPSHOT_KEEP).
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+DEFAULT_EXPORT_CHUNK_ROWS = 20_000
+
+
+class ExportError(ValueError):
+    pass
+
+
+def formats():
+    return [name for name in FORMATS if name != 'arrow' or pa is not None]
+
+
+def check_format(name):
+    if name not in FORMATS:
+        raise ExportError(f"Unknown format '{name}', expected one of {list(FORMATS)}")
+    if name == 'arrow' and pa is None:
+        raise ExportError("Arrow IPC exports need pyarrow, which is not installed")
+    return name
+
+
+def encode_cursor(version, table, row):
+    raw = json.dumps({'v': version, 't': table, 'r': int(row)}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, table):
+    # -> (snapshot version, first row) of a page of `table`
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        version, cursor_table, row = str(data['v']), data['t'], int(data['r'])
+    except (ValueError, TypeError, KeyError):
+        raise ExportError("Invalid cursor")
+    if cursor_table != table or row < 0:
+        raise ExportError("Cursor is from another export; restart paging")
+    return version, row
+
+
+def iso_dates(ns):
+    # int64 nanoseconds -> ISO strings as the JSON endpoints write them, None where missing
+    text = np.char.add(np.datetime_as_string(ns.view('M8[ns]'), unit='s'), 'Z').astype(object)
+    text[ns == NAT] = None
+    return text
+
+
+class TableExport:
+    def __init__(self, snapshot, table, fields=None, where=None, start=None, end=None, members=None,
+                 chunk_rows=DEFAULT_EXPORT_CHUNK_ROWS):
+        # where: {text column: [values]}; start / end: UTC Timestamps bounding the table's
+        # first date column (inclusive); members: bool mask over patient ids (e.g. a cohort)
+        if table not in snapshot.meta['tables']:
+            raise ExportError(f"Unknown table '{table}', expected one of {snapshot.table_names}")
+        self.table = ChunkedTable(snapshot, table)
+        self.kinds = {name: column['kind'] for name, column in self.table.columns.items()}
+        self.fields = fields or list(self.kinds)
+        unknown = [f for f in self.fields if f not in self.kinds]
+        if unknown:
+            raise ExportError(f"Unknown fields {unknown}")
+        self.chunk_rows = max(1, int(chunk_rows))
+        self._categories = {}
+
+        self._wanted = {}
+        for column, values in (where or {}).items():
+            if self.kinds.get(column) != 'category':
+                raise ExportError(f"Cannot filter on '{column}': not a text column of {table}")
+            categories = self._category_values(column)
+            self._wanted[column] = np.flatnonzero(np.isin(categories, [v for v in values if v]))
+
+        self._window = None
+        if start is not None or end is not None:
+            dates = TABLES.get(table, {}).get('dates')
+            if not dates:
+                raise ExportError(f"{table} has no date column to filter on")
+            self._window = (dates[0], NAT + 1 if start is None else start.value, np.iinfo(np.int64).max if end is None else end.value)
+
+        self._members = None
+        if members is not None:
+            if table != 'patients' and 'patient_key' not in snapshot.meta['tables'][table]:
+                raise ExportError(f"{table} has no patient key to filter a cohort on")
+            self._members = np.asarray(members, dtype=bool)
+
+    @property
+    def rows(self):
+        return len(self.table)
+
+    @property
+    def filtered(self):
+        return bool(self._wanted) or self._window is not None or self._members is not None
+
+    def _category_values(self, column):
+        values = self._categories.get(column)
+        if values is None:
+            values = self._categories[column] = np.asarray(self.table.categories(column))
+        return values
+
+    def _mask(self, start, stop):
+        # Rows of [start, stop) that pass the filters (None: all of them)
+        keep = None
+        for column, codes in self._wanted.items():
+            keep = _and(keep, np.isin(self.table.read(column, start, stop), codes))
+        if self._window is not None:
+            column, low, high = self._window
+            ns = self.table.read(column, start, stop)
+            keep = _and(keep, (ns >= low) & (ns <= high))
+        if self._members is not None:
+            if self.table.table == 'patients':
+                ids = np.arange(start, min(stop, self.rows))
+            else:
+                ids = self.table.read('PATIENT_ID', start, stop)
+            known = (ids >= 0) & (ids < len(self._members))
+            keep = _and(keep, known & self._members[np.where(known, ids, 0)])
+        return keep
+
+    def _chunks(self, start, stop):
+        for first in range(start, stop, self.chunk_rows):
+            yield first, min(first + self.chunk_rows, stop)
+
+    def page_end(self, start, limit=None):
+        # Row after the limit-th matching row from `start` (the end of the table when fewer match)
+        if limit is None:
+            return self.rows
+        if not self.filtered:
+            return min(start + limit, self.rows)
+        for first, last in self._chunks(start, self.rows):
+            keep = self._mask(first, last)
+            matched = int(keep.sum())
+            if matched >= limit:
+                return first + int(np.flatnonzero(keep)[limit - 1]) + 1
+            limit -= matched
+        return self.rows
+
+    def frames(self, start, stop):
+        # DataFrames of the matching rows of [start, stop), one per chunk. Text columns are
+        # Categoricals over just the categories the chunk uses, so no full (e.g. per-row id)
+        # category array is ever materialized.
+        for first, last in self._chunks(start, stop):
+            keep = self._mask(first, last)
+            if keep is not None and not keep.any():
+                continue
+            data = {}
+            for name in self.fields:
+                values = self.table.read(name, first, last)
+                if keep is not None:
+                    values = values[keep]
+                kind = self.kinds[name]
+                if kind == 'category':
+                    used = np.unique(values[values >= 0])
+                    categories = pd.Index(self._category_values(name)[used], dtype=object)
+                    values = pd.Categorical.from_codes(np.where(values >= 0, np.searchsorted(used, values), -1), categories=categories)
+                elif kind == 'datetime':
+                    # NAT is numpy's NaT, so the nanoseconds are the datetimes as they are
+                    values = pd.arrays.DatetimeArray._simple_new(values.view('M8[ns]'), dtype=UTC)
+                data[name] = values
+            yield pd.DataFrame(data, copy=False)
+
+    def arrow_schema(self):
+        types = {'category': pa.string(), 'datetime': pa.timestamp('ns', tz='UTC')}
+        return pa.schema([(name, types.get(self.kinds[name]) or pa.from_numpy_dtype(self.table.dtype(name)))
+                          for name in self.fields])
+
+    def stream(self, fmt, start=0, stop=None):
+        stop = self.rows if stop is None else stop
+        return encode(self.frames(start, stop), fmt, self.fields, self.arrow_schema() if fmt == 'arrow' else None)
+
+
+def _and(mask, other):
+    return other if mask is None else mask & other
+
+
+def _is_datetime(dtype):
+    return isinstance(dtype, pd.DatetimeTZDtype) or dtype.kind == 'M'
+
+
+def _nanoseconds(series):
+    return series.array.asi8
+
+
+def json_values(series):
+    # JSON text of every value of a column, null where missing: numbers in their shortest
+    # round-trip form, text escaped once per category, dates as ISO strings
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        categories = np.array([escape(str(v)) for v in dtype.categories] + ['null'], dtype=object)
+        return categories[series.cat.codes.to_numpy()]
+    if _is_datetime(dtype):
+        text = iso_dates(_nanoseconds(series))
+        missing = pd.isna(text)
+        text[~missing] = '"' + text[~missing] + '"'
+        text[missing] = 'null'
+        return text
+    values = series.to_numpy()
+    if dtype.kind == 'f':
+        text = values.astype(str).astype(object)
+        text[~np.isfinite(values)] = 'null'
+        return text
+    if dtype.kind in 'iu':
+        return values.astype(str).astype(object)
+    if dtype.kind == 'b':
+        return np.where(values, 'true', 'false').astype(object)
+    return np.array(['null' if v is None or (isinstance(v, float) and np.isnan(v)) else json.dumps(v, default=str)
+                     for v in values], dtype=object)
+
+
+def ndjson(frame):
+    # One JSON object per row: a (rows x 2 * columns + 1) grid of key and value fragments,
+    # joined once
+    grid = np.empty((len(frame), 2 * len(frame.columns) + 1), dtype=object)
+    for i, name in enumerate(frame.columns):
+        grid[:, 2 * i] = ('{' if i == 0 else ',') + escape(str(name)) + ':'
+        grid[:, 2 * i + 1] = json_values(frame[name])
+    grid[:, -1] = '}\n' if len(frame.columns) else '{}\n'
+    return ''.join(grid.ravel().tolist())
+
+
+def csv_text(frame):
+    # Dates as ISO strings (one numpy call per column); pandas writes missing values as empty fields
+    dates = [name for name in frame.columns if _is_datetime(frame[name].dtype)]
+    if dates:
+        frame = frame.assign(**{name: iso_dates(_nanoseconds(frame[name])) for name in dates})
+    return frame.to_csv(header=False, index=False, lineterminator='\n')
+
+
+def encode(frames, fmt, columns, schema=None):
+    # Byte chunks of a CSV (with a header line), NDJSON or Arrow IPC stream of the frames
+    if fmt == 'arrow':
+        yield from encode_arrow(frames, schema)
+        return
+    if fmt == 'csv':
+        header = io.StringIO()
+        csv.writer(header, lineterminator='\n').writerow(columns)
+        yield header.getvalue().encode()
+    for frame in frames:
+        yield (csv_text(frame) if fmt == 'csv' else ndjson(frame)).encode()
+
+
+def encode_arrow(frames, schema=None):
+    # One record batch per frame; schema=None takes the first frame's
+    sink = io.BytesIO()
+    writer = None
+    for frame in frames:
+        # Text goes out as plain strings: chunk-local categories would change the schema per batch
+        text = [name for name in frame.columns if isinstance(frame[name].dtype, pd.CategoricalDtype)]
+        if text:
+            frame = frame.assign(**{name: frame[name].astype(object) for name in text})
+        batch = pa.RecordBatch.from_pandas(frame, schema=schema, preserve_index=False)
+        if writer is None:
+            writer = pa.ipc.new_stream(sink, batch.schema)
+        writer.write_batch(batch)
+        yield _drain(sink)
+    if writer is None:
+        if schema is None:
+            return
+        writer = pa.ipc.new_stream(sink, schema)
+    writer.close()
+    yield _drain(sink)
+
+
+def _drain(sink):
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
@@ -0,0 +1,173 @@
+import multiprocessing
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+# Forecasts of yearly series (condition counts, mean HbA1c) with confidence intervals.
+#
+# Fitting never happens on the request path: `Forecaster.get` returns the model fitted
+# for (series key, snapshot version) when there is one, and otherwise queues the fit in a
+# process pool and answers with the newest model of an older version (flagged stale), or
+# nothing yet. Models are kept per process in a bounded LRU; a refit for a new version
+# starts from the parameters of the previous fit of the same series (warm start).
+#
+# The pool uses the 'spawn' start method: the serving processes are multi-threaded, and
+# fit_series only needs numpy arrays. A spawned worker imports this module plus the
+# parent's __main__ module, which is why the entry points (serve.py, gunicorn with
+# wsgi.py) keep theirs free of the app's setup.
+
+ARIMA_ORDER = (1, 1, 0)
+# Shorter series are fitted with a linear trend instead of ARIMA
+MIN_ARIMA_POINTS = 8
+MAX_MODELS = 2000
+
+
+def fit_series(years, values, horizon, alpha=0.05, start_params=None):
+    # -> {'model', 'params', 'forecast': [{year, value, lower, upper}]}; runs in a pool worker
+    years = np.asarray(years, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    future = np.arange(years[-1] + 1, years[-1] + 1 + horizon) if len(years) else np.arange(horizon)
+    if len(values) >= MIN_ARIMA_POINTS and np.ptp(values) > 0:
+        try:
+            return _fit_arima(values, future, alpha, start_params)
+        except (ValueError, np.linalg.LinAlgError):
+            pass
+    return _fit_linear(years, values, future, alpha)
+
+
+def _fit_arima(values, future, alpha, start_params):
+    from statsmodels.tsa.arima.model import ARIMA
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        model = ARIMA(values, order=ARIMA_ORDER, trend='t')
+        if start_params is not None and len(start_params) != len(model.start_params):
+            start_params = None
+        result = model.fit(start_params=start_params)
+        forecast = result.get_forecast(len(future))
+        mean, bounds = forecast.predicted_mean, forecast.conf_int(alpha=alpha)
+    return {
+        'model': f'arima{ARIMA_ORDER}',
+        'params': [float(p) for p in result.params],
+        'forecast': _points(future, mean, bounds[:, 0], bounds[:, 1]),
+    }
+
+
+def _fit_linear(years, values, future, alpha):
+    from scipy import stats
+    from sklearn.linear_model import LinearRegression
+
+    if len(values) < 2:
+        level = float(values[-1]) if len(values) else 0.0
+        flat = np.full(len(future), level)
+        return {'model': 'constant', 'params': [level], 'forecast': _points(future, flat, flat, flat)}
+    x = years.reshape(-1, 1).astype(np.float64)
+    model = LinearRegression().fit(x, values)
+    residuals = values - model.predict(x)
+    dof = max(len(values) - 2, 1)
+    sigma = np.sqrt((residuals ** 2).sum() / dof)
+    # Prediction interval of an ordinary least squares line
+    spread = np.sqrt(1 + 1 / len(values) + (future - x.mean()) ** 2 / ((x - x.mean()) ** 2).sum())
+    margin = stats.t.ppf(1 - alpha / 2, dof) * sigma * spread
+    mean = model.predict(future.reshape(-1, 1).astype(np.float64))
+    return {
+        'model': 'linear',
+        'params': [float(model.intercept_), float(model.coef_[0])],
+        'forecast': _points(future, mean, mean - margin, mean + margin),
+    }
+
+
+def _points(future, mean, lower, upper):
+    return [{'year': int(y), 'value': round(float(m), 3), 'lower': round(float(lo), 3), 'upper': round(float(hi), 3)}
+            for y, m, lo, hi in zip(future, mean, lower, upper)]
+
+
+class Forecaster:
+    def __init__(self, workers=None, max_models=MAX_MODELS):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.max_models = max_models
+        self._models = OrderedDict()    # (series, version, horizon, alpha) -> fitted model
+        self._latest = {}               # (series, horizon, alpha) -> (version, model): stale answers, warm starts
+        self._pending = {}              # (series, version, horizon, alpha) -> Future
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def _executor(self):
+        # One pool per process; a pool inherited through fork() is unusable
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            self._pid = os.getpid()
+        return self._pool
+
+    def close(self):
+        # Shut the pool down (e.g. before a pre-fork server forks its workers)
+        with self._lock:
+            pool, self._pool, self._pending = self._pool, None, {}
+        if pool is not None and self._pid == os.getpid():
+            pool.shutdown(wait=True)
+
+    def get(self, series, version, years, values, horizon, alpha=0.05):
+        # -> (model or None, stale); schedules a fit when this version has none yet
+        key = (series, version, horizon, alpha)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                return model, False
+            latest = self._latest.get((series, horizon, alpha))
+        self.submit(series, version, years, values, horizon, alpha)
+        return (latest[1], True) if latest is not None else (None, False)
+
+    def submit(self, series, version, years, values, horizon, alpha=0.05):
+        key = (series, version, horizon, alpha)
+        with self._lock:
+            if key in self._models or key in self._pending:
+                return self._pending.get(key)
+            latest = self._latest.get((series, horizon, alpha))
+            start_params = latest[1]['params'] if latest is not None else None
+            try:
+                future = self._executor().submit(fit_series, years, values, horizon, alpha, start_params)
+            except BrokenProcessPool:
+                # A worker died (killed, out of memory): start a fresh pool
+                self._pool = None
+                future = self._executor().submit(fit_series, years, values, horizon, alpha, start_params)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._store(key, f))
+        return future
+
+    def _store(self, key, future):
+        series, version, horizon, alpha = key
+        with self._lock:
+            if self._pending.get(key) is not future:
+                return
+            del self._pending[key]
+            if future.cancelled() or future.exception() is not None:
+                return
+            model = dict(future.result(), version=version)
+            self._models[key] = model
+            self._latest[(series, horizon, alpha)] = (version, model)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+
+    def refresh(self, jobs, timeout=None):
+        # Fit many series in parallel and wait; jobs: [(series, version, years, values, horizon)]
+        submitted = [((series, version, horizon, 0.05), self.submit(series, version, years, values, horizon))
+                     for series, version, years, values, horizon in jobs]
+        submitted = [(key, future) for key, future in submitted if future is not None]
+        for key, future in submitted:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+            self._store(key, future)
+        return len(submitted)
+
+    def stats(self):
+        with self._lock:
+            return {'models': len(self._models), 'pending': len(self._pending), 'workers': self.workers}
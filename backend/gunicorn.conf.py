@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# gunicorn -c gunicorn.conf.py wsgi:application
+#
+# Workers are processes forked from a preloaded master (see wsgi.py); each runs a few
+# threads, which is enough because request handlers spend most of their time in numpy
+# and pandas code that releases the GIL or in I/O. Memory per extra worker is its
+# private heap only: the column data is shared through the mapped snapshot files.
+
+bind = os.environ.get('PHI_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('PHI_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('PHI_THREADS', 4))
+preload_app = True
+
+# Long report / trend computations on a cold cache
+timeout = int(os.environ.get('PHI_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then to bound heap growth; replacements fork from the
+# preloaded master, so they start with the shared data already in place
+max_requests = int(os.environ.get('PHI_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+
+# Heartbeat files on tmpfs so a slow disk cannot stall workers
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+accesslog = os.environ.get('PHI_ACCESS_LOG', '-')
+
+# Request metrics of all workers are merged from one directory per server (see metrics.py);
+# it only lives as long as the master
+if not os.environ.get('PHI_METRICS_DIR'):
+    shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    os.environ['PHI_METRICS_DIR'] = os.path.join(shm, f'phi-metrics-{os.getpid()}')
+    _metrics_dir = os.environ['PHI_METRICS_DIR']
+
+    def on_exit(server):
+        shutil.rmtree(_metrics_dir, ignore_errors=True)
@@ -0,0 +1,406 @@
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from snapshot import (META_FILE, PATIENT_ID_FILE, VOCAB_DIR, Snapshot, code_dtype, current_version, map_rows, npy_layout,
+                      publish_version)
+
+# Incremental ingestion of new Synthea rows into the published snapshot.
+#
+# A batch is a directory of cleaned_<table>.csv (or <table>.csv) files holding new rows.
+# `ingest_batch` writes a new snapshot version next to the current one:
+#
+#   - tables without new rows are hard-linked (no copy, and the page cache is shared),
+#   - the columns of tables with new rows are hard-linked too and the rows appended to the
+#     file, so a batch costs its own size, not the table's. The parent's readers map only
+#     their own rows (row counts come from meta.json, see snapshot.py); columns whose rows
+#     change in place (patient upserts, earlier rows linked to new patients) or whose
+#     dtype must widen are rewritten instead,
+#   - new text values are appended to the end of the categories, so the codes of existing
+#     rows never change,
+#   - patients are upserted by Id: known Ids are updated in place and keep their dense
+#     patient id, unknown Ids are appended, and rows of earlier batches that reference
+#     them (patient id -1 until now) are linked to them,
+#
+# and then atomically repoints CURRENT. The new meta.json records the parent version, the
+# row count of every table before the batch (`appended`) and the tables whose earlier
+# rows were linked to new patients (`relinked`), which lets a running server
+# extend its derived structures (cubes, per-patient aggregates, ...) with just the new rows
+# instead of rebuilding them (see carry_over in app.py).
+
+INGEST_LOCK = '.ingest.lock'
+APPLIED_DIR = 'applied'
+FAILED_DIR = 'failed'
+
+
+class IngestError(ValueError):
+    pass
+
+
+def read_batch(batch_dir, column_kinds):
+    # -> {table: DataFrame}; text columns are read as strings so they match the snapshot categories
+    batch = {}
+    for table, kinds in column_kinds.items():
+        for name in (f'cleaned_{table}.csv', f'{table}.csv'):
+            path = os.path.join(batch_dir, name)
+            if os.path.exists(path):
+                text_columns = {c: str for c, kind in kinds.items() if kind == 'category'}
+                df = pd.read_csv(path, dtype=text_columns, low_memory=False)
+                unknown = set(df.columns) - set(kinds)
+                if unknown:
+                    raise IngestError(f"{name}: unknown columns {sorted(unknown)}")
+                if len(df):
+                    batch[table] = df
+                break
+    return batch
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _encode(values, kind):
+    # New values of one column in the on-disk representation of its kind
+    if kind == 'datetime':
+        return pd.to_datetime(values, utc=True, errors='coerce').array.asi8
+    if kind == 'numeric':
+        return pd.to_numeric(values, errors='coerce').to_numpy()
+    return values
+
+
+class _Writer:
+    # Builds the staging directory of the new version from the parent snapshot
+    def __init__(self, parent, staging):
+        self.parent = parent
+        self.staging = staging
+        self.meta = json.loads(json.dumps(parent.meta))
+        self.vocabularies = {}
+        self.grown = {}  # path -> size before rows were appended to it
+
+    def load(self, table, filename):
+        # The parent's rows of a column, mapped rather than read
+        return map_rows(os.path.join(self.parent.path, table, filename), self.parent.meta['tables'][table]['rows'])
+
+    def save(self, table, filename, array):
+        path = os.path.join(self.staging, table, filename)
+        self.drop(path)
+        np.save(path, np.ascontiguousarray(array))
+
+    def drop(self, path):
+        # Remove a staged file; one that is a hard link into the parent version loses its appended rows first
+        if path in self.grown:
+            os.truncate(path, self.grown.pop(path))
+        if os.path.exists(path):
+            os.remove(path)
+
+    def rollback(self):
+        # Take the appended rows off the parent's files again (a failed build)
+        for path, size in self.grown.items():
+            os.truncate(path, size)
+        self.grown = {}
+
+    def vocabulary(self, name):
+        if name not in self.vocabularies:
+            self.vocabularies[name] = list(np.load(os.path.join(self.parent.path, VOCAB_DIR, f'{name}.categories.npy')))
+        return self.vocabularies[name]
+
+    def extend(self, categories, values):
+        # Codes of `values` against `categories`, appending unseen values in place
+        values = pd.Series(values, dtype=object)
+        present = values.notna()
+        index = pd.Index(categories)
+        new = pd.unique(values[present & (index.get_indexer(values.where(present, '')) < 0)])
+        categories.extend(str(v) for v in new)
+        codes = pd.Index(categories).get_indexer(values.where(present, None))
+        return np.where(present.to_numpy(), codes, -1)
+
+    def append(self, table, filename, new, dtype=None):
+        # The parent's column + `new` rows. The parent's file is hard-linked and the rows are
+        # appended to it, so the cost follows the batch rather than the table (the parent's
+        # readers map only their own rows). Values the stored dtype cannot hold, or a file
+        # that already has rows past the parent's (a newer version's: CURRENT was moved back),
+        # mean a rewrite, as `dtype` (when given) widened to hold the stored values.
+        src, dst = os.path.join(self.parent.path, table, filename), os.path.join(self.staging, table, filename)
+        wanted, (dtype, _, offset) = dtype, npy_layout(src)
+        end = offset + self.parent.meta['tables'][table]['rows'] * dtype.itemsize
+        new = np.asarray(new)
+        if _fits(new, dtype):
+            self.drop(dst)
+            _link_or_copy(src, dst)
+            if os.path.getsize(dst) == end:
+                self.grown[dst] = end
+                with open(dst, 'ab') as f:
+                    f.write(np.ascontiguousarray(new, dtype=dtype).tobytes())
+                return
+        self.rewrite(table, filename, new, np.result_type(dtype, new.dtype if wanted is None else wanted))
+
+    def rewrite(self, table, filename, new, dtype, replace_rows=None, replace_values=None):
+        # The parent's column + `new` rows as a new file (reads the whole column): for widened
+        # dtypes and for rows updated in place, which must not show through to the parent
+        values = np.concatenate([self.load(table, filename).astype(dtype), np.asarray(new).astype(dtype)])
+        if replace_rows is not None:
+            values[replace_rows] = np.asarray(replace_values).astype(dtype)
+        self.save(table, filename, values)
+
+    def column(self, table, column, new_values, replace_rows=None, replace_values=None):
+        # Write one column as the parent's rows (updated at replace_rows) + the new rows
+        name, kind = column['name'], column['kind']
+        replaced = None
+        if kind == 'category':
+            shared = 'vocabulary' in column
+            categories = self.vocabulary(column['vocabulary']) if shared else list(np.load(
+                os.path.join(self.parent.path, table, f'{name}.categories.npy')))
+            filename, new = f'{name}.codes.npy', self.extend(categories, new_values)
+            if replace_rows is not None:
+                replaced = self.extend(categories, replace_values)
+            if not shared:
+                self.save(table, f'{name}.categories.npy', np.asarray(categories, dtype=str))
+            # Shared-vocabulary codes are widened in finish(), once the vocabulary is complete
+            dtype = code_dtype(len(categories))
+        else:
+            filename, new = f'{name}.values.npy', _encode(new_values, kind)
+            if replace_rows is not None:
+                replaced = _encode(replace_values, kind)
+            dtype = new.dtype if kind == 'numeric' else np.int64
+        if replace_rows is None:
+            self.append(table, filename, new, dtype)
+        else:
+            stored = npy_layout(os.path.join(self.parent.path, table, filename))[0]
+            self.rewrite(table, filename, new, np.result_type(stored, dtype, replaced.dtype), replace_rows, replaced)
+
+    def link_table(self, table):
+        os.makedirs(os.path.join(self.staging, table), exist_ok=True)
+        for filename in os.listdir(os.path.join(self.parent.path, table)):
+            _link_or_copy(os.path.join(self.parent.path, table, filename), os.path.join(self.staging, table, filename))
+
+    def append_table(self, table, df, replace_rows=None, replace_df=None):
+        os.makedirs(os.path.join(self.staging, table), exist_ok=True)
+        info = self.meta['tables'][table]
+        for column in info['columns']:
+            name = column['name']
+            new_values = df[name] if name in df else pd.Series([None] * len(df), dtype=object)
+            replace_values = None
+            if replace_df is not None:
+                replace_values = replace_df[name] if name in replace_df else pd.Series([None] * len(replace_df), dtype=object)
+            self.column(table, column, new_values, replace_rows, replace_values)
+        info['rows'] += len(df)
+
+    def finish(self):
+        # Write the grown shared vocabularies and give every table's codes the matching width
+        os.makedirs(os.path.join(self.staging, VOCAB_DIR), exist_ok=True)
+        for filename in os.listdir(os.path.join(self.parent.path, VOCAB_DIR)):
+            name = filename.split('.')[0]
+            target = os.path.join(self.staging, VOCAB_DIR, filename)
+            if name not in self.vocabularies:
+                _link_or_copy(os.path.join(self.parent.path, VOCAB_DIR, filename), target)
+                continue
+            vocab = self.vocabularies[name]
+            np.save(target, np.asarray(vocab, dtype=str))
+            dtype = code_dtype(len(vocab))
+            for table, info in self.meta['tables'].items():
+                if any(c.get('vocabulary') == name for c in info['columns']):
+                    path = os.path.join(self.staging, table, f'{name}.codes.npy')
+                    if npy_layout(path)[0] != dtype:
+                        codes = np.array(map_rows(path, info['rows']), dtype=dtype)
+                        self.save(table, f'{name}.codes.npy', codes)
+
+
+def _fits(values, dtype):
+    # Whether values can be stored as dtype without loss
+    if not len(values) or np.can_cast(values.dtype, dtype, 'safe'):
+        return True
+    if values.dtype.kind in 'iu' and dtype.kind in 'iu':
+        return np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max
+    return False
+
+
+def _patient_ids(writer, batch_tables, new_patients):
+    # Dense patient ids of the appended rows (existing rows keep theirs). When the batch adds
+    # patients, rows ingested earlier for them (id -1 so far; `unlinked` counts them) are
+    # linked too, as a full rebuild would; -> {table: rows linked that way}
+    staging, parent = writer.staging, writer.parent
+    id_categories = np.load(os.path.join(staging, 'patients', 'Id.categories.npy'))
+    id_codes = map_rows(os.path.join(staging, 'patients', 'Id.codes.npy'), writer.meta['tables']['patients']['rows'])
+    position = np.full(len(id_categories), -1, dtype=np.int32)
+    position[id_codes[id_codes >= 0]] = np.flatnonzero(id_codes >= 0)
+    relinked = {}
+    for table, info in writer.meta['tables'].items():
+        key = info.get('patient_key')
+        # Snapshots from before `unlinked` was recorded are scanned
+        unlinked = parent.meta['tables'][table].get('unlinked')
+        relink = new_patients and unlinked != 0
+        if key is None or (table not in batch_tables and not relink):
+            continue
+        old_rows = parent.meta['tables'][table]['rows']
+        codes = map_rows(os.path.join(staging, table, f'{key}.codes.npy'), info['rows'])
+        key_categories = np.load(os.path.join(staging, table, f'{key}.categories.npy'))
+        lookup = pd.Index(id_categories).get_indexer(key_categories)
+        lookup = np.where(lookup >= 0, position[np.maximum(lookup, 0)], -1)
+        resolve = lambda rows: np.where(codes[rows] >= 0, lookup[np.maximum(codes[rows], 0)], -1).astype(np.int32)
+        new_ids = resolve(np.arange(old_rows, info['rows']))
+        if relink:
+            ids = writer.load(table, PATIENT_ID_FILE)
+            missing = np.flatnonzero(ids < 0)
+            linked = resolve(missing)
+            unlinked = int((linked < 0).sum())
+            if (linked >= 0).any():
+                # Earlier rows change: the file is rewritten rather than shared with the parent
+                ids = np.array(ids)
+                ids[missing] = linked
+                relinked[table] = int((linked >= 0).sum())
+                writer.save(table, PATIENT_ID_FILE, np.concatenate([ids, new_ids]))
+        if table in batch_tables and table not in relinked:
+            writer.append(table, PATIENT_ID_FILE, new_ids)
+        if unlinked is not None:
+            info['unlinked'] = unlinked + int((new_ids < 0).sum())
+    return relinked
+
+
+def _build_version(writer, batch, batch_dir, version, started):
+    # Write the new version into the writer's staging directory: the parent's files linked,
+    # the batch appended
+    parent, staging = writer.parent, writer.staging
+    updated_patients, new_patients = [], 0
+    for table in parent.meta['tables']:
+        df = batch.get(table)
+        if df is None:
+            writer.link_table(table)
+        elif table == 'patients':
+            # Upsert by Id: rows for known patients replace them in place and keep their id
+            df = df.drop_duplicates('Id', keep='last').reset_index(drop=True)
+            ids = parent.patients['Id']
+            codes = ids.cat.codes.to_numpy()
+            row_of_code = np.full(len(ids.cat.categories), -1)
+            row_of_code[codes[codes >= 0]] = np.flatnonzero(codes >= 0)
+            positions = ids.cat.categories.get_indexer(df['Id'])
+            rows = np.where(positions >= 0, row_of_code[np.maximum(positions, 0)], -1)
+            known = rows >= 0
+            writer.append_table('patients', df[~known].reset_index(drop=True),
+                                rows[known] if known.any() else None, df[known].reset_index(drop=True))
+            updated_patients, new_patients = rows[known].tolist(), int((~known).sum())
+        else:
+            writer.append_table(table, df)
+    writer.finish()
+    relinked = _patient_ids(writer, [t for t in batch if t != 'patients'], new_patients)
+
+    meta = writer.meta
+    meta.update({
+        'version': version,
+        'built_at': time.time(),
+        'parent': parent.version,
+        'appended': {t: parent.meta['tables'][t]['rows'] for t in batch},
+        'updated_patients': updated_patients,
+        'relinked': relinked,
+        'batch': {'path': os.path.abspath(batch_dir), 'rows': {t: len(df) for t, df in batch.items()},
+                  'seconds': round(time.perf_counter() - started, 3)},
+    })
+    with open(os.path.join(staging, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def ingest_batch(snapshot_dir, batch_dir):
+    # Apply one batch on top of the current version and publish the result; -> new version
+    parent = Snapshot(os.path.join(snapshot_dir, current_version(snapshot_dir)))
+    kinds = {t: {c['name']: c['kind'] for c in info['columns']} for t, info in parent.meta['tables'].items()}
+    batch = read_batch(batch_dir, kinds)
+    if not batch:
+        raise IngestError(f"No rows for known tables in {batch_dir}")
+
+    started = time.perf_counter()
+    digest = hashlib.sha1(json.dumps({t: len(df) for t, df in batch.items()}, sort_keys=True).encode()
+                          + parent.version.encode()).hexdigest()[:8]
+    version = f"{time.strftime('%Y%m%d%H%M%S')}-{digest}"
+    while os.path.exists(os.path.join(snapshot_dir, version)):
+        version += 'x'
+    staging = os.path.join(snapshot_dir, f'.{version}.tmp')
+    shutil.rmtree(staging, ignore_errors=True)
+    writer = _Writer(parent, staging)
+    try:
+        _build_version(writer, batch, batch_dir, version, started)
+    except BaseException:
+        # A failed batch leaves nothing behind (prune_versions skips dot directories), in
+        # the parent's files neither
+        writer.rollback()
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    os.replace(staging, os.path.join(snapshot_dir, version))
+    publish_version(snapshot_dir, version)
+    return version
+
+
+def pending_batches(drop_dir):
+    # Batch directories waiting in the drop directory (oldest first); loose CSVs form one batch
+    if not os.path.isdir(drop_dir):
+        return []
+    entries = sorted(os.scandir(drop_dir), key=lambda e: (e.stat().st_mtime, e.name))
+    batches = [e.path for e in entries if e.is_dir() and e.name not in (APPLIED_DIR, FAILED_DIR)]
+    if any(e.is_file() and e.name.endswith('.csv') for e in entries):
+        batches.append(drop_dir)
+    return batches
+
+
+def _archive(drop_dir, batch_dir, target):
+    os.makedirs(target, exist_ok=True)
+    if os.path.abspath(batch_dir) == os.path.abspath(drop_dir):
+        for name in os.listdir(drop_dir):
+            if name.endswith('.csv'):
+                os.replace(os.path.join(drop_dir, name), os.path.join(target, name))
+    else:
+        os.replace(batch_dir, os.path.join(target, os.path.basename(batch_dir)))
+
+
+def ingest_pending(snapshot_dir, drop_dir, keep_versions=3):
+    # Apply every pending batch in order under an exclusive lock; -> [{batch, version|error}]
+    results = []
+    with open(os.path.join(snapshot_dir, INGEST_LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for batch_dir in pending_batches(drop_dir):
+            stamp = time.strftime('%Y%m%d%H%M%S')
+            try:
+                version = ingest_batch(snapshot_dir, batch_dir)
+                _archive(drop_dir, batch_dir, os.path.join(drop_dir, APPLIED_DIR, version))
+                results.append({'batch': os.path.basename(batch_dir), 'version': version})
+            except (IngestError, ValueError, KeyError, OSError) as e:
+                _archive(drop_dir, batch_dir, os.path.join(drop_dir, FAILED_DIR, stamp))
+                results.append({'batch': os.path.basename(batch_dir), 'error': str(e)})
+        prune_versions(snapshot_dir, keep_versions)
+    return results
+
+
+def prune_versions(snapshot_dir, keep):
+    # Remove all but the newest `keep` versions; processes still mapping a removed
+    # version keep its pages until they switch
+    current = current_version(snapshot_dir)
+    versions = sorted(d for d in os.listdir(snapshot_dir)
+                      if not d.startswith('.') and os.path.exists(os.path.join(snapshot_dir, d, META_FILE)))
+    for version in versions[:-keep] if keep else []:
+        if version != current:
+            shutil.rmtree(os.path.join(snapshot_dir, version), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Apply new Synthea rows to the published snapshot')
+    parser.add_argument('batch', nargs='?', help='batch directory (default: every pending batch in --drop-dir)')
+    parser.add_argument('--drop-dir', default=os.environ.get('PHI_INGEST_DIR', os.path.join(here, 'incoming')))
+    parser.add_argument('--snapshot-dir', default=os.environ.get('PHI_SNAPSHOT_DIR', os.path.join(here, 'snapshot')))
+    parser.add_argument('--keep', type=int, default=int(os.environ.get('PHI_SNAPSHOT_KEEP', 3)))
+    args = parser.parse_args()
+
+    if args.batch:
+        with open(os.path.join(args.snapshot_dir, INGEST_LOCK), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            print(f"Published {ingest_batch(args.snapshot_dir, args.batch)}")
+    else:
+        for result in ingest_pending(args.snapshot_dir, args.drop_dir, args.keep):
+            print(result)
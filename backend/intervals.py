@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+
+# Interval index for "how many were active at T" / "how many overlap [a, b)" queries.
+#
+# Rows are grouped into keys (one per observed combination of the dimension columns,
+# e.g. DESCRIPTION x STATE). Start times, closed stop times and the start times of
+# still-open intervals are each kept in one sorted int64 array of
+# `key * SPAN + seconds`, so a count for every key is one vectorized searchsorted:
+#
+#   active at t      = #starts <= t          - #closed stops < t
+#   overlapping a..b = #starts <  b          - #closed stops < a
+#
+# which assumes STOP >= START (rows violating that are clamped when the index is built).
+
+# Times are stored as whole seconds since 1900-01-01; 2**34 seconds covers ~544 years
+EPOCH_OFFSET = 2_208_988_800
+SPAN = 2**34
+
+
+def to_seconds(values):
+    # Timestamp / datetime Series / int64 ns array -> seconds since 1900, clamped into [0, SPAN)
+    if isinstance(values, (pd.Timestamp, str)):
+        return int(np.clip(pd.Timestamp(values).value // 10**9 + EPOCH_OFFSET, 0, SPAN - 1))
+    ns = np.asarray(pd.DatetimeIndex(values).asi8 if not isinstance(values, np.ndarray) else values, dtype=np.int64)
+    return np.clip(ns // 10**9 + EPOCH_OFFSET, 0, SPAN - 1)
+
+
+class IntervalIndex:
+    def __init__(self, starts, stops, dims):
+        # starts/stops: datetime Series (STOP may be NaT = still open)
+        # dims: {name: categorical Series aligned with starts}
+        start_ns = pd.DatetimeIndex(starts).asi8
+        stop_ns = pd.DatetimeIndex(stops).asi8
+        valid = start_ns != np.iinfo(np.int64).min
+        open_ = valid & (stop_ns == np.iinfo(np.int64).min)
+        closed = valid & ~open_
+
+        # Collapse the dimension codes of each row into a dense key id
+        self.dim_names = list(dims)
+        self.categories = {name: pd.Index(pd.Categorical(col).categories) for name, col in dims.items()}
+        codes = [pd.Categorical(col).codes.astype(np.int64) for col in dims.values()]
+        combined = np.zeros(len(start_ns), dtype=np.int64)
+        for name, c in zip(self.dim_names, codes):
+            combined = combined * (len(self.categories[name]) + 1) + (c + 1)
+        unique, row_keys = np.unique(combined, return_inverse=True)
+        self.n_keys = len(unique)
+        self.key_codes = {}
+        rest = unique
+        for name in reversed(self.dim_names):
+            base = len(self.categories[name]) + 1
+            self.key_codes[name] = rest % base - 1
+            rest = rest // base
+
+        start_s = to_seconds(start_ns)
+        stop_s = np.maximum(to_seconds(stop_ns), start_s)
+        composite = row_keys.astype(np.int64) * SPAN
+        self._starts = np.sort(composite[valid] + start_s[valid])
+        self._stops = np.sort(composite[closed] + stop_s[closed])
+        self._open_starts = np.sort(composite[open_] + start_s[open_])
+        self._key_base = np.arange(self.n_keys, dtype=np.int64) * SPAN
+        self._offsets = {
+            'starts': np.searchsorted(self._starts, self._key_base),
+            'stops': np.searchsorted(self._stops, self._key_base),
+            'open_starts': np.searchsorted(self._open_starts, self._key_base),
+        }
+        self.min_time = pd.Timestamp(start_ns[valid].min(), tz='UTC') if valid.any() else None
+        self.max_time = pd.Timestamp(max(start_ns[valid].max(), stop_ns[closed].max(initial=0)), tz='UTC') if valid.any() else None
+
+    def __len__(self):
+        return len(self._starts)
+
+    def select(self, **filters):
+        # Boolean mask over keys; filter values of None / 'All' are ignored
+        mask = np.ones(self.n_keys, dtype=bool)
+        for name, value in filters.items():
+            if value is None or value == 'All':
+                continue
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            wanted = self.categories[name].get_indexer(list(values))
+            mask &= np.isin(self.key_codes[name], wanted[wanted >= 0])
+        return mask
+
+    def _count(self, name, t, side):
+        # Per-key count of entries < t (side='left') or <= t (side='right')
+        array = getattr(self, f'_{name}')
+        return np.searchsorted(array, self._key_base + t, side=side) - self._offsets[name]
+
+    def active_at(self, t):
+        t = to_seconds(t)
+        return self._count('starts', t, 'right') - self._count('stops', t, 'left')
+
+    def overlapping(self, a, b, include_end=False):
+        # Intervals with START < b (<= b with include_end) and (open or STOP >= a)
+        side = 'right' if include_end else 'left'
+        return self._count('starts', to_seconds(b), side) - self._count('stops', to_seconds(a), 'left')
+
+    def stopped_between(self, a, b):
+        # Closed intervals with a <= STOP < b
+        return self._count('stops', to_seconds(b), 'left') - self._count('stops', to_seconds(a), 'left')
+
+    def open_started_before(self, t):
+        # Still-open intervals with START < t
+        return self._count('open_starts', to_seconds(t), 'left')
+
+    def census(self, times, mask=None, chunk=1_000_000):
+        # Total active count at each of `times` over the selected keys
+        keys = self._key_base if mask is None else self._key_base[mask]
+        start_off = self._offsets['starts'] if mask is None else self._offsets['starts'][mask]
+        stop_off = self._offsets['stops'] if mask is None else self._offsets['stops'][mask]
+        t = to_seconds(np.asarray(pd.DatetimeIndex(times).asi8))
+        result = np.zeros(len(t), dtype=np.int64)
+        step = max(1, chunk // max(len(keys), 1))
+        for i in range(0, len(t), step):
+            grid = keys[:, None] + t[None, i:i + step]
+            starts = np.searchsorted(self._starts, grid, side='right') - start_off[:, None]
+            stops = np.searchsorted(self._stops, grid, side='left') - stop_off[:, None]
+            result[i:i + step] = (starts - stops).sum(axis=0)
+        return result
+
+    def totals(self, counts, by, mask=None):
+        # Sum per-key counts into a Series indexed by the categories of dimension `by`
+        codes = self.key_codes[by]
+        weights = counts if mask is None else np.where(mask, counts, 0)
+        present = codes >= 0
+        sums = np.bincount(codes[present], weights=weights[present], minlength=len(self.categories[by]))
+        # Alphabetical, so ties rank the same whether or not ingestion appended categories
+        return pd.Series(sums.astype(np.int64), index=self.categories[by]).sort_index()
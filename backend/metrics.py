@@ -0,0 +1,343 @@
+import contextvars
+import cProfile
+import glob
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: files of exited processes are never folded
+    fcntl = None
+
+# Request instrumentation: per-route, per-stage timers aggregated into histograms and
+# rendered in the Prometheus text format.
+#
+# A request gets a RequestTimer (see start_request); code marks its phases with
+# `with stage('filter'):` and time is attributed to the innermost open stage of its thread,
+# so nested stages never count twice. Time outside every marked stage (the handlers' own pandas /
+# numpy work) counts as BASE_STAGE. Outside a request stage() does nothing.
+#
+# Each process keeps its own registry. With a metrics directory (one per server, shared
+# by its workers) a background thread writes the registry there as <pid>.json once a
+# second when it changed, and render() sums the files. The files of exited processes are
+# folded into retired.json (under an flock) and deleted, so counters stay monotonic across
+# worker restarts while the directory holds one file per live process plus one. A forked
+# child starts with an empty registry (the parent's counts stay in the parent's file).
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+FLUSH_SECONDS = 1.0
+RETIRED_FILE = 'retired.json'
+STAGES = ('load', 'filter', 'join', 'aggregate', 'serialize', 'cache')
+BASE_STAGE = 'aggregate'
+
+_current = contextvars.ContextVar('phi_request_timer', default=None)
+
+
+class RequestTimer:
+    # Seconds per stage of one request. Each thread keeps its own stack of open stages: pool
+    # threads working for the request (their tasks run in a copy of its context) add their
+    # own time, so the stages of a parallel section can add up to more than the latency.
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._threads = {}  # thread id -> [stack of stage names, time the innermost one resumed]
+        self._lock = threading.Lock()
+
+    def enter(self, name):
+        now = time.perf_counter()
+        state = self._threads.setdefault(threading.get_ident(), [[], None])
+        if state[0]:
+            self._add(state[0][-1], now - state[1])
+        state[0].append(name)
+        state[1] = now
+
+    def leave(self):
+        now = time.perf_counter()
+        ident = threading.get_ident()
+        state = self._threads[ident]
+        self._add(state[0].pop(), now - state[1])
+        state[1] = now
+        if not state[0]:
+            del self._threads[ident]
+
+    def close(self):
+        # Leave every stage the calling thread still has open
+        while threading.get_ident() in self._threads:
+            self.leave()
+
+    def _add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def start_request():
+    timer = RequestTimer()
+    timer.enter(BASE_STAGE)
+    _current.set(timer)
+    return timer
+
+
+def finish_request():
+    # -> the request's timer with every stage closed, or None
+    timer = _current.get()
+    _current.set(None)
+    if timer is not None:
+        timer.close()
+    return timer
+
+
+@contextmanager
+def stage(name):
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    timer.enter(name)
+    try:
+        yield
+    finally:
+        timer.leave()
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+class Metrics:
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.help = {}
+        self._counters = {}      # key -> value
+        self._histograms = {}    # key -> [bucket counts..., sum, count], with its buckets in _buckets
+        self._buckets = {}       # metric name -> bucket bounds
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flusher = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # In a forked child: threads do not survive the fork, the parent's counts stay its own
+        self._counters, self._histograms = {}, {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flusher = None
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, n=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+        self._changed()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._buckets.setdefault(name, list(buckets))
+            state = self._histograms.get(key)
+            if state is None:
+                state = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+        self._changed()
+
+    def _state(self):
+        with self._lock:
+            return {'counters': dict(self._counters), 'buckets': dict(self._buckets),
+                    'histograms': {k: list(v) for k, v in self._histograms.items()}}
+
+    def _changed(self):
+        self._dirty = True
+        if self.directory and self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                    self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            if self._dirty:
+                self.flush()
+
+    def flush(self):
+        # Write this process's registry to the shared directory (atomic replace)
+        if not self.directory:
+            return
+        self._dirty = False
+        _write(os.path.join(self.directory, f'{os.getpid()}.json'), self._state())
+
+    def _merged(self):
+        if not self.directory:
+            return self._state()
+        self.flush()
+        self._retire()
+        merged = _empty()
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            state = _load(path)
+            if state is not None:
+                _add(merged, state)
+        return merged
+
+    def _retire(self):
+        # Fold the files of exited processes into RETIRED_FILE and delete them
+        if fcntl is None:
+            return
+        paths = glob.glob(os.path.join(self.directory, '*.json'))
+        if not any(_exited(path) for path in paths):
+            return
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                retired_path = os.path.join(self.directory, RETIRED_FILE)
+                retired = _load(retired_path) or _empty()
+                # Another process may have folded some of them meanwhile; those are gone now
+                folded = [path for path in paths if _exited(path) and _add(retired, _load(path))]
+                if folded:
+                    _write(retired_path, retired)
+                    for path in folded:
+                        os.remove(path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def render(self, gauges=()):
+        # Prometheus text exposition; gauges: extra (name, labels, value) computed by the caller
+        state = self._merged()
+        series = {}
+        for key, value in state['counters'].items():
+            name, labels = json.loads(key)
+            series.setdefault(name, []).append(f'{name}{_labels(labels)} {value}')
+        for key, values in state['histograms'].items():
+            name, labels = json.loads(key)
+            lines = series.setdefault(name, [])
+            for bound, count in zip(state['buckets'][name] + ['+Inf'], values[:-2] + [values[-1]]):
+                lines.append(f'{name}_bucket{_labels(labels + [["le", _number(bound)]])} {count}')
+            lines.append(f'{name}_sum{_labels(labels)} {values[-2]:.6f}')
+            lines.append(f'{name}_count{_labels(labels)} {values[-1]}')
+        for name, labels, value in gauges:
+            series.setdefault(name, []).append(f'{name}{_labels(sorted(labels.items()))} {value}')
+
+        out = []
+        for name in sorted(series):
+            kind, text = self.help.get(name, ('untyped', ''))
+            out.append(f'# HELP {name} {text}')
+            out.append(f'# TYPE {name} {kind}')
+            out.extend(series[name])
+        return '\n'.join(out) + '\n'
+
+
+def _empty():
+    return {'counters': {}, 'buckets': {}, 'histograms': {}}
+
+
+def _load(path):
+    # -> a registry file's state, or None when it is gone (or unreadable)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def _add(merged, state):
+    # Sum state into merged; -> whether there was a state to add
+    if state is None:
+        return False
+    merged['buckets'].update(state['buckets'])
+    for key, value in state['counters'].items():
+        merged['counters'][key] = merged['counters'].get(key, 0) + value
+    for key, values in state['histograms'].items():
+        current = merged['histograms'].get(key)
+        merged['histograms'][key] = values if current is None else [a + b for a, b in zip(current, values)]
+    return True
+
+
+def _exited(path):
+    # Whether the process that wrote <pid>.json is gone (RETIRED_FILE has no process)
+    name = os.path.basename(path)[:-len('.json')]
+    if not name.isdigit() or int(name) == os.getpid():
+        return False
+    try:
+        os.kill(int(name), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+def _number(value):
+    return value if isinstance(value, str) else repr(float(value))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+class SlowRequestProfiler:
+    # Opt-in: profiles a sample of requests and keeps the profile of those slower than
+    # threshold_ms as <directory>/<route>-<time>-<ms>ms.prof (open with pstats / snakeviz).
+    # One profile at a time per process.
+    def __init__(self, directory, threshold_ms, sample_rate):
+        self.directory = directory
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self._busy = threading.Lock()
+        self._local = threading.local()
+        self.enabled = bool(directory) and sample_rate > 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        if not self.enabled or random.random() >= self.sample_rate or not self._busy.acquire(blocking=False):
+            return
+        profile = cProfile.Profile()
+        self._local.profile = profile
+        profile.enable()
+
+    def discard(self):
+        # Stop this thread's profile, if any, and free the profiler for the next request;
+        # -> the stopped profile. Called at teardown too, which runs even when the request
+        # failed before finish() was reached
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            return None
+        profile.disable()
+        self._local.profile = None
+        self._busy.release()
+        return profile
+
+    def finish(self, route, seconds):
+        # -> path of the dumped profile, or None
+        profile = self.discard()
+        if profile is None:
+            return None
+        if seconds < self.threshold:
+            return None
+        name = route.strip('/').replace('/', '_') or 'root'
+        path = os.path.join(self.directory, f'{name}-{time.strftime("%Y%m%d%H%M%S")}-{int(seconds * 1000)}ms.prof')
+        profile.dump_stats(path)
+        return path
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+from sketches import quantile_merge, quantile_sketch, sketch_quantiles
+
+# Per-code index over the numeric rows of `observations`.
+#
+# Rows are grouped by DESCRIPTION (one lab / vital sign) and sorted by date inside each
+# group, with their dates, values and patient ids copied into contiguous arrays, so a
+# trend for one code touches only that code's slice (a date window is two binary
+# searches, a cohort a mask over the slice). Monthly and yearly count / sum / quantile
+# sketch aggregates are precomputed per code; yearly ones are merged from the monthly
+# ones. Requests without a cohort or date window are answered from the aggregates alone.
+
+FREQUENCIES = ('year', 'month')
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+class _Periods:
+    # count / sum / quantile sketch per (description, period), sorted by description then period
+    def __init__(self, descriptions, periods, counts, sums, sketch, n_descriptions):
+        self.descriptions = descriptions
+        self.periods = periods
+        self.counts = counts
+        self.sums = sums
+        self.sketch = sketch
+        self.offsets = np.searchsorted(descriptions, np.arange(n_descriptions + 1))
+
+    @classmethod
+    def from_rows(cls, descriptions, periods, values, n_descriptions):
+        # Rows sorted by description, then period
+        change = np.r_[True, (descriptions[1:] != descriptions[:-1]) | (periods[1:] != periods[:-1])] \
+            if len(descriptions) else np.zeros(0, dtype=bool)
+        group = np.cumsum(change) - 1
+        starts = np.flatnonzero(change)
+        return cls(descriptions[starts], periods[starts], np.bincount(group, minlength=len(starts)),
+                   np.bincount(group, weights=values, minlength=len(starts)), quantile_sketch(group, values),
+                   n_descriptions)
+
+    def rolled_up(self, periods, n_descriptions):
+        # Coarser periods (e.g. months -> years): counts and sums add up, sketches merge
+        change = np.r_[True, (self.descriptions[1:] != self.descriptions[:-1]) | (periods[1:] != periods[:-1])] \
+            if len(periods) else np.zeros(0, dtype=bool)
+        group = np.cumsum(change) - 1
+        starts = np.flatnonzero(change)
+        return _Periods(self.descriptions[starts], periods[starts],
+                        np.bincount(group, weights=self.counts, minlength=len(starts)).astype(np.int64),
+                        np.bincount(group, weights=self.sums, minlength=len(starts)),
+                        quantile_merge(self.sketch, group), n_descriptions)
+
+    def trend(self, description, percentiles):
+        # -> (periods, counts, means, quantiles) of one description
+        lo, hi = self.offsets[description], self.offsets[description + 1]
+        groups, buckets, counts = self.sketch
+        first, last = np.searchsorted(groups, [lo, hi])
+        sketch = (groups[first:last] - lo, buckets[first:last], counts[first:last])
+        quantiles = sketch_quantiles(sketch, hi - lo, np.asarray(percentiles) / 100)
+        return self.periods[lo:hi], self.counts[lo:hi], self.sums[lo:hi] / self.counts[lo:hi], quantiles
+
+
+class ObservationIndex:
+    def __init__(self, observations, patient_ids):
+        # observations: the observations table; patient_ids: dense patient id of each row
+        descriptions = observations['DESCRIPTION']
+        self.categories = descriptions.cat.categories
+        codes = descriptions.cat.codes.to_numpy()
+        dates = observations['DATE'].array.asi8
+        values = observations['VALUE'].to_numpy(dtype=np.float64)
+        numeric = (codes >= 0) & ~np.isnan(values) & (dates != np.iinfo(np.int64).min)
+        rows = np.flatnonzero(numeric)
+        rows = rows[np.lexsort((dates[rows], codes[rows]))]
+
+        self.n = len(self.categories)
+        self.codes = codes[rows]
+        self.dates = dates[rows]
+        self.values = values[rows]
+        self.patients = np.asarray(patient_ids)[rows]
+        self.offsets = np.searchsorted(self.codes, np.arange(self.n + 1))
+
+        # Most frequent LOINC code and unit of each description, for lookups and labels
+        labels = pd.DataFrame({'description': self.codes,
+                               'CODE': observations['CODE'].to_numpy()[rows],
+                               'UNITS': observations['UNITS'].to_numpy()[rows]})
+        self.labels = {column: labels.groupby('description')[column].agg(lambda s: s.mode().iat[0] if s.notna().any() else None)
+                       for column in ('CODE', 'UNITS')}
+        self._by_code = {str(code): d for d, code in self.labels['CODE'].items() if code is not None}
+
+        months = self._months(self.dates)
+        self.monthly = _Periods.from_rows(self.codes, months, self.values, self.n)
+        self.yearly = self.monthly.rolled_up(self.monthly.periods // 12, self.n)
+
+    @staticmethod
+    def _months(dates):
+        # Months since 1970-01 (year = months // 12 + 1970)
+        return dates.astype('datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+
+    def lookup(self, code):
+        # LOINC code or description -> description position, or None
+        if code in self._by_code:
+            return self._by_code[code]
+        position = self.categories.get_indexer([code])[0]
+        return position if position >= 0 and self.offsets[position + 1] > self.offsets[position] else None
+
+    def codes_summary(self):
+        counts = np.diff(self.offsets)
+        return [{
+            'description': self.categories[d],
+            'code': self.labels['CODE'].get(d),
+            'units': self.labels['UNITS'].get(d),
+            'count': int(counts[d]),
+            'first': pd.Timestamp(self.dates[self.offsets[d]], tz='UTC').isoformat(),
+            'last': pd.Timestamp(self.dates[self.offsets[d + 1] - 1], tz='UTC').isoformat(),
+        } for d in sorted(np.flatnonzero(counts), key=lambda d: self.categories[d])]
+
+    def trend(self, description, freq='year', percentiles=DEFAULT_PERCENTILES, start=None, end=None, cohort=None):
+        # -> (DataFrame period/count/mean/pNN, rows read); pre-aggregated unless a window or cohort is given
+        if freq not in FREQUENCIES:
+            raise ValueError(f"freq must be one of {list(FREQUENCIES)}")
+        if start is None and end is None and cohort is None:
+            periods = self.yearly if freq == 'year' else self.monthly
+            rows_read = 0
+        else:
+            lo, hi = self.offsets[description], self.offsets[description + 1]
+            dates = self.dates[lo:hi]
+            if start is not None:
+                lo += np.searchsorted(dates, start.value, side='left')
+            if end is not None:
+                hi = self.offsets[description] + np.searchsorted(dates, end.value, side='left')
+            keep = slice(lo, max(lo, hi))
+            values, months = self.values[keep], self._months(self.dates[keep])
+            if cohort is not None:
+                patients = self.patients[keep]
+                member = np.zeros(len(patients), dtype=bool)
+                known = patients >= 0
+                member[known] = cohort.mask()[patients[known]]
+                values, months = values[member], months[member]
+            rows_read = keep.stop - keep.start
+            periods = _Periods.from_rows(np.zeros(len(values), dtype=np.int64), months, values, 1)
+            if freq == 'year':
+                periods = periods.rolled_up(periods.periods // 12, 1)
+            description = 0
+
+        labels, counts, means, quantiles = periods.trend(description, percentiles)
+        if freq == 'year':
+            labels = labels + 1970
+        else:
+            labels = [f'{m // 12 + 1970}-{m % 12 + 1:02d}' for m in labels]
+        df = pd.DataFrame({'period': labels, 'count': counts.astype(np.int64), 'mean': means})
+        for i, p in enumerate(percentiles):
+            df[f'p{p:g}'] = quantiles[:, i]
+        return df, rows_read
@@ -0,0 +1,224 @@
+import base64
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+from snapshot import alphabetical, category_ranks
+
+# Materialized per-patient aggregates behind /api/patients.
+#
+# condition_count, top_condition, medication_count and HRI are computed with
+# bincount / unique over the integer patient positions of each row, once per
+# snapshot; after an ingested batch only the appended rows are counted. Queries then
+# only filter, page and project this table; sort orders are argsorted once per key
+# (text columns alphabetically, whatever their vocabulary order) and reused, so a page
+# costs a mask and a slice. A page's cursor names the snapshot version, the sort and a
+# hash of the filters and cohort, and is refused by a query that differs in any of them.
+
+COLUMNS = ['Id', 'GENDER', 'RACE', 'AGE', 'CITY', 'HEALTHCARE_EXPENSES',
+           'condition_count', 'medication_count', 'HRI', 'top_condition']
+SORT_KEYS = ['HRI', 'AGE', 'HEALTHCARE_EXPENSES', 'condition_count', 'medication_count', 'CITY', 'Id']
+CATEGORY_FILTERS = {'gender': 'GENDER', 'race': 'RACE', 'city': 'CITY'}
+RANGE_FILTERS = {'hri': 'HRI', 'age': 'AGE'}
+MAX_PAGE_SIZE = 1000
+
+
+class QueryError(ValueError):
+    pass
+
+
+def most_frequent(owner, codes, n_owners, ranks=None):
+    # Most frequent code per owner; ties -> lowest rank (ranks: per code, default the code
+    # itself, i.e. first in vocabulary order)
+    valid = (owner >= 0) & (codes >= 0)
+    owner, codes = owner[valid].astype(np.int64), codes[valid].astype(np.int64)
+    result = np.full(n_owners, -1, dtype=np.int64)
+    if not len(owner):
+        return result
+    width = int(codes.max()) + 1
+    pairs, counts = np.unique(owner * width + codes, return_counts=True)
+    pair_owner, pair_code = pairs // width, pairs % width
+    # Sort by owner, then count descending, then rank; the first row per owner wins
+    order = np.lexsort((pair_code if ranks is None else ranks[pair_code], -counts, pair_owner))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = pair_owner[order][1:] != pair_owner[order][:-1]
+    winners = order[first]
+    result[pair_owner[winners]] = pair_code[winners]
+    return result
+
+
+def patient_counts(n, condition_ids, condition_codes, medication_ids, dispenses, condition_ranks=None):
+    # Per-patient condition_count, top condition code (ties: lowest condition rank) and
+    # dispensed medication count
+    valid = condition_ids >= 0
+    med_valid = medication_ids >= 0
+    return {
+        'condition_count': np.bincount(condition_ids[valid], minlength=n),
+        'top_codes': most_frequent(condition_ids, condition_codes, n, condition_ranks),
+        'medication_count': np.bincount(medication_ids[med_valid], weights=dispenses[med_valid], minlength=n),
+    }
+
+
+def update_counts(counts, n, condition_ids, condition_codes, medication_ids, dispenses, first_condition, first_medication,
+                  condition_ranks=None):
+    # Counts after rows were appended from first_condition / first_medication on; only the
+    # patients with new condition rows get their top condition recomputed
+    grow = lambda values: np.concatenate([values, np.zeros(n - len(values), dtype=values.dtype)])
+    new_ids, new_med = condition_ids[first_condition:], medication_ids[first_medication:]
+    new_valid, med_valid = new_ids >= 0, new_med >= 0
+    condition_count = grow(counts['condition_count']) + np.bincount(new_ids[new_valid], minlength=n)
+    medication_count = grow(counts['medication_count']) + np.bincount(
+        new_med[med_valid], weights=dispenses[first_medication:][med_valid], minlength=n)
+
+    top_codes = np.concatenate([counts['top_codes'], np.full(n - len(counts['top_codes']), -1)])
+    affected = np.unique(new_ids[new_valid])
+    if len(affected):
+        rows = np.flatnonzero(np.isin(condition_ids, affected))
+        top_codes[affected] = most_frequent(condition_ids[rows], condition_codes[rows], n, condition_ranks)[affected]
+    return {'condition_count': condition_count, 'top_codes': top_codes, 'medication_count': medication_count}
+
+
+def patient_frame(patients, counts, condition_categories):
+    condition_count, medication_count = counts['condition_count'], counts['medication_count']
+    top_codes = counts['top_codes']
+    top_condition = np.asarray(condition_categories, dtype=object)[np.maximum(top_codes, 0)]
+    top_condition = np.where(top_codes >= 0, top_condition, 'None')
+
+    expenses = patients['HEALTHCARE_EXPENSES'].to_numpy(dtype=np.float64)
+    hri = condition_count * 0.4 + expenses / 10000 * 0.4 + medication_count * 0.2
+    max_hri = np.nanmax(hri) if len(patients) else 0
+    hri = np.clip(hri / max_hri * 100, None, 100) if max_hri else hri
+
+    return pd.DataFrame({
+        'Id': patients['Id'],
+        'GENDER': patients['GENDER'],
+        'RACE': patients['RACE'],
+        'AGE': patients['AGE'],
+        'CITY': patients['CITY'],
+        'HEALTHCARE_EXPENSES': expenses,
+        'condition_count': condition_count,
+        'medication_count': medication_count,
+        'HRI': hri,
+        'top_condition': top_condition,
+    })
+
+
+def build_patient_table(patients, conditions, condition_rows, medications, medication_rows):
+    description = conditions['DESCRIPTION']
+    counts = patient_counts(len(patients), np.asarray(condition_rows), description.cat.codes.to_numpy(),
+                            np.asarray(medication_rows), medications['DISPENSES'].fillna(0).to_numpy(),
+                            category_ranks(description.cat.categories))
+    return patient_frame(patients, counts, description.cat.categories), counts
+
+
+def filters_digest(filters, members=None):
+    # Short hash of what a query selects (its filters and cohort), bound into its cursors
+    selected = {param: sorted({v for v in filters.get(param, []) if v and v != 'All'}) for param in CATEGORY_FILTERS}
+    for param in RANGE_FILTERS:
+        for bound in (f'{param}_min', f'{param}_max'):
+            value = filters.get(bound)
+            selected[bound] = None if value is None else float(value)
+    digest = hashlib.sha1(json.dumps(selected, sort_keys=True).encode())
+    if members is not None:
+        digest.update(np.packbits(np.asarray(members, dtype=bool)).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def encode_cursor(version, sort, rank, digest):
+    raw = json.dumps({'v': version, 's': sort, 'f': digest, 'r': int(rank)}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, version, sort, digest):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        cursor_version, cursor_sort, rank = data['v'], data['s'], int(data['r'])
+    except (ValueError, TypeError, KeyError):
+        raise QueryError("Invalid cursor")
+    if cursor_version != version or cursor_sort != sort:
+        raise QueryError("Cursor is from another snapshot or sort order; restart paging")
+    if data.get('f') != digest:
+        raise QueryError("Cursor is from other filters or another cohort; restart paging")
+    return rank
+
+
+class PatientTable:
+    def __init__(self, df, version, counts=None):
+        self.df = df
+        self.version = version
+        self.counts = counts
+        self._orders = {}
+
+    def __len__(self):
+        return len(self.df)
+
+    def order(self, sort):
+        # Row positions in sort order (stable: ties keep patient order) and each row's rank
+        cached = self._orders.get(sort)
+        if cached is None:
+            key = sort.lstrip('-')
+            if key not in SORT_KEYS:
+                raise QueryError(f"Unknown sort key '{key}', expected one of {SORT_KEYS}")
+            values = self.df[key]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = alphabetical(values).cat.codes.to_numpy()
+            else:
+                values = values.to_numpy(dtype=np.float64)
+            if sort.startswith('-'):
+                values = -values
+            order = np.argsort(values, kind='stable')
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            cached = self._orders[sort] = (order, rank)
+        return cached
+
+    def mask(self, filters, members=None):
+        # members: optional bool mask over patients (e.g. a cohort), ANDed with the filters
+        mask = np.ones(len(self.df), dtype=bool) if members is None else np.asarray(members, dtype=bool).copy()
+        for param, column in CATEGORY_FILTERS.items():
+            values = [v for v in filters.get(param, []) if v and v != 'All']
+            if values:
+                series = self.df[column]
+                wanted = series.cat.categories.get_indexer(values)
+                mask &= np.isin(series.cat.codes.to_numpy(), wanted[wanted >= 0])
+        for param, column in RANGE_FILTERS.items():
+            low, high = filters.get(f'{param}_min'), filters.get(f'{param}_max')
+            values = self.df[column].to_numpy(dtype=np.float64)
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+        return mask
+
+    def project(self, fields):
+        fields = fields or COLUMNS
+        unknown = [f for f in fields if f not in COLUMNS]
+        if unknown:
+            raise QueryError(f"Unknown fields {unknown}")
+        return fields
+
+    def query(self, filters=None, sort='-HRI', limit=100, offset=0, cursor=None, fields=None, members=None):
+        fields = self.project(fields)
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+        order, rank = self.order(sort)
+        filters = filters or {}
+        selected = order[self.mask(filters, members)[order]]
+        digest = filters_digest(filters, members)
+        if cursor:
+            start = np.searchsorted(rank[selected], decode_cursor(cursor, self.version, sort, digest), side='right')
+        else:
+            start = max(0, int(offset))
+        page = selected[start:start + limit]
+
+        more = start + limit < len(selected)
+        return {
+            'data': self.df.iloc[page][fields].to_dict(orient='records'),
+            'total': int(len(selected)),
+            'offset': int(start),
+            'limit': limit,
+            'sort': sort,
+            'next_cursor': encode_cursor(self.version, sort, rank[page[-1]], digest) if more and len(page) else None,
+        }
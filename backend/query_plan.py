@@ -0,0 +1,67 @@
+import threading
+from concurrent.futures import Future
+
+from thread_pool import ThreadPool
+
+# Shared query plan for a batch of dashboard widgets.
+#
+# A widget is a function (plan, filters) -> JSON-ready data that reads its input through
+# plan.base(name, filters): a base frame (e.g. the filtered medical-condition rows, or an
+# encounter cube restricted to the selected year and class) identified by its name and the
+# values of the filters it depends on. Each distinct base is built once per plan however
+# many widgets read it: the first widget to ask builds it in its own thread and the others
+# wait for the result, so a pool worker never waits on a task queued behind it.
+#
+# WidgetPool runs the widgets of a batch concurrently on a per-process thread pool (see
+# thread_pool.py); the calling thread runs one of them itself.
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+class QueryPlan:
+    def __init__(self, bases):
+        # bases: {name: (names of the filters it depends on, build(plan, filters))}
+        self.bases = bases
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def base(self, name, filters):
+        params, build = self.bases[name]
+        key = (name,) + tuple(_hashable(filters.get(p)) for p in params)
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        if owner:
+            try:
+                future.set_result(build(self, filters))
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+    def built(self):
+        # -> number of distinct bases built (or being built) so far
+        return len(self._futures)
+
+
+class WidgetPool(ThreadPool):
+    def __init__(self, workers):
+        super().__init__(workers, 'phi-widget')
+
+    def run(self, tasks):
+        # tasks: zero-argument callables -> [(result, None) or (None, exception)] in order
+        def call(task):
+            try:
+                return task(), None
+            except Exception as e:
+                return None, e
+
+        if self.workers == 1 or len(tasks) < 2:
+            return [call(task) for task in tasks]
+        futures = [self.submit(call, task) for task in tasks[1:]]
+        return [call(tasks[0])] + [future.result() for future in futures]
@@ -0,0 +1,189 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from thread_pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:  # Windows: a job may then run once per process
+    fcntl = None
+
+# Background report jobs with results persisted on local disk.
+#
+# A job is identified by a hash of (snapshot version, report type, year, cohort), so
+# submitting the same report twice, from any worker process, names the same job. Its
+# files live in <directory>/<version>/:
+#
+#   <id>.job.json   state (queued / running / done / failed), parameters and timings
+#   <id>.json       the finished report as /api/reports returns it
+#   <id>.csv        the same as CSV
+#
+# Jobs run on a per-process thread pool (reports read the process's snapshot tables and
+# cubes, which threads share). A job holds an flock() on <id>.lock while it runs and
+# first checks whether another process finished it meanwhile, so concurrent submissions
+# in different processes compute once. Finished results are served from disk until the
+# data version changes; directories of versions no longer kept are pruned.
+
+# A queued / running job whose state was not updated for this long is submitted again
+DEFAULT_STALE_SECONDS = 3600
+JOB_FILE = '{}.job.json'
+
+logger = logging.getLogger('phi.reports')
+
+
+def job_id(version, report_type, year, cohort):
+    raw = json.dumps([version, report_type, year, cohort])
+    return hashlib.sha1(raw.encode()).hexdigest()[:20]
+
+
+def valid_id(value):
+    return len(value) == 20 and all(c in '0123456789abcdef' for c in value)
+
+
+class ReportJobs:
+    def __init__(self, directory, run, workers=2, stale_seconds=DEFAULT_STALE_SECONDS):
+        # run(job) -> (JSON body bytes, CSV body bytes) of the job's report; called on the pool
+        self.directory = directory
+        self.run = run
+        self.stale_seconds = stale_seconds
+        self._pool = ThreadPool(workers, 'phi-report')
+        self._forget_pending()
+        os.makedirs(directory, exist_ok=True)
+        # The jobs in flight are the parent's: a forked child has none of its threads
+        os.register_at_fork(after_in_child=self._forget_pending)
+
+    def _forget_pending(self):
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def path(self, job, suffix):
+        return os.path.join(self.directory, job['version'], f"{job['id']}.{suffix}")
+
+    def get(self, id, versions=None):
+        # -> the job's state, or None when no kept version has it
+        for version in self.versions() if versions is None else versions:
+            try:
+                with open(os.path.join(self.directory, version, JOB_FILE.format(id))) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def versions(self):
+        return sorted((v for v in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, v))), reverse=True)
+
+    def list(self, version):
+        # -> the jobs of a version, most recently submitted first (none for unknown versions,
+        # so a version is never joined into a path it does not name)
+        if version not in self.versions():
+            return []
+        directory = os.path.join(self.directory, version)
+        ids = [name[:-len('.job.json')] for name in os.listdir(directory) if name.endswith('.job.json')]
+        jobs = [job for job in (self.get(id, [version]) for id in ids) if job is not None]
+        return sorted(jobs, key=lambda job: job['submitted'], reverse=True)
+
+    def submit(self, version, report_type, year, cohort=''):
+        # -> the job for these parameters: finished, in progress, or queued now
+        id = job_id(version, report_type, year, cohort)
+        with self._lock:
+            job = self.get(id, [version])
+            if job is not None and (id in self._pending or not self._retry(job)):
+                return job
+            job = {'id': id, 'version': version, 'report_type': report_type, 'year': year, 'cohort': cohort,
+                   'state': 'queued', 'submitted': time.time(), 'started': None, 'finished': None, 'error': None}
+            self._write(job)
+            self._pending.add(id)
+        # A job outlives the request that submitted it: it runs in an empty context, not the request's
+        self._pool.submit(contextvars.Context().run, self._execute, job)
+        return job
+
+    def _retry(self, job):
+        # Failed jobs, and queued / running ones nobody is working on, are submitted again
+        if job['state'] == 'failed':
+            return True
+        if job['state'] == 'done':
+            return not os.path.exists(self.path(job, 'json'))
+        if job['state'] == 'running' and not _locked(self.path(job, 'lock')):
+            return True
+        return time.time() - job.get('updated', job['submitted']) > self.stale_seconds
+
+    def _execute(self, job):
+        try:
+            with _FileLock(self.path(job, 'lock')):
+                current = self.get(job['id'], [job['version']])
+                if current is not None and current['state'] == 'done' and os.path.exists(self.path(current, 'json')):
+                    return
+                job.update(state='running', started=time.time())
+                self._write(job)
+                try:
+                    json_body, csv_body = self.run(job)
+                    _write_atomic(self.path(job, 'json'), json_body)
+                    _write_atomic(self.path(job, 'csv'), csv_body)
+                    job.update(state='done')
+                except Exception as e:
+                    logger.exception("Report job %s failed", job['id'])
+                    job.update(state='failed', error=str(e))
+                job['finished'] = time.time()
+                job['seconds'] = round(job['finished'] - job['started'], 3)
+                self._write(job)
+        finally:
+            with self._lock:
+                self._pending.discard(job['id'])
+
+    def _write(self, job):
+        job['updated'] = time.time()
+        os.makedirs(os.path.join(self.directory, job['version']), exist_ok=True)
+        _write_atomic(self.path(job, 'job.json'), json.dumps(job).encode())
+
+    def prune(self, keep):
+        # Remove the results of versions not in `keep`
+        for version in self.versions():
+            if version not in keep:
+                shutil.rmtree(os.path.join(self.directory, version), ignore_errors=True)
+
+
+def _write_atomic(path, data):
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _locked(path):
+    # Whether some process holds the flock() on path
+    if fcntl is None or not os.path.exists(path):
+        return False
+    fd = os.open(path, os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return True
+    else:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return False
+    finally:
+        os.close(fd)
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,450 @@
+import functools
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+from flask import current_app, request
+
+from metrics import stage
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-flight is then per process only
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # optional: without it entries are precompressed with gzip (and zstd) only
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+# Response cache shared by every worker process on the host.
+#
+# Entries live in one SQLite database (WAL mode, so readers never block each other)
+# keyed by the request path, the normalized query string and a data version (snapshot
+# + vocabulary rules): publishing a new snapshot makes every old entry unreachable and
+# LRU eviction reclaims the space. Total size and entry count are bounded.
+#
+# Concurrent misses for the same key compute once: the first request takes a striped
+# thread lock plus an flock() on the matching lock file, the others wait on it and then
+# read the stored entry. A hit only reads: hit / miss counts, entry access times (for
+# LRU) and request counts (for the warm-up list) are buffered per process and written in
+# one transaction every FLUSH_REQUESTS requests or FLUSH_SECONDS, so hits in different
+# workers never queue on SQLite's single writer lock. The counters cover all workers, a
+# few requests behind. Only the MAX_REQUESTS most frequent requests are remembered, so
+# one-off query strings (cursors, as_of timestamps) do not accumulate. The view decorator
+# leaves the outcome of each request (hit / miss / coalesced / uncacheable / not_modified)
+# in request.environ[OUTCOME_KEY].
+#
+# The cache key doubles as a strong ETag: it is a hash of the data version and the
+# normalized request, so a request whose If-None-Match holds it gets a 304 before any
+# lookup or computation (also with the cache disabled). A compressed body's ETag is the
+# key suffixed with its content coding (RFC 9110: each coding of a representation gets
+# its own strong validator); any of them revalidates the request. Views with a TTL key on aligned
+# TTL windows (every process agrees on the window) and their entries expire at the end
+# of the window, so one ETag never names two different bodies. Bodies are stored with
+# precompressed gzip (and brotli / zstd when installed) variants next to the plain one,
+# and each response is sent in the best encoding the client accepts.
+
+DEFAULT_MAX_BYTES = 256 * 2**20
+DEFAULT_MAX_ENTRIES = 10000
+LOCK_STRIPES = 64
+COUNTERS = ('hits', 'misses', 'coalesced', 'stores', 'evictions', 'expired', 'uncacheable')
+# Response headers kept with an entry (everything else is recomputed by Flask)
+KEPT_HEADERS = ('Content-Type', 'Content-Disposition')
+OUTCOME_KEY = 'phi.cache_outcome'
+FLUSH_REQUESTS = 100
+FLUSH_SECONDS = 5.0
+MAX_REQUESTS = 1000
+# Precompressed variants of bodies of at least COMPRESS_MIN_BYTES, in order of preference
+# when the client accepts several equally; unavailable codecs are skipped
+COMPRESSORS = {
+    'br': brotli and (lambda body: brotli.compress(body, quality=6)),
+    'zstd': zstandard and (lambda body: zstandard.ZstdCompressor(level=10).compress(body)),
+    'gzip': lambda body: gzip.compress(body, compresslevel=6, mtime=0),
+}
+ENCODINGS = tuple(name for name, compress in COMPRESSORS.items() if compress)
+COMPRESS_MIN_BYTES = 1024
+
+# Bumped when the entries table changes; entries of an older layout are dropped
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY, request TEXT NOT NULL, version TEXT NOT NULL,
+    status INTEGER NOT NULL, headers TEXT NOT NULL, body BLOB NOT NULL,
+    br BLOB, zstd BLOB, gzip BLOB,
+    size INTEGER NOT NULL, created REAL NOT NULL, expires REAL, accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS requests (request TEXT PRIMARY KEY, count INTEGER NOT NULL, last REAL NOT NULL);
+"""
+
+
+def normalize_query(args):
+    # Sorted parameter names, blank values dropped; repeated values keep their order
+    items = []
+    for name in sorted(args.keys()):
+        values = [v.strip() for v in args.getlist(name) if v.strip()]
+        items.extend((name, v) for v in values)
+    return urlencode(items)
+
+
+class ResponseCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, max_entries=DEFAULT_MAX_ENTRIES, enabled=True):
+        self.directory = directory
+        self.path = os.path.join(directory, 'responses.sqlite')
+        self.max_bytes = int(max_bytes)
+        self.max_entries = int(max_entries)
+        self.enabled = enabled
+        self._local = threading.local()
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._reset_buffers()
+        # A forked worker must not flush what its parent buffered
+        os.register_at_fork(after_in_child=self._reset_buffers)
+        if enabled:
+            os.makedirs(os.path.join(directory, 'locks'), exist_ok=True)
+            db = self._connection()
+            if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                db.execute("DROP TABLE IF EXISTS entries")
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            db.executescript(SCHEMA)
+            with self._db() as db:
+                db.executemany("INSERT OR IGNORE INTO counters VALUES (?, 0)", [(c,) for c in COUNTERS])
+
+    def _connection(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _db(self):
+        return _Transaction(self._connection())
+
+    def _read(self):
+        # Consistent read (WAL): takes no write lock, so it never waits for a writer
+        return _Transaction(self._connection(), 'DEFERRED')
+
+    def _reset_buffers(self):
+        self._buffer_lock = threading.Lock()
+        self._counters = {}
+        self._accessed = {}
+        self._requests = {}
+        self._buffered = 0
+        self._flushed = time.monotonic()
+
+    def _note(self, counter=None, accessed=None, request_text=None):
+        # Buffer a counter increment / entry access / request; flush when due
+        with self._buffer_lock:
+            if counter is not None:
+                self._counters[counter] = self._counters.get(counter, 0) + 1
+            if accessed is not None:
+                self._accessed[accessed] = time.time()
+            if request_text is not None:
+                count, _ = self._requests.get(request_text, (0, 0))
+                self._requests[request_text] = (count + 1, time.time())
+            self._buffered += 1
+            due = self._buffered >= FLUSH_REQUESTS or time.monotonic() - self._flushed >= FLUSH_SECONDS
+        if due:
+            self.flush()
+
+    def flush(self):
+        # Write the buffered counters, access times and request counts in one transaction
+        with self._buffer_lock:
+            counters, accessed, requests = self._counters, self._accessed, self._requests
+            self._counters, self._accessed, self._requests = {}, {}, {}
+            self._buffered, self._flushed = 0, time.monotonic()
+        if not (counters or accessed or requests):
+            return
+        with self._db() as db:
+            for name, n in counters.items():
+                self._count(db, name, n)
+            db.executemany("UPDATE entries SET accessed = MAX(accessed, ?) WHERE key = ?",
+                           [(when, key) for key, when in accessed.items()])
+            db.executemany("INSERT INTO requests VALUES (?, ?, ?) ON CONFLICT(request) DO UPDATE "
+                           "SET count = count + excluded.count, last = MAX(last, excluded.last)",
+                           [(text, count, last) for text, (count, last) in requests.items()])
+            if db.execute("SELECT COUNT(*) FROM requests").fetchone()[0] > MAX_REQUESTS:
+                db.execute("DELETE FROM requests WHERE request NOT IN "
+                           "(SELECT request FROM requests ORDER BY count DESC, last DESC LIMIT ?)", (MAX_REQUESTS,))
+
+    @staticmethod
+    def key(path, query, version):
+        return hashlib.sha1(f'{version}\0{path}?{query}'.encode()).hexdigest()
+
+    def _count(self, db, name, n=1):
+        db.execute("UPDATE counters SET value = value + ? WHERE name = ?", (n, name))
+
+    def get(self, key, encodings=(), record=True):
+        # -> (status, headers, body, encoding) with the body in the first of `encodings` stored
+        # (encoding None: the plain body), or None; counts a hit or miss when `record`.
+        # Read only: expired entries are left for put() to delete.
+        stored = ', '.join(f'{e} IS NOT NULL' for e in ENCODINGS)
+        with self._read() as db:
+            row = db.execute(f"SELECT status, headers, expires, {stored} FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[2] is not None and row[2] <= time.time():
+                row = None
+            if row is not None:
+                available = {e for e, present in zip(ENCODINGS, row[3:]) if present}
+                encoding = next((e for e in encodings if e in available), None)
+                body, = db.execute(f"SELECT {encoding or 'body'} FROM entries WHERE key = ?", (key,)).fetchone()
+        if record or row is not None:
+            self._note(('hits' if row is not None else 'misses') if record else None, key if row is not None else None)
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), body, encoding
+
+    @staticmethod
+    def compress(body):
+        # -> {encoding: compressed body} for every available codec that makes the body smaller
+        if len(body) < COMPRESS_MIN_BYTES:
+            return {}
+        variants = {encoding: COMPRESSORS[encoding](body) for encoding in ENCODINGS}
+        return {encoding: data for encoding, data in variants.items() if len(data) < len(body)}
+
+    def put(self, key, request_text, version, entry, ttl=None, variants=None):
+        # variants: compress(body) when the caller already has it
+        status, headers, body = entry
+        variants = self.compress(body) if variants is None else variants
+        now = time.time()
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (key, request_text, version, status, json.dumps(headers), body,
+                        variants.get('br'), variants.get('zstd'), variants.get('gzip'),
+                        len(body) + sum(map(len, variants.values())), now, window_end(now, ttl), now))
+            self._count(db, 'stores')
+            self._evict(db, now)
+
+    def _evict(self, db, now):
+        # Drop expired entries, then least recently used ones until both bounds hold
+        expired = db.execute("DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?", (now,)).rowcount
+        if expired:
+            self._count(db, 'expired', expired)
+        count, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        victims = []
+        for key, entry_size in db.execute("SELECT key, size FROM entries ORDER BY accessed"):
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            victims.append((key,))
+            count, size = count - 1, size - entry_size
+        db.executemany("DELETE FROM entries WHERE key = ?", victims)
+        self._count(db, 'evictions', len(victims))
+
+    def record_request(self, request_text):
+        # Request frequencies drive the warm-up list
+        self._note(request_text=request_text)
+
+    def popular(self, limit):
+        self.flush()
+        with self._read() as db:
+            return [r for r, in db.execute("SELECT request FROM requests ORDER BY count DESC, last DESC LIMIT ?", (limit,))]
+
+    def _flight(self, key):
+        return _SingleFlight(self._stripes[int(key[:8], 16) % LOCK_STRIPES],
+                             os.path.join(self.directory, 'locks', f'{int(key[:8], 16) % LOCK_STRIPES:02d}.lock'))
+
+    def get_or_compute(self, key, request_text, version, compute, ttl=None, encodings=()):
+        # compute() -> (status, headers, body); only 200 responses are stored
+        # -> ((status, headers, body, encoding), outcome) with outcome 'hit', 'coalesced',
+        # 'miss' or 'uncacheable'; the body is in the first of `encodings` available
+        with stage('cache'):
+            entry = self.get(key, encodings)
+        if entry is not None:
+            return entry, 'hit'
+        with self._flight(key):
+            with stage('cache'):
+                entry = self.get(key, encodings, record=False)
+                if entry is not None:
+                    self._note('coalesced')
+                    return entry, 'coalesced'
+            status, headers, body = compute()
+            if status != 200:
+                with stage('cache'):
+                    self._note('uncacheable')
+                return (status, headers, body, None), 'uncacheable'
+            with stage('serialize'):
+                variants = self.compress(body)
+            with stage('cache'):
+                self.put(key, request_text, version, (status, headers, body), ttl, variants)
+        encoding = next((e for e in encodings if e in variants), None)
+        return (status, headers, variants[encoding] if encoding else body, encoding), 'miss'
+
+    def _request_key(self, version, ttl=None):
+        # Key / ETag of the current request; with a TTL the key changes every TTL window
+        window = f'@{int(time.time() // ttl)}' if ttl else ''
+        return self.key(request.path, normalize_query(request.args), f'{version}{window}')
+
+    @staticmethod
+    def _revalidated(key):
+        # The If-None-Match tag naming this request in any content coding, or None
+        for etag in [key] + [_etag(key, encoding) for encoding in ENCODINGS]:
+            if request.if_none_match.contains_weak(etag):
+                return etag
+        return None
+
+    @staticmethod
+    def _not_modified(etag):
+        request.environ[OUTCOME_KEY] = 'not_modified'
+        response = current_app.response_class(status=304)
+        response.vary.add('Accept-Encoding')
+        return _validated(response, etag)
+
+    def view(self, version, ttl=None):
+        # Decorator for a Flask view; `version()` returns the current data version
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                data_version = version()
+                key = self._request_key(data_version, ttl)
+                etag = self._revalidated(key)
+                if etag is not None:
+                    return self._not_modified(etag)
+                if not self.enabled:
+                    response = current_app.make_response(func(*args, **kwargs))
+                    return _validated(response, key) if response.status_code == 200 else response
+                request_text = f'{request.path}?{normalize_query(request.args)}'.rstrip('?')
+                with stage('cache'):
+                    self.record_request(request_text)
+
+                def compute():
+                    response = current_app.make_response(func(*args, **kwargs))
+                    headers = {h: response.headers[h] for h in KEPT_HEADERS if h in response.headers}
+                    return response.status_code, headers, response.get_data()
+
+                (status, headers, body, encoding), outcome = self.get_or_compute(
+                    key, request_text, data_version, compute, ttl, accepted_encodings())
+                request.environ[OUTCOME_KEY] = outcome
+                response = current_app.response_class(body, status=status, headers=headers)
+                if encoding:
+                    response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                return _validated(response, _etag(key, encoding)) if status == 200 else response
+            return wrapper
+        return decorator
+
+    def conditional(self, version):
+        # Decorator for views that are not stored (e.g. streamed exports): ETag and 304 only
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                key = self._request_key(version())
+                if request.if_none_match.contains_weak(key):
+                    return self._not_modified(key)
+                response = current_app.make_response(func(*args, **kwargs))
+                return _validated(response, key) if response.status_code == 200 else response
+            return wrapper
+        return decorator
+
+    def clear(self):
+        if self.enabled:
+            with self._db() as db:
+                db.execute("DELETE FROM entries")
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        self.flush()
+        with self._read() as db:
+            counters = dict(db.execute("SELECT name, value FROM counters"))
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            versions = dict(db.execute("SELECT version, COUNT(*) FROM entries GROUP BY version"))
+        lookups = counters['hits'] + counters['misses']
+        return {
+            'enabled': True,
+            'path': self.path,
+            'entries': entries,
+            'bytes': size,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hit_ratio': round(counters['hits'] / lookups, 4) if lookups else None,
+            'counters': counters,
+            'versions': versions,
+        }
+
+    def warm(self, app, paths):
+        # Request each path through the app so the responses are computed and stored
+        client = app.test_client()
+        results = {}
+        for path in paths:
+            started = time.perf_counter()
+            status = client.get(path).status_code
+            results[path] = {'status': status, 'ms': round((time.perf_counter() - started) * 1000, 1)}
+        return results
+
+
+def window_end(now, ttl):
+    # End of the TTL window `now` falls in (None: no TTL)
+    return (now // ttl + 1) * ttl if ttl else None
+
+
+def accepted_encodings():
+    # Available encodings the request accepts, best first (client quality, then ours)
+    accepted = request.accept_encodings
+    ranked = sorted(ENCODINGS, key=lambda e: -accepted[e])
+    return [e for e in ranked if accepted[e] > 0]
+
+
+def _etag(key, encoding=None):
+    return f'{key}-{encoding}' if encoding else key
+
+
+def _validated(response, etag):
+    # Clients may keep the response but revalidate it (If-None-Match) before every use
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+class _Transaction:
+    # `with` block = one IMMEDIATE (write) or DEFERRED (read) transaction; the connection
+    # is in autocommit mode otherwise
+    def __init__(self, db, mode='IMMEDIATE'):
+        self.db = db
+        self.mode = mode
+
+    def __enter__(self):
+        self.db.execute(f"BEGIN {self.mode}")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class _SingleFlight:
+    # Thread lock for this process + flock() for the other processes on the host
+    def __init__(self, lock, path):
+        self.lock = lock
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if fcntl is not None:
+            try:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            except OSError:
+                self.fd = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.lock.release()
@@ -0,0 +1,25 @@
+# Development server:
+#
+#   python serve.py
+#
+# The forecasting pool starts its workers with 'spawn', and a spawned process re-imports
+# the parent's __main__ module before it runs anything. This module only defines main(),
+# so the workers load forecasting.py and nothing else; started as `python app.py`, every
+# worker would import the whole app (snapshot, caches, pools) again. app.py started as a
+# script hands over to this module. For production use wsgi.py (see gunicorn.conf.py).
+
+
+def main():
+    from app import app, cache, logger, preload, snapshot, warm_cache
+    from snapshot import format_stats
+
+    logger.info("Snapshot %s", snapshot.version)
+    preload()
+    logger.info("%s", format_stats(snapshot))
+    if cache.enabled:
+        logger.info("Warmed %d cached responses", len(warm_cache()))
+    app.run(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import numpy as np
+
+# Mergeable sketches used by the pre-aggregated structures.
+#
+# HyperLogLog keeps one uint8 register array per group; merging groups is an
+# element-wise max, so distinct counts can be rolled up along any dimension without
+# going back to the rows. Values are hashed with splitmix64, so integer keys (e.g.
+# dense patient ids) need no string hashing.
+
+HLL_PRECISION = 12
+
+
+def splitmix64(values):
+    x = np.asarray(values).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _bit_length(values):
+    # Exact bit length of uint64 values
+    x = values.copy()
+    length = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = x >= (np.uint64(1) << np.uint64(shift))
+        length += big * shift
+        x = np.where(big, x >> np.uint64(shift), x)
+    return length + (x > 0)
+
+
+def hll_registers(groups, keys, n_groups, p=HLL_PRECISION):
+    # One row of 2**p registers per group; groups[i] is the group of keys[i]
+    m = 1 << p
+    hashed = splitmix64(keys)
+    index = (hashed >> np.uint64(64 - p)).astype(np.int64)
+    rest = hashed & np.uint64((1 << (64 - p)) - 1)
+    rho = (64 - p) - _bit_length(rest) + 1
+    registers = np.zeros(n_groups * m, dtype=np.uint8)
+    np.maximum.at(registers, np.asarray(groups, dtype=np.int64) * m + index, rho.astype(np.uint8))
+    return registers.reshape(n_groups, m)
+
+
+def hll_merge(registers, groups, n_groups):
+    # Element-wise max of register rows that share a group id
+    merged = np.zeros((n_groups, registers.shape[1]), dtype=np.uint8)
+    np.maximum.at(merged, np.asarray(groups, dtype=np.int64), registers)
+    return merged
+
+
+def hll_estimate(registers):
+    # Cardinality estimate per register row, with the small-range (linear counting) correction
+    registers = np.atleast_2d(registers)
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.sum(np.exp2(-registers.astype(np.float64)), axis=1)
+    zeros = np.sum(registers == 0, axis=1)
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    estimate = np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+    return np.rint(estimate).astype(np.int64)
+
+
+# Quantile sketch (DDSketch-style): values are counted in logarithmic buckets whose bounds
+# grow by a factor gamma, so every quantile comes back within QUANTILE_ACCURACY relative
+# error. A sketch of many groups is a sparse (group, bucket, count) table sorted by group
+# and bucket; merging groups is a sum of counts per (group, bucket).
+
+QUANTILE_ACCURACY = 0.01
+_BUCKET_OFFSET = 1 << 20
+_ZERO = 1e-9
+
+
+def _gamma(accuracy):
+    return (1 + accuracy) / (1 - accuracy)
+
+
+def quantile_buckets(values, accuracy=QUANTILE_ACCURACY):
+    # Signed bucket key per value, ordered like the values (0 holds values near zero)
+    values = np.asarray(values, dtype=np.float64)
+    magnitude = np.abs(values)
+    nonzero = magnitude > _ZERO
+    index = np.zeros(len(values), dtype=np.int64)
+    index[nonzero] = np.ceil(np.log(magnitude[nonzero]) / np.log(_gamma(accuracy)))
+    index = np.clip(index, 1 - _BUCKET_OFFSET, _BUCKET_OFFSET - 1) + _BUCKET_OFFSET
+    return np.where(nonzero, np.sign(values).astype(np.int64) * index, 0)
+
+
+def bucket_values(buckets, accuracy=QUANTILE_ACCURACY):
+    # Representative value of each bucket (within `accuracy` of every value it holds)
+    buckets = np.asarray(buckets, dtype=np.int64)
+    gamma = _gamma(accuracy)
+    index = np.abs(buckets) - _BUCKET_OFFSET
+    return np.where(buckets == 0, 0.0, np.sign(buckets) * 2 * gamma ** index.astype(np.float64) / (gamma + 1))
+
+
+def _combine(groups, buckets, counts):
+    # Sum the counts of equal (group, bucket) pairs; -> sorted (groups, buckets, counts)
+    order = np.lexsort((buckets, groups))
+    groups, buckets, counts = groups[order], buckets[order], counts[order]
+    if not len(groups):
+        return groups, buckets, counts
+    starts = np.flatnonzero(np.r_[True, (groups[1:] != groups[:-1]) | (buckets[1:] != buckets[:-1])])
+    return groups[starts], buckets[starts], np.add.reduceat(counts, starts)
+
+
+def quantile_sketch(groups, values, accuracy=QUANTILE_ACCURACY):
+    # groups[i] is the group of values[i]; NaN values are skipped
+    values = np.asarray(values, dtype=np.float64)
+    known = ~np.isnan(values)
+    groups = np.asarray(groups, dtype=np.int64)[known]
+    return _combine(groups, quantile_buckets(values[known], accuracy), np.ones(len(groups), dtype=np.int64))
+
+
+def quantile_merge(sketch, group_map):
+    # Roll groups up: group g of `sketch` is added to group group_map[g]
+    groups, buckets, counts = sketch
+    return _combine(np.asarray(group_map, dtype=np.int64)[groups], buckets, counts)
+
+
+def sketch_quantiles(sketch, n_groups, quantiles, accuracy=QUANTILE_ACCURACY):
+    # -> (n_groups, len(quantiles)) array, NaN for empty groups
+    groups, buckets, counts = sketch
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    result = np.full((n_groups, len(quantiles)), np.nan)
+    if not len(groups):
+        return result
+    cumulative = np.cumsum(counts)
+    totals = np.bincount(groups, weights=counts, minlength=n_groups).astype(np.int64)
+    before = np.concatenate([[0], np.cumsum(totals)[:-1]])
+    present = np.flatnonzero(totals)
+    # Lower rank q * (n - 1) within the group, as a rank in the concatenated counts
+    ranks = before[present, None] + np.floor(quantiles[None, :] * (totals[present, None] - 1))
+    entries = np.searchsorted(cumulative, ranks, side='right')
+    result[present] = bucket_values(buckets[entries], accuracy)
+    return result
@@ -0,0 +1,542 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import resource
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from metrics import stage
+
+# Columnar snapshot of the cleaned Synthea tables.
+#
+# `build_snapshot` parses the cleaned_*.csv files once and writes every column as a
+# plain .npy file: datetimes as int64 nanoseconds (UTC), numerics in their parsed
+# dtype and every text column as categorical codes plus a categories array.
+# `Snapshot` memory-maps those files the first time a table is touched, so a cold start
+# costs a few page faults instead of a full CSV parse and the pages are shared by every
+# process that maps the same snapshot. A table's row count is the one in meta.json, not
+# the .npy header's: ingestion appends a version's new rows to its parent's (hard-linked)
+# files, so a file can be longer than a version's table and its header can count fewer
+# rows (see ingest.py).
+
+TABLES = {
+    'patients': {'dates': ['BIRTHDATE', 'DEATHDATE']},
+    'conditions': {'dates': ['START', 'STOP']},
+    'encounters': {'dates': ['START', 'STOP']},
+    'medications': {'dates': ['START', 'STOP']},
+    'observations': {'dates': ['DATE'], 'numeric': ['VALUE']},
+    'claims': {'dates': ['CURRENTILLNESSDATE', 'SERVICEDATE', 'LASTBILLEDDATE1', 'LASTBILLEDDATE2', 'LASTBILLEDDATEP']},
+    'imaging_studies': {'dates': ['DATE']},
+    'immunizations': {'dates': ['DATE']},
+}
+
+# Text columns whose categories are shared by every table that has them, so codes
+# can be compared across tables (e.g. conditions and encounters DESCRIPTION)
+SHARED_VOCABULARIES = ['DESCRIPTION', 'GENDER', 'STATE', 'ENCOUNTERCLASS', 'ORGANIZATION']
+
+# Column holding the patient key of each table (tables not listed use PATIENT)
+PATIENT_KEYS = {'claims': 'PATIENTID'}
+
+# Tables too large to parse whole: built from their CSV in chunks of PHI_BUILD_CHUNK_ROWS rows,
+# each written out before the next is read (see write_table_chunks), and never opened
+# whole by the server either (see app.py)
+OUT_OF_CORE_TABLES = [t for t in os.environ.get('PHI_OUT_OF_CORE_TABLES', 'claims,imaging_studies').split(',') if t]
+BUILD_CHUNK_ROWS = int(os.environ.get('PHI_BUILD_CHUNK_ROWS', 250_000))
+
+# Bumped whenever the on-disk layout changes; older snapshots are rebuilt
+SNAPSHOT_FORMAT = 3
+
+CURRENT_FILE = 'CURRENT'
+PATIENT_ID_FILE = 'PATIENT_ID.ids.npy'
+VOCAB_DIR = 'vocab'
+META_FILE = 'meta.json'
+UTC = pd.DatetimeTZDtype(tz='UTC')
+
+logger = logging.getLogger('phi.snapshot')
+
+
+def csv_path(csv_dir, table):
+    return os.path.join(csv_dir, f'cleaned_{table}.csv')
+
+
+def source_fingerprint(csv_dir):
+    # Size and mtime of every source CSV; a snapshot is stale when this changes
+    sources = {}
+    for table in TABLES:
+        path = csv_path(csv_dir, table)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            sources[table] = {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+    return sources
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is a high-water mark in KiB on Linux, bytes on macOS
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if os.uname().sysname == 'Darwin' else usage * 1024
+
+
+# Helpers to convert a parsed column into the arrays stored on disk
+def _encode_column(series, name, spec):
+    if name in spec.get('dates', []):
+        values = pd.to_datetime(series, utc=True, errors='coerce')
+        return 'datetime', {'values': values.array.asi8}
+    if name in spec.get('numeric', []):
+        return 'numeric', {'values': pd.to_numeric(series, errors='coerce').to_numpy()}
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return 'numeric', {'values': series.to_numpy()}
+    cat = series.astype('category')
+    categories = np.asarray(cat.cat.categories.astype(str), dtype=str)
+    return 'category', {'codes': cat.cat.codes.to_numpy(), 'categories': categories}
+
+
+def write_table(df, table_dir, table):
+    # Write one DataFrame as a directory of .npy columns and return its column metadata
+    os.makedirs(table_dir, exist_ok=True)
+    spec = TABLES.get(table, {})
+    columns = []
+    for name in df.columns:
+        kind, arrays = _encode_column(df[name], name, spec)
+        for suffix, array in arrays.items():
+            np.save(os.path.join(table_dir, f'{name}.{suffix}.npy'), np.ascontiguousarray(array))
+        columns.append({'name': name, 'kind': kind})
+    return {'rows': int(len(df)), 'columns': columns}
+
+
+class _ColumnWriter:
+    # One column of a table written chunk by chunk: each chunk's encoded rows are appended to
+    # a .part file as they come (text as codes into a vocabulary grown in order of
+    # appearance), and the .npy is written once the row count and final dtype are known
+    def __init__(self, table_dir, name, spec):
+        self.table_dir, self.name, self.spec = table_dir, name, spec
+        self.reset()
+
+    def reset(self):
+        self.kind = None
+        self.mixed = False  # parsed as numbers in some chunks and as text in others
+        self.segments = []  # (dtype, rows) of each chunk in the .part file
+        self.vocabulary = {}
+        self.part = os.path.join(self.table_dir, f'.{self.name}.part')
+        with open(self.part, 'wb'):
+            pass
+
+    def add(self, series):
+        if self.mixed:
+            return
+        kind, arrays = _encode_column(series, self.name, self.spec)
+        if kind == 'category':
+            known = np.fromiter((self.vocabulary.setdefault(v, len(self.vocabulary)) for v in arrays['categories']),
+                                dtype=np.int32, count=len(arrays['categories']))
+            codes = arrays['codes']
+            values = np.where(codes >= 0, known[np.maximum(codes, 0)] if len(known) else -1, -1).astype(np.int32)
+        else:
+            values = np.ascontiguousarray(arrays['values'])
+        # Booleans next to other numbers (or missing values) are objects in a whole-file parse
+        if self.kind not in (None, kind) or (self.segments and (self.segments[0][0] == bool) != (values.dtype == bool)):
+            self.mixed = True
+            return
+        self.kind = kind
+        with open(self.part, 'ab') as f:
+            f.write(values.tobytes())
+        self.segments.append((values.dtype, len(values)))
+
+    def chunks(self, dtype):
+        # The .part file's rows converted to dtype, one chunk at a time
+        offset = 0
+        for segment_dtype, rows in self.segments:
+            if rows:
+                yield np.memmap(self.part, dtype=segment_dtype, mode='r', offset=offset, shape=(rows,)).astype(dtype)
+            offset += rows * segment_dtype.itemsize
+
+    def finish(self, rows):
+        # Write the .npy files of the column; -> its kind
+        if self.kind is None:
+            # No rows at all: text with no values, as a whole-file parse of the header gives
+            self.kind = 'category'
+        if self.kind == 'category':
+            categories = np.asarray(list(self.vocabulary), dtype=str)
+            order = np.argsort(categories, kind='stable')
+            rank = np.empty(len(order), dtype=np.int64)
+            rank[order] = np.arange(len(order))
+            np.save(os.path.join(self.table_dir, f'{self.name}.categories.npy'), categories[order])
+            suffix, dtype = 'codes', code_dtype(len(categories))
+            remap = lambda codes: np.where(codes >= 0, rank[np.maximum(codes, 0)] if len(rank) else -1, -1).astype(dtype)
+        else:
+            suffix = 'values'
+            dtype = np.result_type(*[d for d, _ in self.segments]) if self.kind == 'numeric' else np.dtype(np.int64)
+            remap = lambda values: values
+        path = os.path.join(self.table_dir, f'{self.name}.{suffix}.npy')
+        if not rows:
+            np.save(path, np.empty(0, dtype=dtype))
+        else:
+            out, start = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(rows,)), 0
+            for values in self.chunks(np.int64 if self.kind == 'category' else dtype):
+                out[start:start + len(values)] = remap(values)
+                start += len(values)
+            out.flush()
+            del out
+        os.remove(self.part)
+        return self.kind
+
+
+def write_table_chunks(path, table_dir, table, chunk_rows=BUILD_CHUNK_ROWS):
+    # write_table for a CSV read `chunk_rows` rows at a time, so that a table never has to
+    # fit in memory (only the vocabularies of its text columns do); -> its column metadata
+    os.makedirs(table_dir, exist_ok=True)
+    spec = TABLES.get(table, {})
+    names = list(pd.read_csv(path, nrows=0).columns)
+    columns = {name: _ColumnWriter(table_dir, name, spec) for name in names}
+    rows = 0
+    for chunk in pd.read_csv(path, chunksize=chunk_rows, low_memory=False):
+        for name in names:
+            columns[name].add(chunk[name])
+        rows += len(chunk)
+    # A column that only some chunks parse as numbers is text, as in a whole-file parse:
+    # those columns are read once more, alone and as strings
+    mixed = [name for name in names if columns[name].mixed]
+    if mixed:
+        for name in mixed:
+            columns[name].reset()
+        for chunk in pd.read_csv(path, chunksize=chunk_rows, usecols=mixed, dtype=str):
+            for name in mixed:
+                columns[name].add(chunk[name])
+    return {'rows': rows, 'columns': [{'name': name, 'kind': columns[name].finish(rows)} for name in names]}
+
+
+def npy_layout(path):
+    # -> (dtype, number of items in the header, byte offset of the data) of a .npy file
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran, dtype = read_header(f)
+        if fortran and len(shape) > 1:
+            raise ValueError(f"{path}: Fortran-ordered arrays are not supported")
+        return dtype, int(np.prod(shape)), f.tell()
+
+
+def map_rows(path, rows):
+    # The first `rows` items of a .npy column, memory-mapped read-only
+    dtype, _, offset = npy_layout(path)
+    if not rows:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(rows,))
+
+
+def alphabetical(values):
+    # A categorical Series with its categories in alphabetical order. Ingestion appends new
+    # values to a vocabulary (so existing codes never change), which leaves code order
+    # alphabetical only in a snapshot built from scratch: group and sort on this to get
+    # the same order either way.
+    categories = values.cat.categories
+    if categories.is_monotonic_increasing:
+        return values
+    return values.cat.reorder_categories(categories.sort_values())
+
+
+def category_ranks(categories):
+    # Alphabetical rank of each category, indexed by code
+    order = np.argsort(np.asarray(categories, dtype=str), kind='stable')
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    return ranks
+
+
+def code_dtype(n_categories):
+    # Same code width pandas picks for a Categorical with n categories
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def share_vocabularies(snapshot_path, meta, columns=SHARED_VOCABULARIES):
+    # Recode each shared column against the sorted union of its per-table categories
+    os.makedirs(os.path.join(snapshot_path, VOCAB_DIR), exist_ok=True)
+    for column in columns:
+        users = [(table, c) for table, info in meta['tables'].items()
+                 for c in info['columns'] if c['name'] == column and c['kind'] == 'category']
+        if not users:
+            continue
+        paths = {table: os.path.join(snapshot_path, table, column) for table, _ in users}
+        vocab = np.unique(np.concatenate([np.load(f'{p}.categories.npy') for p in paths.values()]))
+        for table, info in users:
+            old = np.load(f'{paths[table]}.categories.npy')
+            mapping = np.searchsorted(vocab, old)
+            codes = np.load(f'{paths[table]}.codes.npy')
+            recoded = np.where(codes >= 0, mapping[np.maximum(codes, 0)], -1).astype(code_dtype(len(vocab)))
+            np.save(f'{paths[table]}.codes.npy', recoded)
+            os.remove(f'{paths[table]}.categories.npy')
+            info['vocabulary'] = column
+        np.save(os.path.join(snapshot_path, VOCAB_DIR, f'{column}.categories.npy'), vocab)
+
+
+def assign_patient_ids(snapshot_path, meta):
+    # Dense patient id (= row position in patients) for every row of every table with a
+    # patient key, stored next to the table as int32 so joins become array gathers
+    patients = meta['tables'].get('patients')
+    if patients is None:
+        return
+    id_path = os.path.join(snapshot_path, 'patients', 'Id')
+    id_categories = np.load(f'{id_path}.categories.npy')
+    position = np.full(len(id_categories), -1, dtype=np.int32)
+    id_codes = np.load(f'{id_path}.codes.npy')
+    position[id_codes[id_codes >= 0]] = np.flatnonzero(id_codes >= 0)
+    for table, info in meta['tables'].items():
+        key = PATIENT_KEYS.get(table, 'PATIENT')
+        if table == 'patients' or not any(c['name'] == key and c['kind'] == 'category' for c in info['columns']):
+            continue
+        key_path = os.path.join(snapshot_path, table, key)
+        lookup = pd.Index(id_categories).get_indexer(np.load(f'{key_path}.categories.npy'))
+        lookup = np.where(lookup >= 0, position[np.maximum(lookup, 0)], -1)
+        codes = np.load(f'{key_path}.codes.npy')
+        ids = np.where(codes >= 0, lookup[np.maximum(codes, 0)], -1).astype(np.int32)
+        np.save(os.path.join(snapshot_path, table, PATIENT_ID_FILE), ids)
+        info['patient_key'] = key
+        # Rows whose patient is not known (yet); ingestion links them when the patient arrives
+        info['unlinked'] = int((ids < 0).sum())
+
+
+def build_snapshot(csv_dir, snapshot_dir, tables=None):
+    # Parse the cleaned CSVs and publish them as a new snapshot version
+    started = time.perf_counter()
+    sources = source_fingerprint(csv_dir)
+    tables = [t for t in (tables or TABLES) if t in sources]
+    if not tables:
+        raise FileNotFoundError(f"No cleaned_*.csv files found in {csv_dir}")
+
+    digest = hashlib.sha1(json.dumps(sources, sort_keys=True).encode()).hexdigest()[:8]
+    version = f"{time.strftime('%Y%m%d%H%M%S')}-{digest}"
+    staging = os.path.join(snapshot_dir, f'.{version}.tmp')
+    shutil.rmtree(staging, ignore_errors=True)
+
+    meta = {'version': version, 'format': SNAPSHOT_FORMAT, 'built_at': time.time(), 'csv_dir': os.path.abspath(csv_dir),
+            'sources': sources, 'tables': {}}
+    for table in tables:
+        table_started = time.perf_counter()
+        if table in OUT_OF_CORE_TABLES:
+            meta['tables'][table] = write_table_chunks(csv_path(csv_dir, table), os.path.join(staging, table), table)
+        else:
+            df = pd.read_csv(csv_path(csv_dir, table), low_memory=False)
+            meta['tables'][table] = write_table(df, os.path.join(staging, table), table)
+            del df
+        meta['tables'][table]['build_seconds'] = round(time.perf_counter() - table_started, 3)
+    share_vocabularies(staging, meta)
+    assign_patient_ids(staging, meta)
+
+    with open(os.path.join(staging, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(staging, os.path.join(snapshot_dir, version))
+    publish_version(snapshot_dir, version)
+    logger.info("Built snapshot %s in %.1fs", version, time.perf_counter() - started)
+    return version
+
+
+def publish_version(snapshot_dir, version):
+    # Point CURRENT at a version directory; os.replace makes the switch atomic
+    tmp = os.path.join(snapshot_dir, f'.{CURRENT_FILE}.{os.getpid()}')
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(snapshot_dir, CURRENT_FILE))
+
+
+def current_version(snapshot_dir):
+    try:
+        with open(os.path.join(snapshot_dir, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+# Columns derived when a table is opened (cheap, vectorized, and depend on "now")
+def _derive_patients(df):
+    today = pd.Timestamp.now(tz='UTC')
+    df['AGE'] = (today - df['BIRTHDATE']).dt.days // 365
+    return df
+
+
+DERIVED = {'patients': _derive_patients}
+
+
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.version = self.meta['version']
+        self.stats = {}
+        self._tables = {}
+        self._derived = {}
+        self._vocabularies = {}
+        self._lock = threading.RLock()
+
+    @property
+    def table_names(self):
+        return list(self.meta['tables'])
+
+    def __getattr__(self, name):
+        # snapshot.patients, snapshot.conditions, ... open the table on first access
+        tables = self.__dict__.get('meta', {}).get('tables', {})
+        if name.startswith('_') or name not in tables:
+            raise AttributeError(name)
+        return self.table(name)
+
+    def table(self, name):
+        df = self._tables.get(name)
+        if df is None:
+            with self._lock:
+                df = self._tables.get(name)
+                if df is None:
+                    with stage('load'):
+                        df = self._load(name)
+                    self._tables[name] = df
+        return df
+
+    def vocabulary(self, column):
+        # One CategoricalDtype per shared column, reused by every table that has it
+        dtype = self._vocabularies.get(column)
+        if dtype is None:
+            with self._lock:
+                dtype = self._vocabularies.get(column)
+                if dtype is None:
+                    path = os.path.join(self.path, VOCAB_DIR, f'{column}.categories.npy')
+                    dtype = pd.CategoricalDtype(pd.Index(np.load(path), dtype=object))
+                    self._vocabularies[column] = dtype
+        return dtype
+
+    def derived(self, name, build):
+        # Memoize an index or aggregate computed from this snapshot's tables
+        value = self._derived.get(name)
+        if value is None:
+            with self._lock:
+                value = self._derived.get(name)
+                if value is None:
+                    started = time.perf_counter()
+                    with stage('load'):
+                        value = build()
+                    self._derived[name] = value
+                    self.stats[name] = {'build_seconds': round(time.perf_counter() - started, 4)}
+        return value
+
+    def patient_ids(self, table):
+        # Dense patient id per row of `table` (-1 when the key is not a known patient)
+        if table == 'patients':
+            return self.derived('patients.PATIENT_ID', lambda: np.arange(len(self.patients), dtype=np.int32))
+        if 'patient_key' not in self.meta['tables'].get(table, {}):
+            raise KeyError(f"Table '{table}' has no patient key")
+        rows = self.meta['tables'][table]['rows']
+        return self.derived(f'{table}.PATIENT_ID', lambda: map_rows(os.path.join(self.path, table, PATIENT_ID_FILE), rows))
+
+    def cached_derived(self, name):
+        # The memoized value of `name`, or None when it has not been built
+        return self._derived.get(name)
+
+    def derived_names(self):
+        return list(self._derived)
+
+    def set_derived(self, name, value):
+        # Seed a derived value computed elsewhere (e.g. carried over from the previous version)
+        with self._lock:
+            self._derived.setdefault(name, value)
+
+    def _column(self, table_dir, column, rows):
+        name, kind = column['name'], column['kind']
+        load = lambda suffix: map_rows(os.path.join(table_dir, f'{name}.{suffix}.npy'), rows)
+        if kind == 'datetime':
+            # _simple_new wraps the mapped int64 buffer without copying it
+            values = pd.arrays.DatetimeArray._simple_new(load('values').view('M8[ns]'), dtype=UTC)
+            return pd.Series(values, name=name, copy=False)
+        if kind == 'category':
+            if 'vocabulary' in column:
+                dtype = self.vocabulary(column['vocabulary'])
+            else:
+                dtype = pd.CategoricalDtype(pd.Index(np.load(os.path.join(table_dir, f'{name}.categories.npy')), dtype=object))
+            values = pd.Categorical.from_codes(load('codes'), dtype=dtype, validate=False)
+            return pd.Series(values, name=name, copy=False)
+        return pd.Series(load('values'), name=name, copy=False)
+
+    def _load(self, name):
+        started = time.perf_counter()
+        rss_before = rss_bytes()
+        table_dir = os.path.join(self.path, name)
+        info = self.meta['tables'][name]
+        columns = {c['name']: self._column(table_dir, c, info['rows']) for c in info['columns']}
+        df = pd.DataFrame(columns, copy=False)
+        if name in DERIVED:
+            df = DERIVED[name](df)
+        mapped = sum(os.path.getsize(os.path.join(table_dir, f)) for f in os.listdir(table_dir))
+        self.stats[name] = {
+            'rows': info['rows'],
+            'load_seconds': round(time.perf_counter() - started, 4),
+            'mapped_bytes': mapped,
+            'rss_delta_bytes': rss_bytes() - rss_before,
+        }
+        return df
+
+    def load_all(self, exclude=()):
+        for name in self.table_names:
+            if name not in exclude:
+                self.table(name)
+        return self.stats
+
+
+def open_snapshot(snapshot_dir, csv_dir=None, rebuild_stale=True):
+    # Open the published snapshot, building it from csv_dir when missing or stale
+    os.makedirs(snapshot_dir, exist_ok=True)
+    version = current_version(snapshot_dir)
+    if version is not None and csv_dir is not None and rebuild_stale:
+        with open(os.path.join(snapshot_dir, version, META_FILE)) as f:
+            meta = json.load(f)
+        sources = source_fingerprint(csv_dir)
+        if sources and sources != meta['sources']:
+            logger.info("Source CSVs changed since snapshot %s, rebuilding", version)
+            version = None
+        elif sources and meta.get('format') != SNAPSHOT_FORMAT:
+            logger.info("Snapshot %s uses an older layout, rebuilding", version)
+            version = None
+    if version is None:
+        if csv_dir is None:
+            raise FileNotFoundError(f"No snapshot published in {snapshot_dir}")
+        version = build_snapshot(csv_dir, snapshot_dir)
+    return Snapshot(os.path.join(snapshot_dir, version))
+
+
+def format_stats(snapshot):
+    lines = [f"{'table':<18}{'rows':>12}{'load ms':>10}{'mapped MiB':>12}{'rss MiB':>10}"]
+    derived = []
+    for name, s in snapshot.stats.items():
+        if 'rows' not in s:
+            derived.append(f"{name:<40}{s['build_seconds'] * 1000:>10.1f}")
+            continue
+        lines.append(f"{name:<18}{s['rows']:>12}{s['load_seconds'] * 1000:>10.1f}"
+                     f"{s['mapped_bytes'] / 2**20:>12.1f}{s['rss_delta_bytes'] / 2**20:>10.1f}")
+    if derived:
+        lines += ['', f"{'derived':<40}{'build ms':>10}"] + derived
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Build or inspect the columnar data snapshot')
+    parser.add_argument('command', choices=['build', 'stats'])
+    parser.add_argument('--csv-dir', default=os.environ.get('PHI_DATA_DIR', os.path.join(here, 'csv')))
+    parser.add_argument('--snapshot-dir', default=os.environ.get('PHI_SNAPSHOT_DIR', os.path.join(here, 'snapshot')))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.command == 'build':
+        os.makedirs(args.snapshot_dir, exist_ok=True)
+        build_snapshot(args.csv_dir, args.snapshot_dir)
+    snap = open_snapshot(args.snapshot_dir, rebuild_stale=False)
+    snap.load_all()
+    print(f"Snapshot {snap.version}")
+    print(format_stats(snap))
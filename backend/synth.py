@@ -0,0 +1,411 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# Generates schema-compatible cleaned_*.csv files so the backend can be run and
+# benchmarked without the original Synthea export. Rows are produced in blocks of
+# patients so memory stays flat even at 1M+ patients.
+#
+# Cardinalities follow a Synthea export: a few hundred distinct conditions and medications
+# (a head of common codes plus a Zipf-distributed tail), organizations and cities growing
+# with the population, and tens of rows per patient in the clinical tables.
+#
+#   python synth.py --patients 100000 --out /data/synth-100k
+
+GENDERS = ['M', 'F']
+RACES = ['white', 'black', 'asian', 'native', 'hawaiian', 'other']
+ETHNICITIES = ['nonhispanic', 'hispanic']
+STATES = ['Massachusetts', 'New York', 'California', 'Texas', 'Florida', 'Ohio', 'Washington', 'Illinois']
+# Cities per state grow with sqrt(patients) between these bounds
+MIN_CITIES_PER_STATE = 10
+MAX_CITIES_PER_STATE = 400
+ENCOUNTER_CLASSES = ['wellness', 'ambulatory', 'outpatient', 'emergency', 'inpatient', 'urgentcare']
+ENCOUNTER_CLASS_WEIGHTS = [0.35, 0.3, 0.2, 0.07, 0.05, 0.03]
+ORGANIZATIONS_PER_1K = 12
+PAYERS = ['Medicare', 'Medicaid', 'Blue Cross Blue Shield', 'Aetna', 'UnitedHealthcare', 'Humana', 'Cigna', 'NO_INSURANCE']
+
+CONDITIONS = [
+    ('44054006', 'Diabetes mellitus type 2 (disorder)', True),
+    ('38341003', 'Hypertension (disorder)', True),
+    ('55822004', 'Hyperlipidemia (disorder)', True),
+    ('195662009', 'Acute viral pharyngitis (disorder)', False),
+    ('10509002', 'Acute bronchitis (disorder)', False),
+    ('444814009', 'Viral sinusitis (disorder)', False),
+    ('40055000', 'Chronic sinusitis (disorder)', True),
+    ('233604007', 'Pneumonia (disorder)', False),
+    ('840539006', 'Disease caused by severe acute respiratory syndrome coronavirus 2 (disorder)', False),
+    ('15777000', 'Prediabetes (finding)', True),
+    ('162864005', 'Body mass index 30+ - obesity (finding)', True),
+    ('195967001', 'Asthma (disorder)', True),
+    ('13645005', 'Chronic obstructive lung disease (disorder)', True),
+    ('49727002', 'Cough (finding)', False),
+    ('68496003', 'Polyp of colon (disorder)', False),
+    ('283371005', 'Laceration of forearm (disorder)', False),
+    ('44465007', 'Sprain of ankle (disorder)', False),
+    ('65363002', 'Otitis media (disorder)', False),
+    ('314529007', 'Medication review due (situation)', False),
+    ('73595000', 'Stress (finding)', False),
+    ('160903007', 'Full-time employment (finding)', False),
+    ('399211009', 'History of myocardial infarction (situation)', True),
+    ('53741008', 'Coronary heart disease (disorder)', True),
+    ('59621000', 'Essential hypertension (disorder)', True),
+    ('46177005', 'End-stage renal disease (disorder)', True),
+    ('431855005', 'Chronic kidney disease stage 1 (disorder)', True),
+    ('80394007', 'Hyperglycemia (disorder)', False),
+    ('36971009', 'Sinusitis (disorder)', False),
+    ('301011002', 'Escherichia coli urinary tract infection', False),
+    ('386661006', 'Fever (finding)', False),
+]
+
+MEDICATIONS = [
+    ('860975', 'Metformin hydrochloride 500 MG Extended Release Oral Tablet', 25.0),
+    ('314076', 'lisinopril 10 MG Oral Tablet', 12.0),
+    ('259255', 'atorvastatin 80 MG Oral Tablet', 30.0),
+    ('308136', 'amlodipine 2.5 MG Oral Tablet', 10.0),
+    ('313782', 'Acetaminophen 325 MG Oral Tablet', 4.0),
+    ('834061', 'Penicillin V Potassium 250 MG Oral Tablet', 9.0),
+    ('895994', '120 ACTUAT fluticasone propionate 0.044 MG/ACTUAT Metered Dose Inhaler', 70.0),
+    ('310965', 'Ibuprofen 200 MG Oral Tablet', 3.0),
+    ('106892', 'insulin isophane  human 70 UNT/ML / insulin  regular  human 30 UNT/ML Injectable Suspension', 120.0),
+    ('197361', 'Amlodipine 5 MG Oral Tablet', 11.0),
+    ('1000126', '1 ML medroxyprogesterone acetate 150 MG/ML Injection', 40.0),
+    ('749762', 'Seasonique 91 Day Pack', 95.0),
+]
+
+OBSERVATIONS = [
+    ('4548-4', 'Hemoglobin A1c/Hemoglobin.total in Blood', '%', 6.0, 1.2),
+    ('8302-2', 'Body Height', 'cm', 165.0, 15.0),
+    ('29463-7', 'Body Weight', 'kg', 78.0, 18.0),
+    ('39156-5', 'Body mass index (BMI) [Ratio]', 'kg/m2', 28.0, 5.0),
+    ('8462-4', 'Diastolic Blood Pressure', 'mm[Hg]', 80.0, 10.0),
+    ('8480-6', 'Systolic Blood Pressure', 'mm[Hg]', 125.0, 15.0),
+    ('8867-4', 'Heart rate', '/min', 75.0, 12.0),
+    ('9279-1', 'Respiratory rate', '/min', 15.0, 2.0),
+    ('2339-0', 'Glucose [Mass/volume] in Blood', 'mg/dL', 100.0, 25.0),
+    ('2093-3', 'Cholesterol [Mass/volume] in Serum or Plasma', 'mg/dL', 190.0, 35.0),
+    ('2571-8', 'Triglycerides', 'mg/dL', 140.0, 50.0),
+    ('18262-6', 'Low Density Lipoprotein Cholesterol', 'mg/dL', 110.0, 30.0),
+    ('2085-9', 'High Density Lipoprotein Cholesterol', 'mg/dL', 55.0, 12.0),
+    ('72166-2', 'Tobacco smoking status', None, None, None),
+]
+
+IMMUNIZATIONS = [
+    ('140', 'Influenza  seasonal  injectable  preservative free', 140.52),
+    ('113', 'Td (adult) preservative free', 140.52),
+    ('133', 'Pneumococcal conjugate PCV 13', 140.52),
+    ('208', 'SARS-COV-2 (COVID-19) vaccine  mRNA  spike protein  LNP  preservative free  30 mcg/0.3mL dose', 140.52),
+    ('62', 'HPV  quadrivalent', 140.52),
+]
+
+# Rarer codes after the common ones above, with Zipf-like frequencies
+TAIL_CONDITIONS = 170
+TAIL_MEDICATIONS = 250
+TAIL_OBSERVATIONS = 40
+TAIL_SHARE = 0.1
+
+CONDITIONS = CONDITIONS + [
+    (str(900000000 + i), f'Rare condition {i} (disorder)', i % 3 == 0) for i in range(TAIL_CONDITIONS)]
+MEDICATIONS = MEDICATIONS + [
+    (str(990000 + i), f'Compound {i} {5 * (1 + i % 20)} MG Oral Tablet', 5.0 + i % 50) for i in range(TAIL_MEDICATIONS)]
+# The text observation (smoking status) stays last
+OBSERVATIONS = OBSERVATIONS[:-1] + [
+    (f'9{i:04d}-0', f'Laboratory test {i} [Mass/volume] in Serum or Plasma', 'mg/dL', 20.0 + 7 * i, 2.0 + i % 9)
+    for i in range(TAIL_OBSERVATIONS)] + OBSERVATIONS[-1:]
+
+MODALITIES = [('DX', 'Digital Radiography'), ('CT', 'Computed Tomography'), ('US', 'Ultrasound'), ('MR', 'Magnetic Resonance')]
+BODY_SITES = [('51185008', 'Thoracic structure (body structure)'), ('8205005', 'Wrist'), ('70258002', 'Ankle joint structure'), ('40983000', 'Arm')]
+
+HISTORY_START = pd.Timestamp('2010-01-01', tz='UTC').value
+HISTORY_END = pd.Timestamp('2025-03-17', tz='UTC').value
+DAY_NS = 86_400 * 10**9
+
+# Mean rows per patient for each child table
+ROWS_PER_PATIENT = {
+    'conditions': 8,
+    'encounters': 30,
+    'medications': 10,
+    'observations': 60,
+    'imaging_studies': 0.3,
+    'immunizations': 5,
+}
+
+
+_HEX = np.frombuffer(b'0123456789abcdef', dtype='S1')
+_UUID_DIGITS = [i for i in range(36) if i not in (8, 13, 18, 23)]
+
+
+def uuids(rng, n):
+    # Random UUID-formatted strings, built without a Python loop
+    raw = rng.integers(0, 256, size=(n, 16), dtype=np.uint8)
+    chars = np.full((n, 36), b'-', dtype='S1')
+    chars[:, _UUID_DIGITS] = np.stack([_HEX[raw >> 4], _HEX[raw & 15]], axis=2).reshape(n, 32)
+    return chars.view('S36').ravel().astype(str)
+
+
+def iso(ns):
+    # 2020-01-31T12:00:00Z
+    seconds = np.asarray(ns, dtype=np.int64).astype('datetime64[ns]').astype('datetime64[s]')
+    return np.char.add(np.datetime_as_string(seconds, unit='s'), 'Z')
+
+
+def _zipf(head, tail, share):
+    # Probabilities: a linear head carrying 1 - share, a Zipf tail carrying share
+    head_p = np.linspace(2.0, 0.3, head)
+    tail_p = 1.0 / np.arange(1, tail + 1) ** 1.1
+    p = np.concatenate([head_p / head_p.sum() * (1 - share), tail_p / tail_p.sum() * share if tail else []])
+    return p / p.sum()
+
+
+def _children(rng, n_patients, mean):
+    # Number of child rows per patient and the owning patient index of each row
+    counts = rng.poisson(mean, size=n_patients)
+    return np.repeat(np.arange(n_patients), counts)
+
+
+def _write(df, path, first):
+    df.to_csv(path, mode='w' if first else 'a', header=first, index=False)
+
+
+def generate(n_patients, out_dir, seed=0, block=20_000):
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_orgs = max(3, n_patients * ORGANIZATIONS_PER_1K // 1000)
+    organizations = uuids(rng, min(n_orgs, 5000))
+    providers = uuids(rng, min(n_orgs * 5, 20000))
+    payers = uuids(rng, len(PAYERS))
+    cities_per_state = int(np.clip(np.sqrt(n_patients) / 2, MIN_CITIES_PER_STATE, MAX_CITIES_PER_STATE))
+    cities = {s: [f'{s[:3]}ville {i}' for i in range(cities_per_state)] for s in STATES}
+
+    cond_codes = np.array([c[0] for c in CONDITIONS])
+    cond_desc = np.array([c[1] for c in CONDITIONS], dtype=object)
+    cond_chronic = np.array([c[2] for c in CONDITIONS])
+    cond_p = _zipf(len(CONDITIONS) - TAIL_CONDITIONS, TAIL_CONDITIONS, TAIL_SHARE)
+    med_p = _zipf(len(MEDICATIONS) - TAIL_MEDICATIONS, TAIL_MEDICATIONS, TAIL_SHARE)
+    # Vital signs and the common labs are equally frequent (HbA1c less so), the tail labs rarer
+    obs_p = np.ones(len(OBSERVATIONS))
+    obs_p[0] = 0.4
+    obs_p[len(OBSERVATIONS) - 1 - TAIL_OBSERVATIONS:-1] = 0.1
+    obs_p /= obs_p.sum()
+
+    paths = {name: os.path.join(out_dir, f'cleaned_{name}.csv') for name in
+             ['patients', 'conditions', 'encounters', 'medications', 'observations',
+              'claims', 'imaging_studies', 'immunizations']}
+
+    for offset in range(0, n_patients, block):
+        first = offset == 0
+        n = min(block, n_patients - offset)
+
+        # Patients
+        pid = uuids(rng, n)
+        birth = HISTORY_END - rng.integers(0, 95 * 365, size=n) * DAY_NS
+        state = rng.choice(STATES, size=n)
+        city = np.array([cities[s][i] for s, i in zip(state, rng.integers(0, cities_per_state, size=n))], dtype=object)
+        deceased = rng.random(n) < 0.05
+        death = np.where(deceased, HISTORY_END - rng.integers(0, 5 * 365, size=n) * DAY_NS, 0)
+        patients = pd.DataFrame({
+            'Id': pid,
+            'BIRTHDATE': pd.to_datetime(birth, utc=True).strftime('%Y-%m-%d'),
+            'DEATHDATE': np.where(deceased, pd.to_datetime(death, utc=True).strftime('%Y-%m-%d'), ''),
+            'FIRST': np.char.add('Patient', np.arange(offset, offset + n).astype(str)),
+            'LAST': rng.choice(['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller'], size=n),
+            'MARITAL': rng.choice(['M', 'S', 'D', 'W'], size=n),
+            'RACE': rng.choice(RACES, size=n, p=[0.6, 0.13, 0.1, 0.02, 0.01, 0.14]),
+            'ETHNICITY': rng.choice(ETHNICITIES, size=n, p=[0.82, 0.18]),
+            'GENDER': rng.choice(GENDERS, size=n),
+            'CITY': city,
+            'STATE': state,
+            'COUNTY': np.char.add(state.astype(str), ' County'),
+            'ZIP': rng.integers(1000, 99999, size=n).astype(str),
+            'LAT': rng.uniform(25, 48, size=n).round(6),
+            'LON': rng.uniform(-122, -70, size=n).round(6),
+            'HEALTHCARE_EXPENSES': rng.gamma(2.0, 250_000, size=n).round(2),
+            'HEALTHCARE_COVERAGE': rng.gamma(2.0, 20_000, size=n).round(2),
+            'INCOME': rng.integers(15_000, 250_000, size=n),
+        })
+        _write(patients, paths['patients'], first)
+
+        # Encounters
+        owner = _children(rng, n, ROWS_PER_PATIENT['encounters'])
+        m = len(owner)
+        enc_id = uuids(rng, m)
+        enc_start = rng.integers(np.maximum(birth[owner], HISTORY_START), HISTORY_END)
+        enc_class = rng.choice(ENCOUNTER_CLASSES, size=m, p=ENCOUNTER_CLASS_WEIGHTS)
+        duration = np.where(enc_class == 'inpatient', rng.integers(1, 10, size=m) * DAY_NS,
+                            rng.integers(15, 120, size=m) * 60 * 10**9)
+        enc_stop = enc_start + duration
+        base_cost = rng.choice([85.55, 129.16, 136.8, 146.18, 77.49], size=m)
+        total_cost = (base_cost * rng.uniform(1.0, 12.0, size=m)).round(2)
+        coverage = (total_cost * rng.uniform(0.0, 1.0, size=m)).round(2)
+        encounters = pd.DataFrame({
+            'Id': enc_id,
+            'START': iso(enc_start),
+            'STOP': iso(enc_stop),
+            'PATIENT': pid[owner],
+            'ORGANIZATION': rng.choice(organizations, size=m),
+            'PROVIDER': rng.choice(providers, size=m),
+            'PAYER': rng.choice(payers, size=m),
+            'ENCOUNTERCLASS': enc_class,
+            'CODE': rng.choice(['185349003', '162673000', '410620009', '50849002'], size=m),
+            'DESCRIPTION': rng.choice(['Encounter for check up (procedure)', 'General examination of patient (procedure)',
+                                       'Well child visit (procedure)', 'Emergency room admission (procedure)'], size=m),
+            'BASE_ENCOUNTER_COST': base_cost,
+            'TOTAL_CLAIM_COST': total_cost,
+            'PAYER_COVERAGE': coverage,
+            'REASONCODE': '',
+            'REASONDESCRIPTION': '',
+        })
+        _write(encounters, paths['encounters'], first)
+
+        # Claims: one per encounter
+        claim_dept = rng.integers(1, 40, size=m)
+        outstanding = (total_cost - coverage).round(2)
+        claims = pd.DataFrame({
+            'Id': uuids(rng, m),
+            'PATIENTID': pid[owner],
+            'PROVIDERID': encounters['PROVIDER'].to_numpy(),
+            'PRIMARYPATIENTINSURANCEID': encounters['PAYER'].to_numpy(),
+            'SECONDARYPATIENTINSURANCEID': '0',
+            'DEPARTMENTID': claim_dept,
+            'PATIENTDEPARTMENTID': claim_dept,
+            'DIAGNOSIS1': rng.choice(cond_codes, size=m),
+            'APPOINTMENTID': enc_id,
+            'CURRENTILLNESSDATE': iso(enc_start),
+            'SERVICEDATE': iso(enc_start),
+            'SUPERVISINGPROVIDERID': encounters['PROVIDER'].to_numpy(),
+            'STATUS1': rng.choice(['CLOSED', 'BILLED'], size=m, p=[0.9, 0.1]),
+            'STATUS2': '',
+            'STATUSP': rng.choice(['CLOSED', 'BILLED'], size=m, p=[0.9, 0.1]),
+            'OUTSTANDING1': np.where(rng.random(m) < 0.1, outstanding, 0.0),
+            'OUTSTANDING2': 0.0,
+            'OUTSTANDINGP': np.where(rng.random(m) < 0.1, outstanding, 0.0),
+            'LASTBILLEDDATE1': iso(enc_stop),
+            'LASTBILLEDDATE2': '',
+            'LASTBILLEDDATEP': iso(enc_stop),
+            'HEALTHCARECLAIMTYPEID1': 1,
+            'HEALTHCARECLAIMTYPEID2': 0,
+        })
+        _write(claims, paths['claims'], first)
+
+        # Conditions: attached to one of the patient's encounters
+        per_patient_enc = np.bincount(owner, minlength=n)
+        first_enc = np.concatenate([[0], np.cumsum(per_patient_enc)[:-1]])
+        c_owner = _children(rng, n, ROWS_PER_PATIENT['conditions'])
+        c_owner = c_owner[per_patient_enc[c_owner] > 0]
+        k = len(c_owner)
+        c_enc = first_enc[c_owner] + (rng.random(k) * per_patient_enc[c_owner]).astype(np.int64)
+        c_pick = rng.choice(len(CONDITIONS), size=k, p=cond_p)
+        c_start = enc_start[c_enc]
+        ongoing = cond_chronic[c_pick] | (rng.random(k) < 0.03)
+        c_stop = c_start + rng.integers(5, 60, size=k) * DAY_NS
+        conditions = pd.DataFrame({
+            'START': iso(c_start),
+            'STOP': np.where(ongoing, '', iso(c_stop)),
+            'PATIENT': pid[c_owner],
+            'ENCOUNTER': enc_id[c_enc],
+            'CODE': cond_codes[c_pick],
+            'DESCRIPTION': cond_desc[c_pick],
+        })
+        _write(conditions, paths['conditions'], first)
+
+        # Medications
+        md_owner = _children(rng, n, ROWS_PER_PATIENT['medications'])
+        md_owner = md_owner[per_patient_enc[md_owner] > 0]
+        k = len(md_owner)
+        md_enc = first_enc[md_owner] + (rng.random(k) * per_patient_enc[md_owner]).astype(np.int64)
+        md_pick = rng.choice(len(MEDICATIONS), size=k, p=med_p)
+        md_base = np.array([x[2] for x in MEDICATIONS])[md_pick]
+        dispenses = rng.integers(1, 24, size=k)
+        md_start = enc_start[md_enc]
+        medications = pd.DataFrame({
+            'START': iso(md_start),
+            'STOP': np.where(rng.random(k) < 0.2, '', iso(md_start + dispenses * 30 * DAY_NS)),
+            'PATIENT': pid[md_owner],
+            'PAYER': encounters['PAYER'].to_numpy()[md_enc],
+            'ENCOUNTER': enc_id[md_enc],
+            'CODE': np.array([x[0] for x in MEDICATIONS])[md_pick],
+            'DESCRIPTION': np.array([x[1] for x in MEDICATIONS], dtype=object)[md_pick],
+            'BASE_COST': md_base,
+            'PAYER_COVERAGE': (md_base * dispenses * rng.uniform(0, 1, size=k)).round(2),
+            'DISPENSES': dispenses,
+            'TOTALCOST': (md_base * dispenses).round(2),
+            'REASONCODE': '',
+            'REASONDESCRIPTION': '',
+        })
+        _write(medications, paths['medications'], first)
+
+        # Observations
+        o_owner = _children(rng, n, ROWS_PER_PATIENT['observations'])
+        o_owner = o_owner[per_patient_enc[o_owner] > 0]
+        k = len(o_owner)
+        o_enc = first_enc[o_owner] + (rng.random(k) * per_patient_enc[o_owner]).astype(np.int64)
+        o_pick = rng.choice(len(OBSERVATIONS), size=k, p=obs_p)
+        means = np.array([o[3] if o[3] is not None else np.nan for o in OBSERVATIONS])[o_pick]
+        sds = np.array([o[4] if o[4] is not None else np.nan for o in OBSERVATIONS])[o_pick]
+        values = (means + rng.standard_normal(k) * sds).round(1).astype(str)
+        numeric = ~np.isnan(means)
+        values = np.where(numeric, values, rng.choice(['Never smoked tobacco (finding)', 'Former smoker (finding)'], size=k))
+        observations = pd.DataFrame({
+            'DATE': iso(enc_start[o_enc]),
+            'PATIENT': pid[o_owner],
+            'ENCOUNTER': enc_id[o_enc],
+            'CATEGORY': np.where(numeric, 'vital-signs', 'survey'),
+            'CODE': np.array([o[0] for o in OBSERVATIONS])[o_pick],
+            'DESCRIPTION': np.array([o[1] for o in OBSERVATIONS], dtype=object)[o_pick],
+            'VALUE': values,
+            'UNITS': np.array([o[2] or '{nominal}' for o in OBSERVATIONS])[o_pick],
+            'TYPE': np.where(numeric, 'numeric', 'text'),
+        })
+        _write(observations, paths['observations'], first)
+
+        # Imaging studies
+        i_owner = _children(rng, n, ROWS_PER_PATIENT['imaging_studies'])
+        i_owner = i_owner[per_patient_enc[i_owner] > 0]
+        k = len(i_owner)
+        i_enc = first_enc[i_owner] + (rng.random(k) * per_patient_enc[i_owner]).astype(np.int64)
+        mod = rng.integers(0, len(MODALITIES), size=k)
+        site = rng.integers(0, len(BODY_SITES), size=k)
+        imaging = pd.DataFrame({
+            'Id': uuids(rng, k),
+            'DATE': iso(enc_start[i_enc]),
+            'PATIENT': pid[i_owner],
+            'ENCOUNTER': enc_id[i_enc],
+            'SERIES_UID': uuids(rng, k),
+            'BODYSITE_CODE': np.array([b[0] for b in BODY_SITES])[site],
+            'BODYSITE_DESCRIPTION': np.array([b[1] for b in BODY_SITES])[site],
+            'MODALITY_CODE': np.array([x[0] for x in MODALITIES])[mod],
+            'MODALITY_DESCRIPTION': np.array([x[1] for x in MODALITIES])[mod],
+            'PROCEDURE_CODE': rng.choice(['399208008', '169069000', '241615005'], size=k),
+        })
+        _write(imaging, paths['imaging_studies'], first)
+
+        # Immunizations
+        im_owner = _children(rng, n, ROWS_PER_PATIENT['immunizations'])
+        im_owner = im_owner[per_patient_enc[im_owner] > 0]
+        k = len(im_owner)
+        im_enc = first_enc[im_owner] + (rng.random(k) * per_patient_enc[im_owner]).astype(np.int64)
+        im_pick = rng.integers(0, len(IMMUNIZATIONS), size=k)
+        immunizations = pd.DataFrame({
+            'DATE': iso(enc_start[im_enc]),
+            'PATIENT': pid[im_owner],
+            'ENCOUNTER': enc_id[im_enc],
+            'CODE': np.array([x[0] for x in IMMUNIZATIONS])[im_pick],
+            'DESCRIPTION': np.array([x[1] for x in IMMUNIZATIONS], dtype=object)[im_pick],
+            'BASE_COST': np.array([x[2] for x in IMMUNIZATIONS])[im_pick],
+        })
+        _write(immunizations, paths['immunizations'], first)
+
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic cleaned_*.csv tables')
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--out', default='csv')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    generate(args.patients, args.out, seed=args.seed)
+    print(f"Generated {args.patients} patients in {time.perf_counter() - started:.1f}s -> {args.out}")
@@ -0,0 +1,38 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+# The backend modules are imported by name, as app.py and wsgi.py import them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synth import generate  # noqa: E402
+
+PATIENTS = 300
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    # app.py configured at import from the environment: a generated dataset, the response
+    # cache in a temporary directory (off unless a test turns it on) and one forecast worker
+    root = tmp_path_factory.mktemp('app')
+    generate(PATIENTS, str(root / 'csv'))
+    with pytest.MonkeyPatch.context() as mp:
+        for name, value in {'PHI_DATA_DIR': root / 'csv', 'PHI_SNAPSHOT_DIR': root / 'snapshot',
+                            'PHI_CACHE_DIR': root / 'cache', 'PHI_CACHE': '0', 'PHI_REPORT_DIR': root / 'reports',
+                            'PHI_INGEST_DIR': root / 'incoming', 'PHI_VOCAB_RULES': root / 'vocabulary.json',
+                            'PHI_ADMIN_TOKEN': 'test-token', 'PHI_FORECAST_WORKERS': '1',
+                            'PHI_SNAPSHOT_POLL': '3600'}.items():
+            mp.setenv(name, str(value))
+        for name in ('PHI_METRICS_DIR', 'PHI_PROFILE_DIR'):
+            mp.delenv(name, raising=False)
+        module = importlib.import_module('app')
+    module.app.testing = True
+    yield module
+    module.forecaster.close()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
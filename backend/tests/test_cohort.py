@@ -0,0 +1,129 @@
+import pandas as pd
+import pytest
+
+from cohort import CohortError, CohortIndex
+
+# The cohort expression parser over a small hand-made population, and the ?cohort=
+# parameter as the endpoints see it.
+#
+#   patient  gender  state  city     age  conditions
+#   0        F       Texas  Austin   70   Diabetes
+#   1        M       Ohio   Dayton   30
+#   2        F       Texas  El Paso  10   Asthma, Diabetes
+#   3        M       Texas  Austin   66   Diabetes
+#   4        F       Ohio   Dayton   40
+
+
+@pytest.fixture(scope='module')
+def index():
+    patients = pd.DataFrame({
+        'GENDER': pd.Categorical(['F', 'M', 'F', 'M', 'F']),
+        'RACE': pd.Categorical(['white'] * 5),
+        'STATE': pd.Categorical(['Texas', 'Ohio', 'Texas', 'Texas', 'Ohio']),
+        'CITY': pd.Categorical(['Austin', 'Dayton', 'El Paso', 'Austin', 'Dayton']),
+        'AGE': [70, 30, 10, 66, 40],
+    })
+    return CohortIndex(patients, condition_ids=[0, 2, 2, 3], condition_codes=[0, 1, 0, 0],
+                       condition_categories=['Diabetes', 'Asthma'])
+
+
+def members(index, expression):
+    return set(index.parse(expression).ids().tolist())
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('gender:F', {0, 2, 4}),
+    ('condition:Diabetes', {0, 2, 3}),
+    ('age:65+', {0, 3}),
+    ('city:"El Paso"', {2}),
+    # AND binds tighter than OR, on either side
+    ('gender:F OR gender:M AND state:Ohio', {0, 1, 2, 4}),
+    ('state:Ohio AND gender:M OR gender:F', {0, 1, 2, 4}),
+    ('gender:M OR state:Ohio AND age:36-50 OR city:"El Paso"', {1, 2, 3, 4}),
+    # Keywords in any case; values match exactly
+    ('gender:f or gender:M and state:Ohio', {1}),
+    ('gender:F or gender:M and state:Ohio', {0, 1, 2, 4}),
+])
+def test_precedence(index, expression, expected):
+    assert members(index, expression) == expected
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('NOT state:Texas', {1, 4}),
+    ('NOT NOT state:Texas', {0, 2, 3}),
+    ('gender:F AND NOT age:65+', {2, 4}),
+    # NOT binds tighter than AND and OR
+    ('NOT gender:F OR state:Texas', {0, 1, 2, 3}),
+    ('NOT gender:F AND state:Texas', {3}),
+    ('NOT condition:Asthma', {0, 1, 3, 4}),
+    # The complement stays within the population
+    ('NOT (gender:F OR gender:M)', set()),
+])
+def test_not(index, expression, expected):
+    assert members(index, expression) == expected
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('(gender:F OR gender:M) AND state:Ohio', {1, 4}),
+    ('gender:F AND (state:Ohio OR condition:Asthma)', {2, 4}),
+    ('NOT (state:Texas AND condition:Diabetes)', {1, 4}),
+    ('((gender:M) OR (age:0-18 AND (condition:Asthma)))', {1, 2, 3}),
+])
+def test_parentheses(index, expression, expected):
+    assert members(index, expression) == expected
+
+
+@pytest.mark.parametrize('expression', [
+    'planet:Mars',
+    'gender:F AND planet:Mars',
+    'age:200+',
+    '(gender:F',
+    'gender:F)',
+    'gender:F AND',
+    'NOT',
+    'gender',
+    'city:',
+    'gender:F state:Ohio',
+])
+def test_invalid_expressions_raise(index, expression):
+    with pytest.raises(CohortError):
+        index.parse(expression)
+
+
+@pytest.mark.parametrize('expression', [
+    'state:Atlantis',
+    'condition:"Not a condition"',
+    'gender:F AND gender:M',
+    'age:0-18 AND age:65+',
+])
+def test_empty_result(index, expression):
+    cohort = index.parse(expression)
+    assert len(cohort) == 0 and cohort.n == 5 and not cohort.ids().size
+
+
+def test_endpoint_counts_match_the_population(app_module, client):
+    genders = app_module.snapshot.patients['GENDER'].value_counts()
+    for gender, count in genders.items():
+        assert client.get(f'/api/cohort?cohort=gender:{gender}').get_json()['patients'] == count
+    everyone = client.get('/api/cohort?cohort=' + ' OR '.join(f'gender:{g}' for g in genders.index)).get_json()
+    assert everyone['patients'] == everyone['population'] == len(app_module.snapshot.patients)
+
+
+@pytest.mark.parametrize('url', [
+    '/api/cohort?cohort=planet:Mars',
+    '/api/cohort?cohort=(gender:F',
+    '/api/dashboard_stats?cohort=planet:Mars',
+    '/api/patients?cohort=gender:F AND planet:Mars',
+])
+def test_invalid_cohort_is_a_bad_request(client, url):
+    response = client.get(url)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_empty_cohort_is_not_an_error(client):
+    assert client.get('/api/cohort?cohort=state:Atlantis').get_json()['patients'] == 0
+    patients = client.get('/api/patients?cohort=gender:F AND NOT gender:F&limit=5').get_json()
+    assert patients['data'] == [] and patients['total'] == 0
+    stats = client.get('/api/dashboard_stats?cohort=state:Atlantis').get_json()
+    assert stats['totalPatients'] == 0
@@ -0,0 +1,169 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ingest
+from snapshot import Snapshot, build_snapshot, current_version, map_rows
+
+# Incremental ingestion against a full rebuild of the same rows.
+#
+# A generated dataset is split into a base snapshot and two batches: A holds the later rows
+# of every clinical table (some for patients that do not exist yet), B the missing
+# patients plus updates of existing ones (a new city, which sorts first). Both batches go
+# through /api/ingest, so the server swaps versions and carries its derived structures
+# over; the tables and the endpoints must then match a snapshot built from scratch.
+
+BASE_SHARE = 0.7
+NEW_CITY = 'Aaa New City'
+URLS = [
+    '/api/dashboard_stats',
+    '/api/disease_trends',
+    '/api/top_diseases?timeRange=year',
+    '/api/patients?limit=50&sort=-HRI',
+    '/api/patients?limit=50&sort=CITY',
+    '/api/patients?limit=50&sort=-condition_count&gender=F',
+    '/api/resource_utilization',
+    '/api/medication_trends',
+    '/api/patient_demographics',
+    '/api/census?table=encounters&freq=year',
+    '/api/reports?report_type=conditions&format=json',
+    '/api/cohort?cohort=city:"Aaa%20New%20City"',
+]
+# Values that name the snapshot version rather than describe the data
+VOLATILE = {'version', 'next_cursor', 'generated_at', 'snapshot'}
+
+
+def write(df, directory, table):
+    os.makedirs(directory, exist_ok=True)
+    df.to_csv(os.path.join(directory, f'cleaned_{table}.csv'), index=False)
+
+
+def comparable(value):
+    if isinstance(value, dict):
+        return {k: comparable(v) for k, v in value.items() if k not in VOLATILE}
+    if isinstance(value, list):
+        return [comparable(v) for v in value]
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+
+def plain(df):
+    # Text columns as plain values: the category codes of the two versions differ
+    return pd.DataFrame({c: df[c].astype(object) if isinstance(df[c].dtype, pd.CategoricalDtype) else df[c]
+                         for c in df.columns})
+
+
+def frame(snapshot, table):
+    return plain(snapshot.table(table))
+
+
+@pytest.fixture(scope='module')
+def versions(app_module, tmp_path_factory):
+    app = app_module
+    root = tmp_path_factory.mktemp('ingest')
+    source = os.environ.get('PHI_DATA_DIR') or app.DATA_DIR
+    tables = {t: pd.read_csv(os.path.join(source, f'cleaned_{t}.csv'), dtype=str, keep_default_na=False)
+              for t in ('patients', 'conditions', 'encounters', 'medications', 'observations', 'claims')}
+
+    patients = tables.pop('patients')
+    split = int(len(patients) * BASE_SHARE)
+    updated = patients.iloc[:10].assign(CITY=NEW_CITY)
+    for table, df in tables.items():
+        cut = int(len(df) * BASE_SHARE)
+        write(df.iloc[:cut], root / 'base', table)
+        write(df.iloc[cut:], root / 'incoming' / 'a', table)
+        write(df, root / 'full', table)
+    write(patients.iloc[:split], root / 'base', 'patients')
+    write(pd.concat([patients.iloc[split:], updated]), root / 'later' / 'b', 'patients')
+    write(pd.concat([updated, patients.iloc[10:]]), root / 'full', 'patients')
+
+    saved = app.SNAPSHOT_DIR, app.INGEST_DIR, app.current_snapshot
+    app.SNAPSHOT_DIR, app.INGEST_DIR = str(root / 'snapshot'), str(root / 'incoming')
+    build_snapshot(str(root / 'base'), app.SNAPSHOT_DIR)
+    base = Snapshot(os.path.join(app.SNAPSHOT_DIR, current_version(app.SNAPSHOT_DIR)))
+    app.current_snapshot = base
+    try:
+        client = app.app.test_client()
+        app.preload()
+        for url in URLS:
+            client.get(url)
+        headers = {'X-Admin-Token': app.ADMIN_TOKEN}
+        carried = [client.post('/api/ingest', headers=headers).get_json()]
+        shutil.move(str(root / 'later' / 'b'), str(root / 'incoming' / 'b'))
+        carried.append(client.post('/api/ingest', headers=headers).get_json())
+        ingested = app.current_snapshot
+        served = {url: client.get(url).get_json() for url in URLS}
+
+        full = Snapshot(os.path.join(str(root / 'rebuilt'), build_snapshot(str(root / 'full'), str(root / 'rebuilt'))))
+        with app.pinned(full):
+            rebuilt = {url: client.get(url).get_json() for url in URLS}
+        yield {'base': base, 'ingested': ingested, 'full': full, 'carried': carried,
+               'served': served, 'rebuilt': rebuilt, 'snapshot_dir': app.SNAPSHOT_DIR}
+    finally:
+        app.SNAPSHOT_DIR, app.INGEST_DIR, app.current_snapshot = saved
+
+
+def test_batches_are_swapped_in_with_carried_structures(versions):
+    first, second = versions['carried']
+    assert [list(b) for b in first['batches'] + second['batches']] == [['batch', 'version']] * 2
+    assert 'encounter_cube' in first['carried_over'] and 'patient_table' in first['carried_over']
+    assert versions['ingested'].version == second['version']
+    # B adds the patients A's rows were waiting for
+    assert versions['ingested'].meta['relinked']
+
+
+@pytest.mark.parametrize('table', ['patients', 'conditions', 'encounters', 'claims'])
+def test_tables_match_a_rebuild(versions, table):
+    pd.testing.assert_frame_equal(frame(versions['ingested'], table), frame(versions['full'], table), check_dtype=False)
+    if table != 'patients':
+        assert np.array_equal(versions['ingested'].patient_ids(table), versions['full'].patient_ids(table))
+
+
+def test_patient_aggregates_match_a_rebuild(app_module, versions):
+    with app_module.pinned(versions['ingested']):
+        carried = app_module.patient_table().df
+    with app_module.pinned(versions['full']):
+        rebuilt = app_module.patient_table().df
+    pd.testing.assert_frame_equal(plain(carried), plain(rebuilt), check_dtype=False)
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_endpoints_match_a_rebuild(versions, url):
+    assert comparable(versions['served'][url]) == comparable(versions['rebuilt'][url])
+
+
+def test_new_city_sorts_first(versions):
+    cities = [p['CITY'] for p in versions['served']['/api/patients?limit=50&sort=CITY']['data']]
+    assert cities[:10] == [NEW_CITY] * 10
+
+
+def test_parent_files_keep_their_rows(versions):
+    # The ingested version shares (and extends) the base version's files; the base still
+    # reads exactly its own rows
+    base, ingested = versions['base'], versions['ingested']
+    rows = base.meta['tables']['conditions']['rows']
+    base_path = os.path.join(base.path, 'conditions', 'START.values.npy')
+    assert os.path.samefile(base_path, os.path.join(ingested.path, 'conditions', 'START.values.npy'))
+    assert np.array_equal(map_rows(base_path, rows), ingested.conditions['START'].array.asi8[:rows])
+    assert len(Snapshot(base.path).conditions) == rows
+
+
+def test_failed_batch_leaves_nothing_behind(versions, tmp_path, monkeypatch):
+    snapshot_dir = versions['snapshot_dir']
+    current = Snapshot(os.path.join(snapshot_dir, current_version(snapshot_dir)))
+    sizes = {path: os.path.getsize(path) for path in
+             (os.path.join(current.path, t, f) for t in current.meta['tables'] for f in os.listdir(os.path.join(current.path, t)))}
+    write(frame(current, 'conditions').head(5), tmp_path, 'conditions')
+
+    def fail(*args):
+        raise RuntimeError('disk full')
+    monkeypatch.setattr(ingest, '_patient_ids', fail)
+    with pytest.raises(RuntimeError):
+        ingest.ingest_batch(snapshot_dir, str(tmp_path))
+    assert current_version(snapshot_dir) == current.version
+    assert not [name for name in os.listdir(snapshot_dir) if name.endswith('.tmp')]
+    assert {path: os.path.getsize(path) for path in sizes} == sizes
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+import check_memory
+from synth import generate
+
+# Memory budget of the pre-fork serving mode: starts gunicorn with gunicorn.conf.py
+# (preload_app) on a generated dataset, sends every worker a few rounds of dashboard
+# requests and checks each worker's RSS and private memory (see check_memory.py).
+#
+# Budgets and size can be raised for larger machines or datasets:
+#
+#   PHI_TEST_PATIENTS=10000 PHI_TEST_RSS_BUDGET_MB=1024 python -m pytest tests/test_memory.py
+
+PATIENTS = int(os.environ.get('PHI_TEST_PATIENTS', 2000))
+WORKERS = 2
+RSS_BUDGET_MB = float(os.environ.get('PHI_TEST_RSS_BUDGET_MB', 256))
+PRIVATE_BUDGET_MB = float(os.environ.get('PHI_TEST_PRIVATE_BUDGET_MB', 128))
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='reads /proc/<pid>/smaps_rollup')
+
+
+@pytest.fixture(scope='module')
+def measured(tmp_path_factory):
+    pytest.importorskip('gunicorn')
+    root = tmp_path_factory.mktemp('memory')
+    generate(PATIENTS, str(root / 'csv'))
+    env = dict(os.environ, PHI_DATA_DIR=str(root / 'csv'), PHI_SNAPSHOT_DIR=str(root / 'snapshot'),
+               PHI_CACHE_DIR=str(root / 'cache'), PHI_REPORT_DIR=str(root / 'reports'),
+               PHI_INGEST_DIR=str(root / 'incoming'), PHI_VOCAB_RULES=str(root / 'vocabulary.json'),
+               PHI_METRICS_DIR=str(root / 'metrics'), PHI_FORECAST_WORKERS='1')
+    env.pop('PHI_PROFILE_DIR', None)
+    return check_memory.measure(workers=WORKERS, threads=2, rounds=2, startup_timeout=300, env=env)
+
+
+def test_requests_succeed(measured):
+    _, workers, failed = measured
+    assert len(workers) == WORKERS
+    assert failed == 0
+
+
+def test_worker_rss_within_budget(measured):
+    _, workers, _ = measured
+    rss = {pid: m['rss'] / 2**20 for pid, m in workers.items()}
+    assert max(rss.values()) <= RSS_BUDGET_MB, f"worker RSS MiB {rss} over {RSS_BUDGET_MB}"
+
+
+def test_worker_private_within_budget(measured):
+    # What one more worker costs: its own heap plus copy-on-write copies of the master's
+    _, workers, _ = measured
+    private = {pid: m['private'] / 2**20 for pid, m in workers.items()}
+    assert max(private.values()) <= PRIVATE_BUDGET_MB, f"worker private MiB {private} over {PRIVATE_BUDGET_MB}"
@@ -0,0 +1,56 @@
+import pytest
+
+# Cursor paging of /api/patients: a cursor continues the query it came from and is refused
+# by any other.
+
+QUERY = '/api/patients?sort=-HRI&gender=F&age_min=30&fields=Id,HRI'
+
+
+def page(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def test_cursor_pages_cover_the_query(client):
+    everything = page(client, f'{QUERY}&limit=1000')
+    ids, url = [], f'{QUERY}&limit=7'
+    while True:
+        result = page(client, url)
+        assert result['total'] == everything['total']
+        ids += [row['Id'] for row in result['data']]
+        if result['next_cursor'] is None:
+            break
+        url = f"{QUERY}&limit=7&cursor={result['next_cursor']}"
+    assert ids == [row['Id'] for row in everything['data']]
+
+
+def test_repeated_and_reordered_filter_values_keep_the_cursor(client):
+    cursor = page(client, '/api/patients?limit=5&gender=F&gender=M')['next_cursor']
+    assert page(client, f'/api/patients?limit=5&gender=M&gender=F&gender=M&cursor={cursor}')['data']
+
+
+@pytest.mark.parametrize('changed', [
+    '/api/patients?sort=-HRI&gender=M&age_min=30',
+    '/api/patients?sort=-HRI&gender=F&age_min=31',
+    '/api/patients?sort=-HRI&gender=F',
+    '/api/patients?sort=-HRI&gender=F&age_min=30&cohort=age:65%2B',
+    '/api/patients?sort=AGE&gender=F&age_min=30',
+])
+def test_cursor_is_refused_by_another_query(client, changed):
+    cursor = page(client, f'{QUERY}&limit=5')['next_cursor']
+    response = client.get(f'{changed}&limit=5&cursor={cursor}')
+    assert response.status_code == 400
+    assert 'restart paging' in response.get_json()['error']
+
+
+def test_cursor_of_a_cohort_is_refused_by_another_cohort(client):
+    cursor = page(client, '/api/patients?limit=5&cohort=gender:F')['next_cursor']
+    assert page(client, f'/api/patients?limit=5&cohort=gender:F&cursor={cursor}')['data']
+    assert client.get(f'/api/patients?limit=5&cohort=gender:M&cursor={cursor}').status_code == 400
+
+
+def test_malformed_cursor(client):
+    response = client.get('/api/patients?limit=5&cursor=not-a-cursor')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Invalid cursor'
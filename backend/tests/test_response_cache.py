@@ -0,0 +1,210 @@
+import gzip
+import threading
+import time
+
+import pytest
+from flask import Flask, jsonify, request
+from werkzeug.datastructures import MultiDict
+
+import response_cache
+from response_cache import ResponseCache, normalize_query
+
+# The shared response cache (response_cache.py) on a small Flask app of its own, with the
+# cache enabled in a temporary directory, and the ETags of the real app's views (whose
+# cache the test configuration turns off; validators do not depend on it).
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # time.time() under the test's control; response_cache reads it for TTL windows,
+    # expiry and LRU access times
+    now = [1_000_000.0]
+    monkeypatch.setattr(response_cache.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(str(tmp_path / 'cache'), max_entries=100)
+
+
+@pytest.fixture
+def served(cache):
+    # -> (test client, state): state['version'] is the data version, state['calls'] counts
+    # the view computations
+    state = {'version': 'v1', 'calls': 0}
+    app = Flask(__name__)
+
+    def body():
+        state['calls'] += 1
+        return jsonify({'query': request.args.to_dict(flat=False), 'rows': list(range(500))})
+
+    app.add_url_rule('/data', 'data', cache.view(lambda: state['version'])(body))
+    app.add_url_rule('/ttl', 'ttl', cache.view(lambda: state['version'], ttl=60)(body))
+    app.add_url_rule('/stream', 'stream', cache.conditional(lambda: state['version'])(body))
+    return app.test_client(), state
+
+
+def entry(name):
+    return 200, {'Content-Type': 'text/plain'}, name.encode() * 10
+
+
+def test_query_normalization():
+    args = MultiDict([('b', '2'), ('a', ' 1 '), ('c', ''), ('b', '1'), ('d', '  ')])
+    assert normalize_query(args) == 'a=1&b=2&b=1'
+
+
+def test_equivalent_queries_share_an_entry(served):
+    client, state = served
+    first = client.get('/data?b=2&a=1')
+    assert client.get('/data?a=1&b=2&c=').headers['ETag'] == first.headers['ETag']
+    assert client.get('/data?a=%201&b=2').headers['ETag'] == first.headers['ETag']
+    assert state['calls'] == 1
+    # Repeated values keep their order: another request
+    client.get('/data?a=1&a=2')
+    client.get('/data?a=2&a=1')
+    assert state['calls'] == 3
+
+
+def test_outcomes_and_counters(served, cache):
+    client, state = served
+    client.get('/data?x=1')
+    client.get('/data?x=1')
+    client.get('/data?x=2')
+    counters = cache.stats()['counters']
+    assert (counters['misses'], counters['hits'], counters['stores']) == (2, 1, 2)
+    assert state['calls'] == 2
+
+
+def test_ttl_entries_expire_with_their_window(served, cache, clock):
+    client, state = served
+    clock[0] = 600 * 60.0
+    first = client.get('/ttl')
+    clock[0] += 59
+    assert client.get('/ttl').headers['ETag'] == first.headers['ETag']
+    assert state['calls'] == 1
+    # The next window is another key (and ETag); the previous entry has expired
+    clock[0] += 1
+    second = client.get('/ttl')
+    assert state['calls'] == 2 and second.headers['ETag'] != first.headers['ETag']
+    assert cache.get(first.get_etag()[0], record=False) is None
+    assert cache.stats()['counters']['expired'] == 1
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / 'lru'), max_entries=3)
+    for name in ('a', 'b', 'c'):
+        clock[0] += 1
+        cache.put(name, name, 'v1', entry(name))
+    clock[0] += 1
+    assert cache.get('a') is not None
+    cache.flush()
+    clock[0] += 1
+    cache.put('d', 'd', 'v1', entry('d'))
+    assert [k for k in 'abcd' if cache.get(k, record=False) is not None] == ['a', 'c', 'd']
+    assert cache.stats()['counters']['evictions'] == 1
+
+
+def test_size_bound(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / 'size'), max_bytes=25)
+    for name in ('a', 'b', 'c'):
+        clock[0] += 1
+        cache.put(name, name, 'v1', entry(name))
+    stats = cache.stats()
+    assert stats['entries'] == 2 and stats['bytes'] <= 25
+    assert cache.get('a', record=False) is None
+
+
+def test_concurrent_misses_compute_once(cache):
+    calls, outcomes = [], []
+    started = threading.Barrier(8)
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return entry('slow')
+
+    def request_it():
+        started.wait()
+        result, outcome = cache.get_or_compute(ResponseCache.key('/slow', '', 'v1'), '/slow', 'v1', compute)
+        outcomes.append((result[2], outcome))
+
+    threads = [threading.Thread(target=request_it) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(outcome for _, outcome in outcomes) == ['coalesced'] * 7 + ['miss']
+    assert {body for body, _ in outcomes} == {entry('slow')[2]}
+
+
+def test_errors_are_not_stored(cache):
+    failed = (500, {}, b'{"error": "boom"}')
+    for _ in range(2):
+        _, outcome = cache.get_or_compute(ResponseCache.key('/fails', '', 'v1'), '/fails', 'v1', lambda: failed)
+        assert outcome == 'uncacheable'
+    assert cache.stats()['entries'] == 0
+
+
+def test_a_new_data_version_invalidates(served, cache):
+    client, state = served
+    first = client.get('/data')
+    state['version'] = 'v2'
+    second = client.get('/data')
+    assert state['calls'] == 2 and second.headers['ETag'] != first.headers['ETag']
+    # The old validator no longer matches
+    assert client.get('/data', headers={'If-None-Match': first.headers['ETag']}).status_code == 200
+    assert cache.stats()['versions'] == {'v1': 1, 'v2': 1}
+
+
+def test_each_content_coding_has_its_etag(served):
+    client, state = served
+    plain = client.get('/data', headers={'Accept-Encoding': 'identity'})
+    zipped = client.get('/data', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in plain.headers
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert zipped.headers['ETag'] == f'"{plain.get_etag()[0]}-gzip"'
+    assert gzip.decompress(zipped.get_data()) == plain.get_data()
+    assert 'Accept-Encoding' in zipped.headers['Vary'] and 'Accept-Encoding' in plain.headers['Vary']
+    assert state['calls'] == 1
+
+
+@pytest.mark.parametrize('encoding', ['identity', 'gzip'])
+def test_any_coding_revalidates(served, encoding):
+    client, state = served
+    tags = {e: client.get('/data', headers={'Accept-Encoding': e}).headers['ETag'] for e in ('identity', 'gzip')}
+    for tag in (tags['identity'], tags['gzip'], f'W/{tags["gzip"]}'):
+        response = client.get('/data', headers={'Accept-Encoding': encoding, 'If-None-Match': tag})
+        assert response.status_code == 304 and not response.get_data()
+        assert response.headers['ETag'] == tag.removeprefix('W/')
+        assert 'Accept-Encoding' in response.headers['Vary']
+    assert state['calls'] == 1
+
+
+def test_conditional_views(served):
+    client, state = served
+    first = client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in first.headers
+    assert first.headers['Cache-Control'] == 'no-cache'
+    for encoding in ('identity', 'gzip'):
+        response = client.get('/stream', headers={'Accept-Encoding': encoding, 'If-None-Match': first.headers['ETag']})
+        assert response.status_code == 304
+    assert state['calls'] == 1
+    state['version'] = 'v2'
+    assert client.get('/stream', headers={'If-None-Match': first.headers['ETag']}).status_code == 200
+
+
+@pytest.mark.parametrize('url, other', [
+    ('/api/export', '/api/export?fields=Id'),
+    ('/api/export/patients?format=csv&limit=5', '/api/export/patients?format=csv&limit=6'),
+    ('/api/dashboard_stats', '/api/dashboard_stats?as_of=2020-01-01'),
+])
+def test_app_views_answer_304(client, url, other):
+    first = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert first.status_code == 200 and first.headers['Cache-Control'] == 'no-cache'
+    etag = first.headers['ETag']
+    for encoding in ('identity', 'gzip'):
+        response = client.get(url, headers={'Accept-Encoding': encoding, 'If-None-Match': etag})
+        assert response.status_code == 304 and response.headers['ETag'] == etag
+    assert client.get(other, headers={'If-None-Match': etag}).status_code == 200
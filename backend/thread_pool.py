@@ -0,0 +1,31 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-process thread pool, started on first use.
+#
+# Threads do not survive a fork (pre-fork servers such as gunicorn fork their workers after
+# the app is imported): a forked child drops the parent's executor and starts its own on
+# its first submit. Tasks run in a copy of the submitting thread's context, so a request's
+# snapshot, vocabulary rules and stage timer (see metrics.py) follow its work onto the pool.
+
+
+class ThreadPool:
+    def __init__(self, workers, name):
+        self.workers = max(1, workers)
+        self.name = name
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        # fn(*args) on the pool, in a copy of the caller's context -> Future
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix=self.name)
+        return self._executor.submit(contextvars.copy_context().run, fn, *args)
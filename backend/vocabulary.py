@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from snapshot import category_ranks
+
+# Condition classification computed once per distinct DESCRIPTION rather than per row.
+#
+# The snapshot stores DESCRIPTION as codes into a shared vocabulary, so every flag
+# here is an array indexed by code: `flags.is_medical[codes]` classifies a whole
+# table with one gather. Changing the rules only re-runs `classify` over the
+# vocabulary (a few hundred strings); the tables are never rescanned.
+
+DEFAULT_RULES = {
+    # A description is a medical condition when it contains one of these keywords
+    'medical_keywords': ['disorder', 'disease', 'syndrome', 'infection', 'injury', 'condition'],
+    # Chronic: the N medical descriptions most often left open (no STOP) ...
+    'chronic_top_open': 5,
+    # ... plus descriptions containing any of these keywords or listed explicitly
+    'chronic_keywords': [],
+    'chronic_descriptions': [],
+    # Never chronic, whatever the other rules say
+    'acute_descriptions': [],
+    # Rows without a STOP date count as chronic regardless of their description
+    'open_is_chronic': True,
+}
+
+
+def load_rules(path=None):
+    # Defaults, overridden by the JSON file at `path` when it exists
+    rules = dict(DEFAULT_RULES)
+    if path and os.path.exists(path):
+        with open(path) as f:
+            rules.update(json.load(f))
+    return validate_rules(rules)
+
+
+def save_rules(path, rules):
+    # Replace the JSON file atomically, so readers in other processes see old or new rules
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(rules, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def rules_stamp(path):
+    # Identity of the rules file as it is now (None: no file); changes whenever it is replaced
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def validate_rules(rules):
+    unknown = set(rules) - set(DEFAULT_RULES)
+    if unknown:
+        raise ValueError(f"Unknown vocabulary rules: {sorted(unknown)}")
+    for key in ('medical_keywords', 'chronic_keywords', 'chronic_descriptions', 'acute_descriptions'):
+        if not isinstance(rules[key], list) or not all(isinstance(v, str) for v in rules[key]):
+            raise ValueError(f"'{key}' must be a list of strings")
+    # bool is an int subclass: true / false are not counts
+    top_open = rules['chronic_top_open']
+    if not isinstance(top_open, int) or isinstance(top_open, bool) or top_open < 0:
+        raise ValueError("'chronic_top_open' must be a non-negative integer")
+    if not isinstance(rules['open_is_chronic'], bool):
+        raise ValueError("'open_is_chronic' must be true or false")
+    return rules
+
+
+def rules_version(rules):
+    return hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()[:8]
+
+
+def _contains_any(lowered, keywords):
+    mask = np.zeros(len(lowered), dtype=bool)
+    for kw in keywords:
+        mask |= lowered.str.contains(kw.lower(), regex=False).to_numpy()
+    return mask
+
+
+class ConditionFlags:
+    def __init__(self, categories, rules, open_counts):
+        # categories: the DESCRIPTION vocabulary; open_counts[code]: rows with no STOP
+        self.categories = pd.Index(categories)
+        self.rules = rules
+        self.version = rules_version(rules)
+        lowered = pd.Series(self.categories.astype(str)).str.lower()
+
+        self.is_medical = _contains_any(lowered, rules['medical_keywords'])
+
+        # Top-N medical descriptions by open count (ties broken by description, not by
+        # vocabulary code, which ingestion appends to)
+        chronic = np.zeros(len(self.categories), dtype=bool)
+        ranked = np.where(self.is_medical & (open_counts > 0), open_counts, -1)
+        top = np.lexsort((category_ranks(self.categories), -ranked))[:rules['chronic_top_open']]
+        chronic[top[ranked[top] > 0]] = True
+        chronic |= _contains_any(lowered, rules['chronic_keywords'])
+        chronic |= self.categories.isin(rules['chronic_descriptions'])
+        chronic &= ~self.categories.isin(rules['acute_descriptions'])
+        self.is_chronic = chronic
+
+    @property
+    def chronic_conditions(self):
+        return set(self.categories[self.is_chronic])
+
+    def codes_of(self, values):
+        # Vocabulary codes for a list of descriptions; unknown values are dropped
+        codes = self.categories.get_indexer(list(values))
+        return codes[codes >= 0]
+
+    def row_flags(self, codes, open_rows):
+        # (is_medical, is_chronic) for each row given its DESCRIPTION codes and STOP-is-NaT mask
+        valid = codes >= 0
+        safe = np.where(valid, codes, 0)
+        is_medical = valid & self.is_medical[safe]
+        is_chronic = valid & self.is_chronic[safe]
+        if self.rules['open_is_chronic']:
+            is_chronic = is_chronic | open_rows
+        return is_medical, is_chronic
+
+    def summary(self):
+        return {
+            'version': self.version,
+            'rules': self.rules,
+            'descriptions': int(len(self.categories)),
+            'medical': int(self.is_medical.sum()),
+            'chronic': sorted(self.chronic_conditions),
+        }
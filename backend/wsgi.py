@@ -0,0 +1,22 @@
+import gc
+
+from app import app, cache, forecaster, preload, warm_cache
+
+# Production entry point for a pre-fork server:
+#
+#   gunicorn -c gunicorn.conf.py wsgi:application
+#
+# With preload_app the master imports this module once: the snapshot columns are
+# memory-mapped (page cache, shared by every process that maps them) and the derived
+# indexes, cubes and bitmaps are built before the workers fork, so they are inherited
+# copy-on-write instead of rebuilt per worker. gc.freeze() moves those objects out of
+# the collector's generations, so collections in a worker do not touch (and copy) them.
+# The forecasting pool is shut down before the fork; each worker starts its own on demand.
+
+preload()
+if cache.enabled:
+    warm_cache()
+forecaster.close()
+gc.freeze()
+
+application = app
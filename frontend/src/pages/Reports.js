@@ -16,13 +16,14 @@ const Reports = () => {
 
   const fetchAvailableYears = async () => {
     try {
-      const response = await fetch('http://localhost:5000/api/resource_utilization');
+      // Only the year list is needed: ask for the filters widget, not the whole utilization page
+      const response = await fetch('http://localhost:5000/api/batch?widgets=resource_filters');
       if (!response.ok) {
         const errorText = await response.text();
         throw new Error(`Failed to fetch years: ${response.status} - ${errorText}`);
       }
       const data = await response.json();
-      setAvailableYears(data.filters?.available_years || []);
+      setAvailableYears(data.results?.resource_filters?.available_years || []);
     } catch (err) {
       console.error('Fetch years error:', err);
       setError(`Failed to fetch years: ${err.message}`);
@@ -34,8 +35,31 @@ const Reports = () => {
     try {
       setLoading(true);
       setError(null);
-      const url = `http://localhost:5000/api/reports?report_type=${reportType}&year=${yearFilter}&format=${format}`;
-      const response = await fetch(url);
+      // Reports are generated as background jobs: submit one (or find the finished one),
+      // poll its status, then fetch the stored result
+      const submitted = await fetch('http://localhost:5000/api/reports/jobs', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ report_type: reportType, year: yearFilter }),
+      });
+      if (!submitted.ok) {
+        const errorText = await submitted.text();
+        throw new Error(`Failed to submit report: ${submitted.status} - ${errorText}`);
+      }
+      let job = await submitted.json();
+      while (job.state === 'queued' || job.state === 'running') {
+        await new Promise(resolve => setTimeout(resolve, 500));
+        const status = await fetch(`http://localhost:5000${job.status_url}`);
+        if (!status.ok) {
+          const errorText = await status.text();
+          throw new Error(`Failed to fetch report status: ${status.status} - ${errorText}`);
+        }
+        job = await status.json();
+      }
+      if (job.state === 'failed') {
+        throw new Error(job.error);
+      }
+      const response = await fetch(`http://localhost:5000${job.result_url}?format=${format}`);
       if (!response.ok) {
         const errorText = await response.text();
         throw new Error(`Failed to fetch report: ${response.status} - ${errorText}`);